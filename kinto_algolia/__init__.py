@@ -1,15 +1,27 @@
-import pkg_resources
-
 from pyramid.settings import aslist
 from kinto.events import ServerFlushed
-from kinto.core.events import AfterResourceChanged
+from kinto.core.events import AfterResourceChanged, ResourceChanged
 
+from . import fallback
+from . import health
 from . import indexer
+from . import lanes
 from . import listener
+from . import metrics
+from . import ratelimit
+
 
+try:
+    from importlib import metadata
+except ImportError:  # pragma: no cover
+    # Python < 3.8: pkg_resources is slow to import, it scans all distributions.
+    import pkg_resources
 
-#: Module version, as defined in PEP-0396.
-__version__ = pkg_resources.get_distribution(__package__).version
+    #: Module version, as defined in PEP-0396.
+    __version__ = pkg_resources.get_distribution(__package__).version
+else:
+    #: Module version, as defined in PEP-0396.
+    __version__ = metadata.version(__package__)
 
 
 def includeme(config):
@@ -18,12 +30,37 @@ def includeme(config):
     # Register a global indexer object
     config.registry.indexer = indexer.load_from_config(config)
 
+    # Optionally check algolia periodically, instead of on every heartbeat.
+    config.registry.algolia_health = health.load_from_config(
+        config, config.registry.indexer
+    )
+
+    # Optionally index in background, with priority lanes.
+    config.registry.algolia_lanes = lanes.load_from_config(
+        config, config.registry.indexer
+    )
+
+    # Optionally limit the indexing rate per bucket or collection.
+    config.registry.algolia_rate_limiter = ratelimit.load_from_config(
+        config, config.registry.indexer, config.registry.algolia_lanes
+    )
+
+    # Optionally answer simple searches from memory when Algolia is unavailable.
+    config.registry.algolia_fallback = fallback.load_from_config(config)
+
     # Register heartbeat to check algolia integration.
     config.registry.heartbeats["algolia"] = indexer.heartbeat
 
     # Activate end-points.
     config.scan("kinto_algolia.views")
 
+    # Optionally collect timings and profiles of search requests.
+    config.include("kinto_algolia.profiling")
+
+    # Expose indexing metrics to Prometheus if enabled.
+    if config.registry.indexer.metrics.prometheus_registry is not None:
+        config.add_cornice_service(metrics.prometheus_metrics)
+
     on_record_changed_listener = listener.on_record_changed
 
     # If StatsD is enabled, monitor execution time of listener.
@@ -39,6 +76,12 @@ def includeme(config):
     )
 
     config.add_subscriber(listener.on_server_flushed, ServerFlushed)
+    config.add_subscriber(
+        listener.on_collection_changed,
+        ResourceChanged,
+        for_resources=("collection",),
+        for_actions=("create", "update"),
+    )
     config.add_subscriber(
         listener.on_collection_created,
         AfterResourceChanged,
@@ -0,0 +1,91 @@
+import argparse
+import logging
+import sys
+
+from kinto.core.storage import Sort
+from pyramid.paster import bootstrap
+
+from .utils import get_paginated
+
+
+DEFAULT_CONFIG_FILE = "config/kinto.ini"
+
+logger = logging.getLogger(__package__)
+
+
+def main(cli_args=None):
+    if cli_args is None:
+        cli_args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(
+        description="Rebuild the registry of the indices of each bucket from Algolia."
+    )
+    parser.add_argument(
+        "--ini",
+        help="Application configuration file",
+        dest="ini_file",
+        required=False,
+        default=DEFAULT_CONFIG_FILE,
+    )
+    args = parser.parse_args(args=cli_args)
+
+    print("Load config...")
+    env = bootstrap(args.ini_file)
+    registry = env["registry"]
+
+    # Make sure that kinto-algolia is configured.
+    try:
+        indexer = registry.indexer
+    except AttributeError:
+        logger.error("kinto-algolia not available.")
+        return 62
+
+    if indexer.index_registry is None:
+        logger.error("kinto-algolia index registry not enabled.")
+        return 62
+
+    bucket_ids = list(get_bucket_ids(registry.storage))
+    # Indices created while listing change the tokens of their bucket.
+    written = indexer.index_registry.written(bucket_ids)
+    indices = indexer.list_indices("%s-" % indexer.prefix)
+    indices_by_bucket, unknown = group_by_bucket(indexer, bucket_ids, indices)
+    indexer.index_registry.rebuild(indices_by_bucket, written)
+
+    print(
+        "%s indices registered for %s buckets."
+        % (len(indices) - len(unknown), len(bucket_ids))
+    )
+    for application_id, indexname in unknown:
+        logger.warning(
+            "Index '%s' of application '%s' does not belong to any bucket."
+            % (indexname, application_id)
+        )
+    return 0
+
+
+def get_bucket_ids(storage, limit=5000):
+    for buckets in get_paginated(storage, "bucket", "", sort=Sort("id", 1), limit=limit):
+        for bucket in buckets:
+            yield bucket["id"]
+
+
+def group_by_bucket(indexer, bucket_ids, indices):
+    """Return the indices of each bucket, and the ones of unknown buckets.
+
+    Bucket ids can contain dashes, the longest matching bucket id wins.
+    """
+    prefixes = sorted(
+        ((indexer.indexname(bucket_id, ""), bucket_id) for bucket_id in bucket_ids),
+        key=lambda prefix: len(prefix[0]),
+        reverse=True,
+    )
+    indices_by_bucket = {bucket_id: [] for bucket_id in bucket_ids}
+    unknown = []
+    for application_id, indexname in indices:
+        for prefix, bucket_id in prefixes:
+            if indexname.startswith(prefix):
+                indices_by_bucket[bucket_id].append((application_id, indexname))
+                break
+        else:
+            unknown.append((application_id, indexname))
+    return indices_by_bucket, unknown
@@ -1,5 +1,9 @@
 import argparse
+import collections
+import gzip
 import logging
+import math
+import multiprocessing
 import time
 import sys
 
@@ -10,9 +14,19 @@ from kinto.core.storage.exceptions import RecordNotFoundError
 from kinto.core.storage import Sort, Filter
 from kinto.core.utils import COMPARISON
 
+from .indexer import record_to_object
+from .lanes import Lanes
+from .utils import get_paginated_records, json_dumps, json_loads
+
 
 DEFAULT_CONFIG_FILE = "config/kinto.ini"
 
+#: Number of records read from the storage and sent to Algolia per batch.
+DEFAULT_BATCH_SIZE = 5000
+
+#: Algolia rejects objects larger than 10KB (default plans).
+DEFAULT_MAX_OBJECT_SIZE = 10000
+
 logger = logging.getLogger(__package__)
 
 
@@ -30,7 +44,50 @@ def main(cli_args=None):
     )
     parser.add_argument("-b", "--bucket", help="Bucket name.", type=str)
     parser.add_argument("-c", "--collection", help="Collection name.", type=str)
+    parser.add_argument(
+        "--export",
+        help="Export the collection to a gzipped NDJSON snapshot file.",
+        dest="export_file",
+        type=str,
+    )
+    parser.add_argument(
+        "--load",
+        help="Reindex from a gzipped NDJSON snapshot file, instead of the storage.",
+        dest="load_file",
+        type=str,
+    )
+    parser.add_argument("--workers", help="Number of parallel batch uploads.", type=int)
+    parser.add_argument(
+        "--processes",
+        help="Number of processes, each reindexing a range of last_modified values.",
+        type=int,
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="Number of records per batch (default: %s)." % DEFAULT_BATCH_SIZE,
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+    )
+    parser.add_argument(
+        "--dry-run",
+        help="Read and transform the records, and report the projected upload, "
+        "without sending anything to Algolia.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-object-size",
+        help="Size in bytes beyond which objects are reported as oversized "
+        "by --dry-run (default: %s)." % DEFAULT_MAX_OBJECT_SIZE,
+        type=int,
+        default=DEFAULT_MAX_OBJECT_SIZE,
+    )
     args = parser.parse_args(args=cli_args)
+    if args.processes and (args.load_file or args.export_file):
+        parser.error("--processes cannot be used with --load or --export")
+    if args.dry_run and (args.processes or args.export_file):
+        parser.error("--dry-run cannot be used with --processes or --export")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be positive")
 
     print("Load config...")
     env = bootstrap(args.ini_file)
@@ -46,81 +103,366 @@ def main(cli_args=None):
     bucket_id = args.bucket
     collection_id = args.collection
 
+    lanes = getattr(registry, "algolia_lanes", None)
+    if args.workers:
+        lanes = Lanes({"reindex": args.workers}, indexer.metrics)
+
+    if args.load_file:
+        # Records are read from the snapshot, the storage is not queried.
+        try:
+            snapshot = gzip.open(args.load_file, "rb")
+            header = json_loads(snapshot.readline())
+            bucket_id = bucket_id or header["bucket_id"]
+            collection_id = collection_id or header["collection_id"]
+            metadata = header["metadata"]
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.error("Cannot read snapshot '%s'" % args.load_file)
+            return 64
+        with snapshot:
+            pages = read_snapshot_pages(snapshot, limit=args.batch_size)
+            if args.dry_run:
+                estimate_pages(
+                    indexer, bucket_id, collection_id, pages, args.max_object_size
+                )
+                return 0
+            prepare_index(indexer, bucket_id, collection_id, metadata)
+            index_pages(indexer, bucket_id, collection_id, pages, lanes=lanes)
+        return 0
+
     # Get index settings from collection metadata.
     try:
-        settings = get_index_settings(registry.storage, bucket_id, collection_id)
+        metadata = get_collection_metadata(registry.storage, bucket_id, collection_id)
     except RecordNotFoundError:
         logger.error("No collection '%s' in bucket '%s'" % (collection_id, bucket_id))
         return 63
 
-    recreate_index(indexer, bucket_id, collection_id, settings)
+    if args.export_file:
+        export_snapshot(
+            registry.storage, bucket_id, collection_id, metadata, args.export_file
+        )
+        return 0
+
+    if args.dry_run:
+        pages = get_paginated_records(
+            registry.storage, bucket_id, collection_id, limit=args.batch_size
+        )
+        estimate_pages(indexer, bucket_id, collection_id, pages, args.max_object_size)
+        return 0
+
+    prepare_index(indexer, bucket_id, collection_id, metadata)
+
+    if args.processes and args.processes > 1:
+        failed = reindex_partitions(
+            args.ini_file,
+            registry.storage,
+            bucket_id,
+            collection_id,
+            args.processes,
+            workers=args.workers,
+            batch_size=args.batch_size,
+        )
+        return 65 if failed else 0
+
+    reindex_records(
+        indexer,
+        registry.storage,
+        bucket_id,
+        collection_id,
+        lanes=lanes,
+        batch_size=args.batch_size,
+    )
+
+    return 0
+
+
+def prepare_index(indexer, bucket_id, collection_id, metadata):
+    settings = metadata.get("algolia:settings")
+    sort_orders = metadata.get("algolia:sort_orders")
+    recreate_index(indexer, bucket_id, collection_id, settings, sort_orders)
     print("Waiting for Algolia quota stats to propagate.")
     for _ in range(3):
         time.sleep(1)  # Wait a couple of seconds
         print(".", end="")
         sys.stdout.flush()
     print()
-    reindex_records(indexer, registry.storage, bucket_id, collection_id)
-
-    return 0
 
 
-def get_index_settings(storage, bucket_id, collection_id):
+def get_collection_metadata(storage, bucket_id, collection_id):
     # Open collection metadata.
     # XXX: https://github.com/Kinto/kinto/issues/710
-    metadata = storage.get(
+    return storage.get(
         parent_id="/buckets/%s" % bucket_id,
         collection_id="collection",
         object_id=collection_id,
     )
-    return metadata.get("algolia:settings")
 
 
-def recreate_index(indexer, bucket_id, collection_id, settings):
+def recreate_index(indexer, bucket_id, collection_id, settings, sort_orders=None):
     index_name = indexer.indexname(bucket_id, collection_id)
-    # Delete existing index.
+    # Delete existing index (and its replicas).
     indexer.delete_index(bucket_id, collection_id)
     print("Old index '%s' deleted." % index_name)
     # Recreate the index with the new settings.
-    indexer.create_index(bucket_id, collection_id, settings=settings)
+    indexer.create_index(
+        bucket_id, collection_id, settings=settings, sort_orders=sort_orders
+    )
     print("New index '%s' created." % index_name)
 
 
-def get_paginated_records(storage, bucket_id, collection_id, limit=5000):
-    # We can reach the storage_fetch_limit, so we use pagination.
-    parent_id = "/buckets/%s/collections/%s" % (bucket_id, collection_id)
-    sorting = [Sort("last_modified", -1)]
-    pagination_rules = []
-    while "not gone through all pages":
-        records, _ = storage.get_all(
-            parent_id=parent_id,
-            collection_id="record",
-            pagination_rules=pagination_rules,
-            sorting=sorting,
-            limit=limit,
-        )
-        yield records
+def reindex_records(
+    indexer, storage, bucket_id, collection_id, lanes=None, batch_size=DEFAULT_BATCH_SIZE
+):
+    pages = get_paginated_records(storage, bucket_id, collection_id, limit=batch_size)
+    return index_pages(indexer, bucket_id, collection_id, pages, lanes=lanes)
 
-        if len(records) < limit:
-            break  # Done.
 
-        smallest_timestamp = records[-1]["last_modified"]
-        pagination_rules = [
-            [Filter("last_modified", smallest_timestamp, COMPARISON.LT)]
-        ]
+def index_pages(indexer, bucket_id, collection_id, pages, lanes=None):
+    total, _ = upload_pages(indexer, bucket_id, collection_id, pages, lanes=lanes)
+    print("\n%s records reindexed." % total)
+    return total
 
 
-def reindex_records(indexer, storage, bucket_id, collection_id):
+def upload_pages(indexer, bucket_id, collection_id, pages, lanes=None):
+    """Index the pages of records, and return the number of records indexed
+    and the number of pages that failed."""
     total = 0
-    for records in get_paginated_records(storage, bucket_id, collection_id):
+    failed = 0
+    futures = collections.deque()
+    for records in pages:
+        if lanes is not None:
+            # Pages are uploaded concurrently, on the reindex lane. The number
+            # of pages in memory is bounded by the number of workers.
+            if len(futures) >= 2 * lanes.lanes["reindex"].workers:
+                page_total = wait_page(futures.popleft())
+                total += page_total or 0
+                failed += page_total is None
+            futures.append(
+                lanes.submit(
+                    "reindex", index_page, indexer, bucket_id, collection_id, records
+                )
+            )
+            continue
         try:
-            with indexer.bulk() as bulk:
-                for record in records:
-                    bulk.index_record(bucket_id, collection_id, record=record)
-                print(".", end="")
-                sys.stdout.flush()
-            total += len(list(bulk.operations.items())[0][1])
+            total += index_page(indexer, bucket_id, collection_id, records)
         except AlgoliaException:
             logger.exception("Failed to index record")
+            failed += 1
             break
-    print("\n%s records reindexed." % total)
+    for future in futures:
+        page_total = wait_page(future)
+        total += page_total or 0
+        failed += page_total is None
+    return total, failed
+
+
+def wait_page(future):
+    try:
+        return future.result()
+    except AlgoliaException:
+        logger.exception("Failed to index record")
+        return None
+
+
+def get_partitions(storage, bucket_id, collection_id, processes):
+    """Split the collection into disjoint ranges of ``last_modified`` values.
+
+    The first and last ranges are open, in order to include the records that
+    are modified during the reindexation.
+    """
+    parent_id = "/buckets/%s/collections/%s" % (bucket_id, collection_id)
+    bounds = []
+    for direction in (1, -1):
+        records = storage.list_all(
+            resource_name="record",
+            parent_id=parent_id,
+            sorting=[Sort("last_modified", direction)],
+            limit=1,
+        )
+        if not records:
+            return [(None, None)]
+        bounds.append(records[0]["last_modified"])
+    oldest, newest = bounds
+    step = (newest - oldest + 1) / processes
+    limits = sorted({oldest + int(step * i) for i in range(1, processes)})
+    return list(zip([None] + limits, limits + [None]))
+
+
+def reindex_partition(
+    ini_file,
+    bucket_id,
+    collection_id,
+    since,
+    before,
+    workers=None,
+    batch_size=DEFAULT_BATCH_SIZE,
+):
+    """Reindex the records modified in ``[since, before[``, in a worker process."""
+    env = bootstrap(ini_file)
+    registry = env["registry"]
+    indexer = registry.indexer
+    lanes = Lanes({"reindex": workers}, indexer.metrics) if workers else None
+    filters = []
+    if since is not None:
+        filters.append(Filter("last_modified", since, COMPARISON.MIN))
+    if before is not None:
+        filters.append(Filter("last_modified", before, COMPARISON.LT))
+    pages = get_paginated_records(
+        registry.storage, bucket_id, collection_id, limit=batch_size, filters=filters
+    )
+    total, failed = upload_pages(indexer, bucket_id, collection_id, pages, lanes=lanes)
+    indexer.join()
+    return total, failed
+
+
+def try_reindex_partition(args):
+    try:
+        return reindex_partition(*args)
+    except Exception:
+        since, before = args[3:5]
+        logger.exception("Failed to reindex partition [%s, %s[" % (since, before))
+        return None
+
+
+def reindex_partitions(
+    ini_file,
+    storage,
+    bucket_id,
+    collection_id,
+    processes,
+    workers=None,
+    batch_size=DEFAULT_BATCH_SIZE,
+):
+    """Reindex the collection from several processes, and return the number of
+    pages or partitions that failed."""
+    partitions = get_partitions(storage, bucket_id, collection_id, processes)
+    print("Reindexing %s partitions in %s processes." % (len(partitions), processes))
+    total = 0
+    failed = 0
+    tasks = [
+        (ini_file, bucket_id, collection_id, since, before, workers, batch_size)
+        for since, before in partitions
+    ]
+    # Workers bootstrap their own application, connections are not inherited.
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes) as pool:
+        results = pool.imap_unordered(try_reindex_partition, tasks)
+        for done, result in enumerate(results, 1):
+            if result is None:
+                failed += 1
+                continue
+            partition_total, partition_failed = result
+            total += partition_total
+            failed += partition_failed
+            print(
+                "\nPartition %s/%s: %s records reindexed (total: %s)."
+                % (done, len(partitions), partition_total, total)
+            )
+    print("\n%s records reindexed, %s failures." % (total, failed))
+    return failed
+
+
+def index_page(indexer, bucket_id, collection_id, records):
+    with indexer.bulk() as bulk:
+        for record in records:
+            bulk.index_record(bucket_id, collection_id, record=record)
+        print(".", end="")
+        sys.stdout.flush()
+    return len(records)
+
+
+def estimate_pages(
+    indexer,
+    bucket_id,
+    collection_id,
+    pages,
+    max_object_size=DEFAULT_MAX_OBJECT_SIZE,
+):
+    """Transform the pages of records into Algolia objects without uploading
+    them, and report the projected upload."""
+    start = time.time()
+    sizes = collections.Counter()
+    oversized = []
+    batches = 0
+    for records in pages:
+        shards = set()
+        for record in records:
+            obj = record_to_object(record)
+            size = len(json_dumps(obj))
+            sizes[size] += 1
+            if size > max_object_size:
+                oversized.append(obj["objectID"])
+            shards.add(indexer.shard(bucket_id, collection_id, obj["objectID"]))
+        # Bulk uploads send one batch per page and per shard index.
+        batches += len(shards)
+        print(".", end="")
+        sys.stdout.flush()
+    elapsed = time.time() - start
+
+    total = sum(sizes.values())
+    stats = {
+        "records": total,
+        "bytes": sum(size * count for size, count in sizes.items()),
+        "p99_size": percentile(sizes, 99),
+        "max_size": max(sizes) if sizes else 0,
+        "oversized": oversized,
+        "batches": batches,
+        "records_per_second": total / elapsed if elapsed > 0 else 0,
+    }
+    print("\nDry run: nothing was sent to Algolia.")
+    print("%s records (%s bytes)." % (stats["records"], stats["bytes"]))
+    print(
+        "Object size: p99 %s bytes, max %s bytes."
+        % (stats["p99_size"], stats["max_size"])
+    )
+    if oversized:
+        print(
+            "%s objects larger than %s bytes: %s"
+            % (len(oversized), max_object_size, ", ".join(oversized[:10]))
+        )
+    print("%s batches projected." % stats["batches"])
+    print("%.0f records/s read and transformed." % stats["records_per_second"])
+    return stats
+
+
+def percentile(counts, percent):
+    """Return the nearest-rank percentile of the values counted in ``counts``."""
+    rank = math.ceil(sum(counts.values()) * percent / 100)
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen >= rank:
+            return value
+    return 0
+
+
+def export_snapshot(storage, bucket_id, collection_id, metadata, path):
+    """Write the collection records to a gzipped NDJSON file, whose first
+    line contains the collection metadata."""
+    header = {
+        "bucket_id": bucket_id,
+        "collection_id": collection_id,
+        "metadata": metadata,
+    }
+    total = 0
+    with gzip.open(path, "wb") as snapshot:
+        snapshot.write(json_dumps(header) + b"\n")
+        for records in get_paginated_records(storage, bucket_id, collection_id):
+            snapshot.writelines(json_dumps(record) + b"\n" for record in records)
+            total += len(records)
+            print(".", end="")
+            sys.stdout.flush()
+    print("\n%s records exported to '%s'." % (total, path))
+    return total
+
+
+def read_snapshot_pages(snapshot, limit=5000):
+    records = []
+    for line in snapshot:
+        if not line.strip():
+            continue
+        records.append(json_loads(line))
+        if len(records) == limit:
+            yield records
+            records = []
+    if records:
+        yield records
@@ -0,0 +1,154 @@
+import argparse
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from algoliasearch.exceptions import AlgoliaException
+from kinto.core import utils as core_utils
+from kinto.core.storage import Sort
+from kinto.core.storage.exceptions import RecordNotFoundError
+from pyramid.paster import bootstrap
+from pyramid.settings import aslist
+
+from .utils import get_paginated, settings_diff
+
+
+DEFAULT_CONFIG_FILE = "config/kinto.ini"
+DEFAULT_WORKERS = 8
+
+logger = logging.getLogger(__package__)
+
+
+def main(cli_args=None):
+    if cli_args is None:
+        cli_args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(
+        description="Apply index settings to all the monitored collections."
+    )
+    parser.add_argument(
+        "--ini",
+        help="Application configuration file",
+        dest="ini_file",
+        required=False,
+        default=DEFAULT_CONFIG_FILE,
+    )
+    parser.add_argument(
+        "-t",
+        "--template",
+        help="JSON file with the index settings to apply.",
+        dest="template_file",
+        required=True,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of collections updated in parallel.",
+        type=int,
+        default=DEFAULT_WORKERS,
+    )
+    args = parser.parse_args(args=cli_args)
+
+    try:
+        with open(args.template_file) as f:
+            template = json.load(f)
+        if not isinstance(template, dict):
+            raise ValueError("Settings template must be an object")
+    except (OSError, ValueError):
+        logger.error("Cannot read settings template '%s'" % args.template_file)
+        return 64
+
+    print("Load config...")
+    env = bootstrap(args.ini_file)
+    registry = env["registry"]
+
+    # Make sure that kinto-algolia is configured.
+    try:
+        indexer = registry.indexer
+    except AttributeError:
+        logger.error("kinto-algolia not available.")
+        return 62
+
+    collections = get_monitored_collections(registry)
+    print("Rolling settings out to %s collections." % len(collections))
+
+    def rollout(collection):
+        bucket_id, collection_id, metadata = collection
+        try:
+            return apply_template(indexer, bucket_id, collection_id, metadata, template)
+        except AlgoliaException:
+            logger.exception(
+                "Failed to update settings of '%s/%s'" % (bucket_id, collection_id)
+            )
+            return None
+
+    # Settings tasks are sent concurrently, and waited for all together.
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(rollout, collections))
+    indexer.join()
+
+    updated = len([r for r in results if r])
+    failed = len([r for r in results if r is None])
+    print(
+        "%s indices updated, %s unchanged, %s failed."
+        % (updated, len(results) - updated - failed, failed)
+    )
+    return 65 if failed else 0
+
+
+def get_monitored_collections(registry):
+    """Return the ``(bucket_id, collection_id, metadata)`` of the collections
+    listed in the ``kinto.algolia.resources`` setting."""
+    storage = registry.storage
+    collections = []
+    for resource_uri in aslist(registry.settings.get("algolia.resources", "")):
+        resource_name, matchdict = core_utils.view_lookup_registry(
+            registry, resource_uri
+        )
+        if resource_name == "bucket":
+            bucket_id = matchdict["id"]
+            records = list(get_bucket_collections(storage, bucket_id))
+        else:
+            bucket_id = matchdict["bucket_id"]
+            try:
+                records = [
+                    storage.get(
+                        parent_id="/buckets/%s" % bucket_id,
+                        collection_id="collection",
+                        object_id=matchdict["id"],
+                    )
+                ]
+            except RecordNotFoundError:
+                logger.warning(
+                    "No collection '%s' in bucket '%s'" % (matchdict["id"], bucket_id)
+                )
+                continue
+        collections.extend((bucket_id, r["id"], r) for r in records)
+    return collections
+
+
+def get_bucket_collections(storage, bucket_id, limit=5000):
+    pages = get_paginated(
+        storage, "collection", "/buckets/%s" % bucket_id, sort=Sort("id", 1), limit=limit
+    )
+    for collections in pages:
+        yield from collections
+
+
+def apply_template(indexer, bucket_id, collection_id, metadata, template):
+    """Send the template settings that differ from the current index settings.
+
+    Settings defined in the collection metadata take precedence.
+    """
+    settings = dict(template)
+    settings.update(metadata.get("algolia:settings") or {})
+    current = indexer.get_settings(bucket_id, collection_id)
+    diff = settings_diff(current, settings, removals=False)
+    if not diff:
+        return False
+    # Replicas rankings are reapplied, primary settings are forwarded.
+    sort_orders = metadata.get("algolia:sort_orders") or None
+    indexer.update_index(
+        bucket_id, collection_id, settings=diff, sort_orders=sort_orders
+    )
+    return True
@@ -0,0 +1,366 @@
+import logging
+import math
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+from algoliasearch.http.serializer import QueryParametersSerializer
+from kinto.core.storage import Filter, Sort
+from kinto.core.storage.exceptions import RecordNotFoundError
+from kinto.core.utils import COMPARISON
+
+from .utils import get_paginated_records, is_monitoring_collection
+
+
+logger = logging.getLogger(__name__)
+
+#: Collections with more records are not loaded in memory.
+DEFAULT_MAX_RECORDS = 50000
+
+#: Removed documents are purged from the postings beyond this number.
+COMPACT_MIN_REMOVED = 1000
+
+#: Search parameters that the fallback engine knows how to answer.
+SUPPORTED_PARAMS = {"query", "page", "hitsPerPage", "filters", "facetFilters"}
+
+TOKEN_RE = re.compile(r"\w+")
+FILTER_RE = re.compile(r'^([\w.]+):(?:"([^"]*)"|([^\s"]+))$')
+MODIFIER_RE = re.compile(r"^(?:unordered|ordered)\((.+)\)$")
+
+
+class UnsupportedSearch(Exception):
+    """The search parameters cannot be answered by the fallback engine."""
+
+
+def tokenize(text):
+    # Case and accents insensitive, like Algolia.
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return TOKEN_RE.findall(text)
+
+
+def searchable_fields(settings):
+    """Return the attributes listed in the index settings, or ``None`` for all."""
+    settings = settings or {}
+    attributes = settings.get("searchableAttributes") or settings.get(
+        "attributesToIndex"
+    )
+    if not attributes:
+        return None
+    fields = []
+    for attribute in attributes:
+        match = MODIFIER_RE.match(attribute)
+        if match:
+            attribute = match.group(1)
+        fields.extend(field.strip() for field in attribute.split(","))
+    return fields
+
+
+def get_attribute(obj, field):
+    for key in field.split("."):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def iter_strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from iter_strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_strings(item)
+
+
+def intersect(smaller, larger):
+    """Intersect two sorted arrays of document numbers."""
+    result = array("I")
+    low = 0
+    for docno in smaller:
+        low = bisect_left(larger, docno, low)
+        if low == len(larger):
+            break
+        if larger[low] == docno:
+            result.append(docno)
+    return result
+
+
+class InvertedIndex(object):
+    """Compact inverted index of the records of a collection.
+
+    Documents are numbered in indexing order, hence the postings of each token
+    are sorted arrays of document numbers. Removed documents stay in the
+    postings until the index is compacted.
+    """
+
+    def __init__(self, fields=None):
+        self.fields = fields
+        self.documents = []
+        self.docnos = {}
+        self.postings = {}
+        self._vocabulary = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.docnos)
+
+    def add(self, record, id_field="id"):
+        hit = dict(record)
+        hit["objectID"] = hit.pop(id_field)
+        with self._lock:
+            self._remove(hit["objectID"])
+            self._add(hit)
+
+    def remove(self, record_id):
+        with self._lock:
+            self._remove(record_id)
+            removed = len(self.documents) - len(self.docnos)
+            if removed > max(COMPACT_MIN_REMOVED, len(self.docnos)):
+                self._compact()
+
+    def _add(self, hit):
+        docno = len(self.documents)
+        self.documents.append(hit)
+        self.docnos[hit["objectID"]] = docno
+        if self.fields is None:
+            values = [v for k, v in hit.items() if k != "objectID"]
+        else:
+            values = [get_attribute(hit, field) for field in self.fields]
+        tokens = {t for text in iter_strings(values) for t in tokenize(text)}
+        for token in tokens:
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = array("I")
+                self._vocabulary = None
+            postings.append(docno)
+
+    def _remove(self, record_id):
+        docno = self.docnos.pop(record_id, None)
+        if docno is not None:
+            self.documents[docno] = None
+
+    def _compact(self):
+        documents = [hit for hit in self.documents if hit is not None]
+        self.documents = []
+        self.docnos = {}
+        self.postings = {}
+        self._vocabulary = None
+        for hit in documents:
+            self._add(hit)
+
+    def _prefix_postings(self, prefix):
+        # The last word of the query is matched as a prefix, as-you-type.
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        position = bisect_left(self._vocabulary, prefix)
+        docnos = set()
+        while position < len(self._vocabulary):
+            token = self._vocabulary[position]
+            if not token.startswith(prefix):
+                break
+            docnos.update(self.postings[token])
+            position += 1
+        return array("I", sorted(docnos))
+
+    def search(self, query, predicate=None):
+        """Return the hits matching all the words of the query, most recently
+        indexed first."""
+        tokens = tokenize(query)
+        with self._lock:
+            if tokens:
+                postings = [self.postings.get(t, array("I")) for t in tokens[:-1]]
+                postings.append(self._prefix_postings(tokens[-1]))
+                postings.sort(key=len)
+                docnos = postings[0]
+                for other in postings[1:]:
+                    docnos = intersect(docnos, other)
+            else:
+                docnos = range(len(self.documents))
+            hits = [self.documents[docno] for docno in reversed(docnos)]
+        return [
+            hit
+            for hit in hits
+            if hit is not None and (predicate is None or predicate(hit))
+        ]
+
+
+def parse_filters(params):
+    """Return a predicate for the ``filters`` and ``facetFilters`` parameters.
+
+    Only conjunctions of ``attribute:value`` are supported.
+    """
+    conditions = []
+    filters = params.get("filters") or ""
+    if not isinstance(filters, str):
+        raise UnsupportedSearch("filters")
+    if filters.strip():
+        conditions.extend(f.strip() for f in filters.split(" AND "))
+    facet_filters = params.get("facetFilters") or []
+    if not isinstance(facet_filters, list) or not all(
+        isinstance(f, str) for f in facet_filters
+    ):
+        raise UnsupportedSearch("facetFilters")
+    conditions.extend(facet_filters)
+
+    expected = []
+    for condition in conditions:
+        match = FILTER_RE.match(condition)
+        if not match:
+            raise UnsupportedSearch(condition)
+        field, quoted, value = match.groups()
+        expected.append((field, quoted if quoted is not None else value))
+    if not expected:
+        return None
+
+    def matches(value, expected_value):
+        if isinstance(value, list):
+            return any(matches(item, expected_value) for item in value)
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        return value is not None and str(value) == expected_value
+
+    def predicate(hit):
+        return all(matches(get_attribute(hit, f), v) for f, v in expected)
+
+    return predicate
+
+
+class FallbackSearch(object):
+    """Answer simple searches from memory when Algolia is unavailable.
+
+    The records of the selected collections are loaded from the storage on
+    first use. When the collection timestamp has moved, the records changed
+    since then (by any process) are read from the storage and applied to the
+    index, like a Kinto client synchronization.
+    """
+
+    def __init__(self, max_records=DEFAULT_MAX_RECORDS):
+        self.max_records = max_records
+        self.indexes = {}
+        self.timestamps = {}
+        self._lock = threading.Lock()
+
+    def is_selected(self, registry, bucket_id, collection_id):
+        return is_monitoring_collection(
+            registry, bucket_id, collection_id, setting="algolia.fallback.resources"
+        )
+
+    def get_index(self, registry, bucket_id, collection_id):
+        key = (bucket_id, collection_id)
+        timestamp = registry.storage.resource_timestamp(
+            resource_name="record",
+            parent_id="/buckets/%s/collections/%s" % key,
+        )
+        with self._lock:
+            if key not in self.indexes:
+                self.indexes[key] = self._load(registry.storage, *key)
+            elif self.timestamps[key] != timestamp:
+                self.indexes[key] = self._catch_up(
+                    registry.storage, key, self.indexes[key], self.timestamps[key]
+                )
+            self.timestamps[key] = timestamp
+            return self.indexes[key]
+
+    def _catch_up(self, storage, key, index, since):
+        if index is None:
+            # Too large when loaded, it may have shrunk since.
+            return self._load(storage, *key)
+        changes = storage.list_all(
+            resource_name="record",
+            parent_id="/buckets/%s/collections/%s" % key,
+            filters=[Filter("last_modified", since, COMPARISON.GT)],
+            sorting=[Sort("last_modified", 1)],
+            limit=self.max_records + 1,
+            include_deleted=True,
+        )
+        if len(changes) > self.max_records:
+            return self._load(storage, *key)
+        for record in changes:
+            if record.get("deleted"):
+                index.remove(record["id"])
+            else:
+                index.add(record)
+        return index
+
+    def _load(self, storage, bucket_id, collection_id):
+        metadata = storage.get(
+            resource_name="collection",
+            parent_id="/buckets/%s" % bucket_id,
+            object_id=collection_id,
+        )
+        records = []
+        for page in get_paginated_records(storage, bucket_id, collection_id):
+            records.extend(page)
+            if len(records) > self.max_records:
+                logger.warning(
+                    "Collection '%s/%s' is too large for the fallback search."
+                    % (bucket_id, collection_id)
+                )
+                return None
+        index = InvertedIndex(searchable_fields(metadata.get("algolia:settings")))
+        for record in sorted(records, key=lambda r: r["last_modified"]):
+            index.add(record)
+        return index
+
+    def drop(self, bucket_id, collection_id=None):
+        with self._lock:
+            for key in list(self.indexes):
+                if key[0] == bucket_id and collection_id in (None, key[1]):
+                    del self.indexes[key]
+                    self.timestamps.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.indexes.clear()
+            self.timestamps.clear()
+
+    def search(self, registry, bucket_id, collection_id, params, sort=None):
+        """Return the search results, or ``None`` if the search cannot be
+        answered from memory."""
+        if sort is not None or not set(params).issubset(SUPPORTED_PARAMS):
+            return None
+        if not self.is_selected(registry, bucket_id, collection_id):
+            return None
+        try:
+            page = int(params.get("page", 0))
+            hits_per_page = int(params["hitsPerPage"])
+            predicate = parse_filters(params)
+            index = self.get_index(registry, bucket_id, collection_id)
+        except (ValueError, UnsupportedSearch, RecordNotFoundError):
+            return None
+        if index is None:
+            return None
+
+        start = time.time()
+        query = params.get("query") or ""
+        hits = index.search(query, predicate)
+        start_hit = page * hits_per_page
+        end_hit = start_hit + hits_per_page
+        return {
+            "hits": hits[start_hit:end_hit],
+            "nbHits": len(hits),
+            "page": page,
+            "nbPages": (
+                int(math.ceil(len(hits) / hits_per_page)) if hits_per_page else 0
+            ),
+            "hitsPerPage": hits_per_page,
+            "processingTimeMS": int((time.time() - start) * 1000),
+            "exhaustiveNbHits": True,
+            "query": query,
+            "params": QueryParametersSerializer.serialize(params),
+            "degraded": True,
+        }
+
+
+def load_from_config(config):
+    settings = config.get_settings()
+    if not settings.get("algolia.fallback.resources"):
+        return None
+    max_records = int(settings.get("algolia.fallback.max_records", DEFAULT_MAX_RECORDS))
+    return FallbackSearch(max_records=max_records)
@@ -0,0 +1,76 @@
+import logging
+import time
+
+from .utils import PeriodicThread
+
+
+logger = logging.getLogger(__name__)
+
+#: A status older than this number of intervals is reported as failed.
+STALE_INTERVALS = 3
+
+
+class HealthProbe(object):
+    """Check Algolia in the background and keep the last outcome in memory.
+
+    The heartbeat endpoint is polled by load balancers, hence it reads the
+    cached status instead of calling Algolia on every hit. The status is also
+    sent to the metrics backends after every check.
+    """
+
+    def __init__(self, indexer, interval):
+        self.indexer = indexer
+        self.interval = interval
+        self.alive = None
+        self.last_check = None
+        self.last_success = None
+        self.latency = None
+        self.thread = PeriodicThread("kinto-algolia-health", interval, self.check)
+
+    def check(self):
+        start = time.time()
+        try:
+            self.indexer.isalive()
+        except Exception as e:
+            logger.exception(e)
+            self.alive = False
+        else:
+            self.alive = True
+            self.last_success = time.time()
+        self.last_check = time.time()
+        self.latency = self.last_check - start
+        self.publish()
+        return self.alive
+
+    def is_alive(self):
+        """Return the last status, or ``False`` if the probe stopped checking
+        (eg. hanging on Algolia, or dead)."""
+        if self.last_check is None:
+            return self.alive
+        age = time.time() - self.last_check
+        if age > STALE_INTERVALS * self.interval:
+            logger.warning("Algolia status is stale (last check %ds ago)." % age)
+            return False
+        return self.alive
+
+    def publish(self):
+        metrics = self.indexer.metrics
+        metrics.gauge("health.alive", 1 if self.alive else 0)
+        metrics.gauge("health.latency_seconds", self.latency)
+        if self.last_success is not None:
+            metrics.gauge("health.last_success", self.last_success)
+
+    def start(self):
+        # The first status is known before the thread starts.
+        self.thread.start(on_start=self.check)
+
+    def stop(self):
+        self.thread.stop()
+
+
+def load_from_config(config, indexer):
+    settings = config.get_settings()
+    interval = float(settings.get("algolia.heartbeat_interval_seconds", 0))
+    if interval <= 0:
+        return None
+    return HealthProbe(indexer, interval=interval)
@@ -0,0 +1,157 @@
+import uuid
+
+from kinto.core.cache import memory
+from pyramid.exceptions import ConfigurationError
+from pyramid.settings import asbool
+
+
+#: Registry entries are kept for 30 days after their last rebuild.
+DEFAULT_TTL = 30 * 24 * 3600
+
+
+class IndexRegistry(object):
+    """Keep the ``(application_id, index_name)`` of the indices of each bucket
+    in the Kinto cache.
+
+    Bucket deletions and server flushes can then target the known indices,
+    instead of listing all the indices of the Algolia applications.
+
+    The cache has no atomic updates, hence the entries are only written by the
+    ``kinto-algolia-reconcile`` command, from the Algolia indices. The creation
+    of an index only stamps its bucket (and the registry) with a new random
+    token, which never loses information under concurrency. The rebuild reads
+    the tokens before listing the indices, and an entry is trusted as long as
+    the token of its bucket is unchanged: no clocks are compared. Otherwise, or
+    if it is missing (eg. expired), ``None`` is returned and the caller lists
+    the indices.
+    """
+
+    def __init__(self, cache, prefix, ttl=DEFAULT_TTL):
+        self.cache = cache
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, bucket_id=None):
+        key = "algolia:indices:{}".format(self.prefix)
+        if bucket_id is None:
+            return key
+        return "{}:{}".format(key, bucket_id)
+
+    def _token(self, key):
+        return self.cache.get("{}:written".format(key))
+
+    def _trusted(self, key):
+        entry = self.cache.get(key)
+        if entry is None or entry["written"] != self._token(key):
+            return None
+        return entry
+
+    def indices(self, bucket_id):
+        """Return the indices of the bucket, or ``None`` if unknown."""
+        entry = self._trusted(self._key(bucket_id))
+        if entry is None:
+            return None
+        return [tuple(index) for index in entry["indices"]]
+
+    def buckets(self):
+        """Return the registered buckets, or ``None`` if unknown."""
+        entry = self._trusted(self._key())
+        if entry is None:
+            return None
+        return list(entry["buckets"])
+
+    def all(self):
+        """Return all the registered indices, or ``None`` if some are unknown."""
+        buckets = self.buckets()
+        if buckets is None:
+            return None
+        indices = []
+        for bucket_id in buckets:
+            bucket_indices = self.indices(bucket_id)
+            if bucket_indices is None:
+                return None
+            indices.extend(bucket_indices)
+        return indices
+
+    def touch(self, bucket_id):
+        """Stamp the bucket as written, before its indices are created."""
+        token = uuid.uuid4().hex
+        for key in (self._key(bucket_id), self._key()):
+            self.cache.set("{}:written".format(key), token, self.ttl)
+
+    def ensure(self, bucket_id, indices):
+        """Stamp the bucket, unless its trusted entry has the given indices.
+
+        Algolia implicitly creates the indices that receive objects.
+        """
+        known = self.indices(bucket_id)
+        if known is None or not set(indices).issubset(known):
+            self.touch(bucket_id)
+
+    def written(self, bucket_ids):
+        """Return the tokens of the buckets and of the registry (``None``),
+        to be read before listing the indices of a rebuild."""
+        return {
+            bucket_id: self._token(self._key(bucket_id))
+            for bucket_id in list(bucket_ids) + [None]
+        }
+
+    def remove(self, bucket_id, indices):
+        """Forget the deleted indices of the bucket.
+
+        A removal lost to a concurrent one leaves the name of a deleted index,
+        which is harmless when deleting it again.
+        """
+        key = self._key(bucket_id)
+        entry = self.cache.get(key)
+        if entry is None:
+            return
+        remaining = [i for i in entry["indices"] if tuple(i) not in indices]
+        ttl = self.cache.ttl(key)
+        if len(remaining) < len(entry["indices"]) and ttl > 0:
+            # The expiration is kept, entries are only refreshed by rebuilds.
+            self.cache.set(key, dict(entry, indices=remaining), ttl)
+
+    def delete(self, bucket_id):
+        key = self._key(bucket_id)
+        self.cache.delete(key)
+        self.cache.delete("{}:written".format(key))
+
+    def rebuild(self, indices_by_bucket, written):
+        """Replace the whole registry with the given indices of every bucket,
+        listed from Algolia after reading the ``written`` tokens.
+
+        The tokens are kept: indices created while listing leave their bucket
+        untrusted.
+        """
+        entry = self.cache.get(self._key()) or {"buckets": []}
+        for bucket_id in entry["buckets"]:
+            self.cache.delete(self._key(bucket_id))
+        for bucket_id, indices in indices_by_bucket.items():
+            entry = {
+                "written": written.get(bucket_id),
+                "indices": [list(i) for i in indices],
+            }
+            self.cache.set(self._key(bucket_id), entry, self.ttl)
+        entry = {"written": written.get(None), "buckets": sorted(indices_by_bucket)}
+        self.cache.set(self._key(), entry, self.ttl)
+
+    def clear(self):
+        entry = self.cache.get(self._key()) or {"buckets": []}
+        for bucket_id in entry["buckets"]:
+            self.delete(bucket_id)
+        self.cache.delete(self._key())
+        self.cache.delete("{}:written".format(self._key()))
+
+
+def load_from_config(config, prefix):
+    settings = config.get_settings()
+    if not asbool(settings.get("algolia.index_registry", False)):
+        return None
+    cache = getattr(config.registry, "cache", None)
+    if cache is None or isinstance(cache, memory.Cache):
+        # Each process would only know the indices it created.
+        message = "kinto.algolia.index_registry requires a shared cache backend."
+        raise ConfigurationError(message)
+    ttl = int(settings.get("algolia.index_registry.ttl_seconds", DEFAULT_TTL))
+    return IndexRegistry(cache, prefix, ttl=ttl)
@@ -1,119 +1,599 @@
+import heapq
+import itertools
+import json
 import logging
+import math
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from contextlib import contextmanager
 
+from algoliasearch.http.serializer import QueryParametersSerializer
 from algoliasearch.http.verb import Verb
 from algoliasearch.search_client import SearchClient
 from algoliasearch.exceptions import AlgoliaException
+from pyramid.decorator import reify
 from pyramid.exceptions import ConfigurationError
+from pyramid.settings import asbool, aslist
+
+from . import index_registry as algolia_index_registry
+from . import metrics as algolia_metrics
+from .singleflight import SingleFlight
+from .utils import json_dumps
 
 
 logger = logging.getLogger(__name__)
 
+#: Algolia default ranking, applied after the sort criteria in replicas.
+DEFAULT_RANKING = [
+    "typo",
+    "geo",
+    "words",
+    "filters",
+    "proximity",
+    "attribute",
+    "exact",
+    "custom",
+]
+
+#: Algolia defaults, used to merge the results of sharded collections.
+DEFAULT_HITS_PER_PAGE = 20
+MAX_SHARD_HITS = 1000
+
+#: Threads querying the shards of the searches of all the requests.
+DEFAULT_SEARCH_THREADS = 32
+
+#: Number of seconds to wait for an identical search in flight.
+SEARCH_WAIT_TIMEOUT = 5.0
+
+SORT_CRITERION_RE = re.compile(r"^(asc|desc)\((.+)\)$")
+
+SHARDS_SETTING_RE = re.compile(r"^algolia\.([^.]+)\.([^.]+)\.shards$")
+
 
 class Indexer(object):
-    def __init__(self, application_id, api_key, prefix="kinto"):
-        self.client = SearchClient.create(application_id, api_key)
+    def __init__(
+        self,
+        application_id,
+        api_key,
+        prefix="kinto",
+        search_api_key=None,
+        metrics=None,
+        shards=1,
+        collection_shards=None,
+        applications=None,
+        partial_updates=True,
+        single_flight=None,
+        index_registry=None,
+        search_threads=DEFAULT_SEARCH_THREADS,
+    ):
+        self.application_id = application_id
+        self.api_key = api_key
+        self.search_api_key = search_api_key
         self.prefix = prefix
-        self.tasks = []
+        self.metrics = metrics or algolia_metrics.Metrics()
+        self.shards = shards
+        self.collection_shards = collection_shards or {}
+        # Additional (application_id, api_key) pairs, where shards are spread.
+        self.applications = applications or []
+        self.partial_updates = partial_updates
+        # Optionally share the result of concurrent identical searches.
+        self.single_flight = single_flight
+        # Optionally keep the names of the indices of each bucket.
+        self.index_registry = index_registry
+        self.search_threads = search_threads
+        # Last task of each index, waited for by ``join()``.
+        self.tasks = {}
+
+    @reify
+    def client(self):
+        # Instantiated on first use, in each worker process.
+        return SearchClient.create(self.application_id, self.api_key)
+
+    @reify
+    def application_clients(self):
+        return [
+            SearchClient.create(application_id, api_key)
+            for application_id, api_key in self.applications
+        ]
+
+    @reify
+    def executor(self):
+        # Used to query the shards of a collection in parallel. It is shared by
+        # the request threads, hence sized for concurrent searches.
+        max_shards = max([self.shards] + list(self.collection_shards.values()))
+        return ThreadPoolExecutor(max_workers=max(self.search_threads, max_shards))
+
+    def clients(self):
+        return [self.client] + self.application_clients
+
+    def client_for(self, shard):
+        application = shard % (len(self.applications) + 1)
+        if application == 0:
+            return self.client
+        return self.application_clients[application - 1]
+
+    def application_for(self, shard):
+        application = shard % (len(self.applications) + 1)
+        if application == 0:
+            return self.application_id
+        return self.applications[application - 1][0]
+
+    def application_ids(self):
+        return [self.application_id] + [a for a, _ in self.applications]
+
+    def client_by_application(self, application_id):
+        return self.clients()[self.application_ids().index(application_id)]
+
+    def list_indices(self, prefix):
+        """Return the ``(application_id, index_name)`` of the indices whose
+        name starts with ``prefix``, in all the applications."""
+        indices = []
+        for application_id, client in zip(self.application_ids(), self.clients()):
+            with self.metrics.timer("list_indices"):
+                response = client.list_indices()
+            indices.extend(
+                (application_id, i["name"])
+                for i in response["items"]
+                if i["name"].startswith(prefix)
+            )
+        return indices
 
     def join(self):
-        for indexname, taskID in self.tasks:
-            index = self.client.init_index(indexname)
-            index.wait_task(taskID)
-        self.tasks = []
+        tasks, self.tasks = self.tasks, {}
+        self.metrics.gauge("pending_tasks", len(tasks))
+        for index, taskID in tasks.values():
+            with self.metrics.timer("wait_task"):
+                index.wait_task(taskID)
+        self.metrics.gauge("pending_tasks", 0)
 
     def set_extra_headers(self, headers):
-        self.client._config.headers.update(headers)
+        for client in self.clients():
+            client._config.headers.update(headers)
 
     def indexname(self, bucket_id, collection_id):
         return "{}-{}-{}".format(self.prefix, bucket_id, collection_id)
 
+    def nb_shards(self, bucket_id, collection_id):
+        return self.collection_shards.get((bucket_id, collection_id), self.shards)
+
+    def shard(self, bucket_id, collection_id, record_id):
+        nb_shards = self.nb_shards(bucket_id, collection_id)
+        return zlib.crc32(str(record_id).encode("utf-8")) % nb_shards
+
+    def shardname(self, bucket_id, collection_id, shard):
+        indexname = self.indexname(bucket_id, collection_id)
+        if self.nb_shards(bucket_id, collection_id) == 1:
+            return indexname
+        return "{}-shard-{}".format(indexname, shard)
+
+    def replicaname(self, bucket_id, collection_id, sort_order, shard=0):
+        indexname = self.shardname(bucket_id, collection_id, shard)
+        return "{}-sort-{}".format(indexname, sort_order)
+
     def create_index(
-        self, bucket_id, collection_id, settings=None, wait_for_creation=False
+        self,
+        bucket_id,
+        collection_id,
+        settings=None,
+        sort_orders=None,
+        wait_for_creation=False,
     ):
         if settings is None:
             settings = {}
         self.update_index(
-            bucket_id, collection_id, settings=settings, wait_for_task=wait_for_creation
+            bucket_id,
+            collection_id,
+            settings=settings,
+            sort_orders=sort_orders,
+            wait_for_task=wait_for_creation,
         )
 
     def update_index(
-        self, bucket_id, collection_id, settings=None, wait_for_task=False
+        self,
+        bucket_id,
+        collection_id,
+        settings=None,
+        sort_orders=None,
+        wait_for_task=False,
     ):
-        indexname = self.indexname(bucket_id, collection_id)
+        for shard in range(self.nb_shards(bucket_id, collection_id)):
+            self._update_shard(
+                bucket_id, collection_id, shard, settings, sort_orders, wait_for_task
+            )
+
+    def _update_shard(
+        self, bucket_id, collection_id, shard, settings, sort_orders, wait_for_task
+    ):
+        client = self.client_for(shard)
+        indexname = self.shardname(bucket_id, collection_id, shard)
+        if self.index_registry is not None:
+            # The registry of the bucket cannot be trusted until rebuilt.
+            self.index_registry.touch(bucket_id)
+        if sort_orders is not None:
+            # Replicas are created by the primary index settings.
+            settings = dict(settings or {})
+            settings["replicas"] = [
+                self.replicaname(bucket_id, collection_id, name, shard)
+                for name in sort_orders
+            ]
         if settings is not None:
-            index = self.client.init_index(indexname)
-            res = index.set_settings(settings, {"forwardToReplicas": True})
+            index = client.init_index(indexname)
+            with self.metrics.timer("settings"):
+                res = index.set_settings(settings, {"forwardToReplicas": True})
+            if wait_for_task or sort_orders is not None:
+                with self.metrics.timer("wait_task"):
+                    res.wait()
+            else:
+                self._add_task(shard, index, res[0]["taskID"])
+
+        for name, ranking in (sort_orders or {}).items():
+            if not isinstance(ranking, list):
+                ranking = [ranking]
+            replicaname = self.replicaname(bucket_id, collection_id, name, shard)
+            replica = client.init_index(replicaname)
+            with self.metrics.timer("settings"):
+                res = replica.set_settings({"ranking": ranking + DEFAULT_RANKING})
             if wait_for_task:
-                res.wait()
+                with self.metrics.timer("wait_task"):
+                    res.wait()
             else:
-                self.tasks.append((indexname, res[0]["taskID"]))
+                self._add_task(shard, replica, res[0]["taskID"])
 
     def delete_index(self, bucket_id, collection_id=None):
+        names = []
+        indices = []
         if collection_id is None:
-            response = self.client.list_indices()
-            index_prefix = self.indexname(bucket_id, "")
-            collections = [
-                i["name"]
-                for i in response["items"]
-                if i["name"].startswith(index_prefix)
+            if self.index_registry is not None:
+                names = self.index_registry.indices(bucket_id)
+            if self.index_registry is None or names is None:
+                # Unknown indices, look for them in all the applications.
+                names = self.list_indices(self.indexname(bucket_id, ""))
+            indices = [
+                self.client_by_application(application_id).init_index(indexname)
+                for application_id, indexname in names
             ]
         else:
-            collections = [self.indexname(bucket_id, collection_id)]
+            for shard in range(self.nb_shards(bucket_id, collection_id)):
+                client = self.client_for(shard)
+                application_id = self.application_for(shard)
+                indexname = self.shardname(bucket_id, collection_id, shard)
+                index = client.init_index(indexname)
+                # Replicas are not deleted with their primary index.
+                replicas = self._replicas(index)
+                indices.append(index)
+                indices.extend(client.init_index(n) for n in replicas)
+                names.append((application_id, indexname))
+                names.extend((application_id, n) for n in replicas)
 
-        for indexname in collections:
+        for index in indices:
             try:
-                self.client.init_index(indexname).delete()
+                with self.metrics.timer("delete"):
+                    index.delete()
             except AlgoliaException as e:  # pragma: no cover
                 if "HTTP Code: 404" not in str(e):
                     raise
 
-    def search(self, bucket_id, collection_id, **kwargs):
-        indexname = self.indexname(bucket_id, collection_id)
-        index = self.client.init_index(indexname)
-        query = kwargs.pop("query", "")
-        return index.search(query, kwargs)
+        if self.index_registry is not None:
+            if collection_id is None:
+                self.index_registry.delete(bucket_id)
+            else:
+                self.index_registry.remove(bucket_id, names)
+
+    def delete_replicas(self, bucket_id, collection_id, sort_orders):
+        names = []
+        for shard in range(self.nb_shards(bucket_id, collection_id)):
+            client = self.client_for(shard)
+            for name in sort_orders:
+                replicaname = self.replicaname(bucket_id, collection_id, name, shard)
+                with self.metrics.timer("delete"):
+                    client.init_index(replicaname).delete()
+                names.append((self.application_for(shard), replicaname))
+        if self.index_registry is not None and names:
+            self.index_registry.remove(bucket_id, names)
+
+    def get_settings(self, bucket_id, collection_id):
+        indexname = self.shardname(bucket_id, collection_id, 0)
+        index = self.client_for(0).init_index(indexname)
+        try:
+            with self.metrics.timer("get_settings"):
+                return index.get_settings()
+        except AlgoliaException as e:
+            if getattr(e, "status_code", None) != 404:
+                raise
+            return {}
+
+    def _replicas(self, index):
+        try:
+            with self.metrics.timer("get_settings"):
+                settings = index.get_settings()
+        except AlgoliaException as e:
+            if getattr(e, "status_code", None) != 404:
+                raise
+            return []
+        return settings.get("replicas", [])
+
+    def search(self, bucket_id, collection_id, params=None, sort=None, ranking=None):
+        if self.single_flight is None:
+            return self._search(bucket_id, collection_id, params, sort, ranking)
+        key = json.dumps(
+            [bucket_id, collection_id, params, sort, ranking], sort_keys=True
+        )
+        return self.single_flight.do(
+            key, self._search, bucket_id, collection_id, params, sort, ranking
+        )
+
+    def _search(self, bucket_id, collection_id, params, sort, ranking):
+        params = dict(params or {})
+        query = params.pop("query", "")
+        nb_shards = self.nb_shards(bucket_id, collection_id)
+        if nb_shards == 1:
+            return self._search_shard(bucket_id, collection_id, 0, sort, query, params)
+
+        # Every shard returns its best hits up to the requested page, the
+        # ranked lists are then merged and the page is cut from the result.
+        page = int(params.pop("page", 0))
+        hits_per_page = int(params.get("hitsPerPage", DEFAULT_HITS_PER_PAGE))
+        params["hitsPerPage"] = min((page + 1) * hits_per_page, MAX_SHARD_HITS)
+        futures = [
+            self.executor.submit(
+                self._search_shard, bucket_id, collection_id, shard, sort, query, params
+            )
+            for shard in range(nb_shards)
+        ]
+        results = [future.result() for future in futures]
+        return merge_results(results, page, hits_per_page, ranking=ranking)
+
+    def _search_shard(self, bucket_id, collection_id, shard, sort, query, params):
+        if sort is not None:
+            indexname = self.replicaname(bucket_id, collection_id, sort, shard)
+        else:
+            indexname = self.shardname(bucket_id, collection_id, shard)
+        index = self.client_for(shard).init_index(indexname)
+        with self.metrics.timer("search"):
+            return index.search(query, params)
+
+    def browse(self, bucket_id, collection_id, **kwargs):
+        # Iterate on all the matching objects, one page (and cursor) at a time.
+        return itertools.chain.from_iterable(
+            self.client_for(shard)
+            .init_index(self.shardname(bucket_id, collection_id, shard))
+            .browse_objects(kwargs)
+            for shard in range(self.nb_shards(bucket_id, collection_id))
+        )
+
+    def multiple_search(self, bucket_id, queries):
+        # Every shard is queried in the ``multiple_queries`` call of its
+        # application, and the results of sharded collections are merged.
+        requests = {}
+        positions = []
+        for collection_id, params in queries:
+            params = dict(params)
+            params.setdefault("query", "")
+            nb_shards = self.nb_shards(bucket_id, collection_id)
+            page = hits_per_page = None
+            if nb_shards > 1:
+                page = int(params.pop("page", 0))
+                hits_per_page = int(params.get("hitsPerPage", DEFAULT_HITS_PER_PAGE))
+                params["hitsPerPage"] = min((page + 1) * hits_per_page, MAX_SHARD_HITS)
+            shards = []
+            for shard in range(nb_shards):
+                application_requests = requests.setdefault(
+                    self.application_for(shard), []
+                )
+                shards.append((self.application_for(shard), len(application_requests)))
+                application_requests.append(
+                    {
+                        "indexName": self.shardname(bucket_id, collection_id, shard),
+                        "params": QueryParametersSerializer.serialize(params),
+                    }
+                )
+            positions.append((shards, page, hits_per_page))
+
+        responses = {}
+        for application_id, application_requests in requests.items():
+            client = self.client_by_application(application_id)
+            with self.metrics.timer("multiple_queries"):
+                response = client.multiple_queries(application_requests)
+            responses[application_id] = response["results"]
+
+        results = []
+        for shards, page, hits_per_page in positions:
+            shard_results = [responses[app][position] for app, position in shards]
+            if len(shard_results) == 1:
+                results.append(shard_results[0])
+            else:
+                results.append(merge_results(shard_results, page, hits_per_page))
+        return results
+
+    def secured_api_key(
+        self, bucket_id, collection_id, valid_until, filters=None, sort_orders=None
+    ):
+        # Sharded collections are refused, their indices can be spread across
+        # applications that have their own search keys.
+        indices = [self.indexname(bucket_id, collection_id)] + [
+            self.replicaname(bucket_id, collection_id, name)
+            for name in (sort_orders or [])
+        ]
+        restrictions = {
+            "restrictIndices": ",".join(indices),
+            "validUntil": valid_until,
+        }
+        if filters:
+            restrictions["filters"] = filters
+        return SearchClient.generate_secured_api_key(self.search_api_key, restrictions)
 
     def flush(self):
-        response = self.client.list_indices()
-        for index in response["items"]:
-            indexname = index["name"]
-            if indexname.startswith(self.prefix):
-                index = self.client.init_index(indexname)
+        names = None
+        if self.index_registry is not None:
+            names = self.index_registry.all()
+        if names is None:
+            names = self.list_indices(self.prefix)
+        # Primary indices come first, in order to detach their replicas.
+        for application_id, indexname in sorted(names):
+            index = self.client_by_application(application_id).init_index(indexname)
+            with self.metrics.timer("delete"):
                 index.clear_objects().wait()
                 index.delete().wait()
+        if self.index_registry is not None:
+            self.index_registry.clear()
 
     def isalive(self):
-        self.client._transporter.read(Verb.GET, "1/isalive", {}, None)
+        with self.metrics.timer("isalive"):
+            self.client._transporter.read(Verb.GET, "1/isalive", {}, None)
 
     @contextmanager
     def bulk(self):
         bulk = BulkClient(self)
         yield bulk
 
+        if self.index_registry is not None:
+            # Algolia creates the missing indices, their buckets are stamped first.
+            indices_by_bucket = {}
+            for indexname in bulk.operations:
+                application_id = self.application_for(bulk.shards[indexname])
+                indices = indices_by_bucket.setdefault(bulk.buckets[indexname], [])
+                indices.append((application_id, indexname))
+            for bucket_id, indices in indices_by_bucket.items():
+                self.index_registry.ensure(bucket_id, indices)
+
         for indexname, requests in bulk.operations.items():
-            index = self.client.init_index(indexname)
-            res = index.batch(requests)
-            self.tasks.append((indexname, res[0]["taskID"]))
+            shard = bulk.shards[indexname]
+            index = self.client_for(shard).init_index(indexname)
+            if self.metrics.enabled:
+                payload_bytes = len(json_dumps(requests))
+                self.metrics.batch(indexname, len(requests), payload_bytes)
+            with self.metrics.timer("batch"):
+                res = index.batch(requests)
+            self._add_task(shard, index, res[0]["taskID"])
+
+    def _add_task(self, shard, index, taskID):
+        # The tasks of an index are processed in order: only the last one is
+        # kept, so that the web workers, which never join, do not accumulate them.
+        self.tasks[(self.application_for(shard), index.name)] = (index, taskID)
+
+
+def sort_key(attribute, descending):
+    """Return the key of the hits of a replica sorted on ``attribute``.
+
+    Algolia only sorts on numeric (and boolean) values, the hits where the
+    attribute is missing or has another type come last in both directions.
+    """
+
+    def key(hit):
+        value = hit.get(attribute)
+        if not isinstance(value, (int, float)):
+            return (1, 0)
+        return (0, -value if descending else value)
+
+    return key
+
+
+def merge_results(results, page, hits_per_page, ranking=None):
+    """Merge the ranked results of several shards into a single page.
+
+    Hits are merged on the sort attribute when the first ranking criterion is
+    ``asc(attr)`` or ``desc(attr)``, otherwise by rank within each shard.
+    """
+    if isinstance(ranking, list):
+        ranking = ranking[0] if ranking else None
+    match = SORT_CRITERION_RE.match(ranking) if ranking else None
+    if match:
+        order, attribute = match.groups()
+        merged = heapq.merge(
+            *[r["hits"] for r in results], key=sort_key(attribute, order == "desc")
+        )
+    else:
+        ranked = [
+            [(rank, shard, hit) for rank, hit in enumerate(r["hits"])]
+            for shard, r in enumerate(results)
+        ]
+        merged = (hit for _, _, hit in heapq.merge(*ranked))
+
+    start = page * hits_per_page
+    hits = list(itertools.islice(merged, start, start + hits_per_page))
+    nb_hits = sum(r.get("nbHits", 0) for r in results)
+    merged_results = {
+        "hits": hits,
+        "nbHits": nb_hits,
+        "page": page,
+        "nbPages": int(math.ceil(nb_hits / hits_per_page)) if hits_per_page else 0,
+        "hitsPerPage": hits_per_page,
+        "processingTimeMS": max(r.get("processingTimeMS", 0) for r in results),
+        "exhaustiveNbHits": all(r.get("exhaustiveNbHits", True) for r in results),
+        "query": results[0].get("query", ""),
+        "params": results[0].get("params", ""),
+    }
+    facets = {}
+    for result in results:
+        for facet, counts in result.get("facets", {}).items():
+            merged_counts = facets.setdefault(facet, {})
+            for value, count in counts.items():
+                merged_counts[value] = merged_counts.get(value, 0) + count
+    if facets:
+        merged_results["facets"] = facets
+    return merged_results
+
+
+def record_to_object(record, id_field="id"):
+    """Return the Algolia object of a Kinto record."""
+    obj = deepcopy(record)
+    obj["objectID"] = obj.pop(id_field)
+    return obj
 
 
 class BulkClient:
     def __init__(self, indexer):
         self.indexer = indexer
         self.operations = {}
+        self.shards = {}
+        self.buckets = {}
+
+    def _shard_index(self, bucket_id, collection_id, record_id):
+        shard = self.indexer.shard(bucket_id, collection_id, record_id)
+        indexname = self.indexer.shardname(bucket_id, collection_id, shard)
+        self.shards[indexname] = shard
+        self.buckets[indexname] = bucket_id
+        return indexname
 
     def index_record(self, bucket_id, collection_id, record, id_field="id"):
-        indexname = self.indexer.indexname(bucket_id, collection_id)
+        obj = record_to_object(record, id_field)
+        indexname = self._shard_index(bucket_id, collection_id, obj["objectID"])
         self.operations.setdefault(indexname, [])
-        obj = deepcopy(record)
-        record_id = obj.pop(id_field)
-        obj["objectID"] = record_id
         self.operations[indexname].append({"action": "addObject", "body": obj})
 
+    def update_record(self, bucket_id, collection_id, record, old, id_field="id"):
+        if not self.indexer.partial_updates:
+            return self.index_record(bucket_id, collection_id, record, id_field)
+
+        if any(key not in record for key in old):
+            # Partial updates cannot remove attributes, the object is replaced.
+            return self.index_record(bucket_id, collection_id, record, id_field)
+
+        record_id = record[id_field]
+        # Only the changed top-level attributes are sent.
+        body = {
+            key: value
+            for key, value in record.items()
+            if key != id_field and (key not in old or old[key] != value)
+        }
+        body["objectID"] = record_id
+
+        obj = record_to_object(record, id_field)
+        if len(json_dumps(body)) >= len(json_dumps(obj)):
+            # Replacing the whole object is not more expensive.
+            return self.index_record(bucket_id, collection_id, record, id_field)
+
+        indexname = self._shard_index(bucket_id, collection_id, record_id)
+        self.operations.setdefault(indexname, [])
+        self.operations[indexname].append(
+            {"action": "partialUpdateObjectNoCreate", "body": deepcopy(body)}
+        )
+
     def unindex_record(self, bucket_id, collection_id, record, id_field="id"):
-        indexname = self.indexer.indexname(bucket_id, collection_id)
         record_id = record[id_field]
+        indexname = self._shard_index(bucket_id, collection_id, record_id)
         self.operations.setdefault(indexname, [])
         self.operations[indexname].append(
             {"action": "deleteObject", "body": {"objectID": record_id}}
@@ -128,6 +608,12 @@ def heartbeat(request):
     :returns: ``True`` is everything is ok, ``False`` otherwise.
     :rtype: bool
     """
+    probe = getattr(request.registry, "algolia_health", None)
+    if probe is not None:
+        # Answer from the status refreshed in background.
+        probe.start()
+        return probe.is_alive()
+
     indexer = request.registry.indexer
     try:
         indexer.isalive()
@@ -150,5 +636,48 @@ def load_from_config(config):
         raise ConfigurationError(message)
 
     prefix = settings.get("algolia.index_prefix", "kinto")
-    indexer = Indexer(application_id=application_id, api_key=api_key, prefix=prefix)
+    search_api_key = settings.get("algolia.search_api_key")
+    metrics = algolia_metrics.load_from_config(config)
+
+    # Very large collections can be spread across several indices and applications.
+    shards = int(settings.get("algolia.shards", 1))
+    collection_shards = {}
+    for key, value in settings.items():
+        match = SHARDS_SETTING_RE.match(key)
+        if match:
+            collection_shards[match.groups()] = int(value)
+    if min([shards] + list(collection_shards.values())) < 1:
+        raise ConfigurationError("kinto.algolia shards settings must be positive.")
+
+    applications = []
+    for application in aslist(settings.get("algolia.applications", "")):
+        app_id, _, app_key = application.partition(":")
+        if not app_key:
+            message = "kinto.algolia.applications must be a list of app_id:api_key"
+            raise ConfigurationError(message)
+        applications.append((app_id, app_key))
+
+    single_flight = None
+    if asbool(settings.get("algolia.search.coalesce", True)):
+        timeout = float(
+            settings.get("algolia.search.coalesce_timeout_seconds", SEARCH_WAIT_TIMEOUT)
+        )
+        single_flight = SingleFlight("search", timeout=timeout, metrics=metrics)
+
+    indexer = Indexer(
+        application_id=application_id,
+        api_key=api_key,
+        prefix=prefix,
+        search_api_key=search_api_key,
+        metrics=metrics,
+        shards=shards,
+        collection_shards=collection_shards,
+        applications=applications,
+        partial_updates=asbool(settings.get("algolia.partial_updates", True)),
+        single_flight=single_flight,
+        index_registry=algolia_index_registry.load_from_config(config, prefix),
+        search_threads=int(
+            settings.get("algolia.search_threads", DEFAULT_SEARCH_THREADS)
+        ),
+    )
     return indexer
@@ -0,0 +1,152 @@
+import itertools
+import logging
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from pyramid.exceptions import ConfigurationError
+from pyramid.settings import asbool
+
+
+logger = logging.getLogger(__name__)
+
+#: Priority classes of indexing work, and their default number of workers.
+LANES = {"interactive": 4, "bulk": 1, "reindex": 2}
+
+#: Changes of up to this number of records are considered interactive.
+INTERACTIVE_MAX_RECORDS = 10
+
+
+class Lane(object):
+    """A pool of workers dedicated to one priority class of indexing work.
+
+    Work submitted with a key always runs on the same worker, in submission
+    order, so that the changes of a collection reach Algolia in order.
+    """
+
+    def __init__(self, name, workers, metrics):
+        self.name = name
+        self.workers = workers
+        self.metrics = metrics
+        self.futures = set()
+        self._executors = None
+        self._pid = None
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def executors(self):
+        # Threads do not survive a fork, create the workers once per process.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._executors = [
+                ThreadPoolExecutor(
+                    max_workers=1,
+                    thread_name_prefix="kinto-algolia-{}-{}".format(self.name, i),
+                )
+                for i in range(self.workers)
+            ]
+        return self._executors
+
+    def worker_for(self, key):
+        if key is None:
+            # Unordered work is spread across the workers.
+            return next(self._next) % self.workers
+        return zlib.crc32(repr(key).encode("utf-8")) % self.workers
+
+    def submit(self, func, *args, key=None):
+        with self._lock:
+            executor = self.executors[self.worker_for(key)]
+            future = executor.submit(func, *args)
+            self.futures.add(future)
+            self._gauge()
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self.futures.discard(future)
+            self._gauge()
+        # Nobody waits for the background work, its failures are reported here.
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            logger.error(
+                "Indexing work failed in lane '%s'." % self.name,
+                exc_info=(type(error), error, error.__traceback__),
+            )
+            self.metrics.error("lanes.{}".format(self.name))
+
+    def _gauge(self):
+        name = "lanes.{}.queue_depth".format(self.name)
+        self.metrics.gauge(name, len(self.futures))
+
+    def wait(self):
+        wait(list(self.futures))
+
+
+class Lanes(object):
+    """Route indexing work to the lane of its priority class, so that large
+    imports do not delay the interactive changes.
+
+    The work of a key (eg. a collection) that is pending in a lane is
+    followed there by the next work of the same key, whatever its class.
+    """
+
+    def __init__(self, workers, metrics, interactive_max_records=None):
+        if interactive_max_records is None:
+            interactive_max_records = INTERACTIVE_MAX_RECORDS
+        self.interactive_max_records = interactive_max_records
+        self.lanes = {
+            name: Lane(name, workers.get(name, default), metrics)
+            for name, default in LANES.items()
+        }
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def lane_for(self, nb_records):
+        if nb_records <= self.interactive_max_records:
+            return "interactive"
+        return "bulk"
+
+    def submit(self, lane, func, *args, key=None):
+        if key is None:
+            return self.lanes[lane].submit(func, *args)
+        with self._lock:
+            pending = self.pending.get(key)
+            if pending is not None and not pending[1].done():
+                # Queue behind the pending work, in order to keep the order.
+                lane = pending[0]
+            future = self.lanes[lane].submit(func, *args, key=key)
+            self.pending[key] = (lane, future)
+        future.add_done_callback(lambda future: self._forget(key, future))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            pending = self.pending.get(key)
+            if pending is not None and pending[1] is future:
+                del self.pending[key]
+
+    def wait(self):
+        for lane in self.lanes.values():
+            lane.wait()
+
+
+def load_from_config(config, indexer):
+    settings = config.get_settings()
+    if not asbool(settings.get("algolia.async_indexing", False)):
+        return None
+    workers = {}
+    for name in LANES:
+        value = settings.get("algolia.lanes.{}.workers".format(name))
+        if value is not None:
+            workers[name] = int(value)
+    if workers and min(workers.values()) < 1:
+        raise ConfigurationError("kinto.algolia lanes workers must be positive.")
+    interactive_max_records = settings.get("algolia.lanes.interactive.max_records")
+    if interactive_max_records is not None:
+        interactive_max_records = int(interactive_max_records)
+    return Lanes(
+        workers, indexer.metrics, interactive_max_records=interactive_max_records
+    )
@@ -1,13 +1,32 @@
 import logging
 
 from algoliasearch.exceptions import AlgoliaException
+from kinto.core.errors import raise_invalid
 from kinto.core.events import ACTIONS
-from .utils import is_monitoring_collection
+from .utils import is_monitoring_collection, is_valid_sort_orders, settings_diff
 
 
 logger = logging.getLogger(__name__)
 
 
+def on_collection_changed(event):
+    # Sent before the commit, invalid metadata is rejected with the request.
+    registry = event.request.registry
+    bucket_id = event.payload["bucket_id"]
+    for changed in event.impacted_records:
+        collection_id = changed["new"]["id"]
+        sort_orders = changed["new"].get("algolia:sort_orders")
+        if sort_orders is None or is_valid_sort_orders(sort_orders):
+            continue
+        if is_monitoring_collection(registry, bucket_id, collection_id):
+            error_details = {
+                "name": "algolia:sort_orders",
+                "description": "Sort orders must map names to a ranking criterion, "
+                "or to a list of criteria.",
+            }
+            raise_invalid(event.request, **error_details)
+
+
 def on_collection_created(event):
     registry = event.request.registry
     indexer = registry.indexer
@@ -16,7 +35,10 @@ def on_collection_created(event):
         collection_id = created["new"]["id"]
         if is_monitoring_collection(registry, bucket_id, collection_id):
             settings = created["new"].get("algolia:settings")
-            indexer.create_index(bucket_id, collection_id, settings=settings)
+            sort_orders = created["new"].get("algolia:sort_orders")
+            indexer.create_index(
+                bucket_id, collection_id, settings=settings, sort_orders=sort_orders
+            )
 
 
 def on_collection_updated(event):
@@ -27,11 +49,27 @@ def on_collection_updated(event):
         collection_id = updated["new"]["id"]
 
         if is_monitoring_collection(registry, bucket_id, collection_id):
-            old_settings = updated["old"].get("algolia:settings")
-            new_settings = updated["new"].get("algolia:settings")
-            # Create if there was no index before.
-            if old_settings != new_settings:
-                indexer.update_index(bucket_id, collection_id, settings=new_settings)
+            old_settings = updated["old"].get("algolia:settings") or {}
+            new_settings = updated["new"].get("algolia:settings") or {}
+            old_sort_orders = updated["old"].get("algolia:sort_orders") or {}
+            new_sort_orders = updated["new"].get("algolia:sort_orders") or {}
+            # Only the changed settings are sent, no-op updates are skipped.
+            settings = settings_diff(old_settings, new_settings)
+            if settings or old_sort_orders != new_sort_orders:
+                sort_orders = None
+                if old_sort_orders or new_sort_orders:
+                    # Replicas rankings are reapplied, primary settings are forwarded.
+                    sort_orders = new_sort_orders
+                indexer.update_index(
+                    bucket_id,
+                    collection_id,
+                    settings=settings,
+                    sort_orders=sort_orders,
+                )
+                removed = set(old_sort_orders) - set(new_sort_orders)
+                indexer.delete_replicas(bucket_id, collection_id, sorted(removed))
+                # Searchable attributes may have changed, reload from storage.
+                drop_fallback_index(registry, bucket_id, collection_id)
 
 
 def on_collection_deleted(event):
@@ -42,6 +80,7 @@ def on_collection_deleted(event):
         collection_id = deleted["old"]["id"]
         if is_monitoring_collection(registry, bucket_id, collection_id):
             indexer.delete_index(bucket_id, collection_id)
+            drop_fallback_index(registry, bucket_id, collection_id)
 
 
 def on_bucket_deleted(event):
@@ -51,6 +90,13 @@ def on_bucket_deleted(event):
         bucket_id = deleted["old"]["id"]
         if is_monitoring_collection(registry, bucket_id):
             indexer.delete_index(bucket_id)
+            drop_fallback_index(registry, bucket_id)
+
+
+def drop_fallback_index(registry, bucket_id, collection_id=None):
+    fallback = getattr(registry, "algolia_fallback", None)
+    if fallback is not None:
+        fallback.drop(bucket_id, collection_id)
 
 
 def on_record_changed(event):
@@ -62,21 +108,66 @@ def on_record_changed(event):
 
     if is_monitoring_collection(registry, bucket_id, collection_id):
         action = event.payload["action"]
-        try:
-            with indexer.bulk() as bulk:
-                for change in event.impacted_records:
-                    if action == ACTIONS.DELETE.value:
-                        bulk.unindex_record(
-                            bucket_id, collection_id, record=change["old"]
-                        )
-                    else:
-                        bulk.index_record(
-                            bucket_id, collection_id, record=change["new"]
-                        )
-        except AlgoliaException:
-            logger.exception("Failed to index record")
+        if action == ACTIONS.DELETE.value:
+            changes = [
+                (action, change["old"], None) for change in event.impacted_records
+            ]
+        elif action == ACTIONS.UPDATE.value:
+            # Previous version is kept in order to send only the changed attributes.
+            changes = [
+                (action, change["new"], change["old"])
+                for change in event.impacted_records
+            ]
+        else:
+            changes = [
+                (action, change["new"], None) for change in event.impacted_records
+            ]
+
+        lanes = getattr(registry, "algolia_lanes", None)
+        rate_limiter = getattr(registry, "algolia_rate_limiter", None)
+        if rate_limiter is not None:
+            # Operations beyond the bucket/collection budget are deferred.
+            rate_limiter.submit(bucket_id, collection_id, changes)
+        else:
+            changes = [(collection_id,) + change for change in changes]
+            key = (bucket_id, collection_id)
+            send_changes(indexer, lanes, bucket_id, key, changes)
+
+
+def send_changes(indexer, lanes, bucket_id, key, changes):
+    if not changes:
+        return
+    if lanes is not None:
+        # Large imports do not delay the interactive changes of other
+        # collections, the changes of a collection are sent in order.
+        lane = lanes.lane_for(len(changes))
+        lanes.submit(lane, try_index_changes, indexer, bucket_id, changes, key=key)
+    else:
+        try_index_changes(indexer, bucket_id, changes)
+
+
+def try_index_changes(indexer, bucket_id, changes):
+    try:
+        index_changes(indexer, bucket_id, changes)
+    except AlgoliaException:
+        logger.exception("Failed to index record")
+
+
+def index_changes(indexer, bucket_id, changes):
+    """Send the ``(collection_id, action, record, old)`` changes in a single batch."""
+    with indexer.bulk() as bulk:
+        for collection_id, action, record, old in changes:
+            if action == ACTIONS.DELETE.value:
+                bulk.unindex_record(bucket_id, collection_id, record=record)
+            elif old is not None:
+                bulk.update_record(bucket_id, collection_id, record=record, old=old)
+            else:
+                bulk.index_record(bucket_id, collection_id, record=record)
 
 
 def on_server_flushed(event):
-    indexer = event.request.registry.indexer
-    indexer.flush()
+    registry = event.request.registry
+    registry.indexer.flush()
+    fallback = getattr(registry, "algolia_fallback", None)
+    if fallback is not None:
+        fallback.clear()
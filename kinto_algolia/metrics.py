@@ -0,0 +1,216 @@
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from kinto.core import Service
+from pyramid.exceptions import ConfigurationError
+from pyramid.response import Response
+from pyramid.security import NO_PERMISSION_REQUIRED
+from pyramid.settings import asbool
+
+try:
+    import statsd as statsd_module
+except ImportError:  # pragma: no cover
+    statsd_module = None
+
+
+STATSD_PREFIX = "plugins.algolia"
+
+
+class Metrics(object):
+    """Send the indexing pipeline metrics to StatsD and/or Prometheus.
+
+    Without any backend, every method is a no-op. The StatsD backend is a
+    ``statsd.StatsClient``, since Kinto's wrapper has no gauges nor timings.
+    """
+
+    def __init__(self, statsd=None, prometheus=False):
+        self.statsd = statsd
+        self.prometheus_registry = None
+        if prometheus:
+            self._setup_prometheus()
+
+    @property
+    def enabled(self):
+        return self.statsd is not None or self.prometheus_registry is not None
+
+    def _setup_prometheus(self):
+        # Slow to import, hence only imported when enabled.
+        import prometheus_client
+
+        self.prometheus_client = prometheus_client
+        registry = prometheus_client.CollectorRegistry()
+        self._latency = prometheus_client.Histogram(
+            "kinto_algolia_operation_seconds",
+            "Latency of Algolia calls by operation.",
+            ["operation"],
+            registry=registry,
+        )
+        self._errors = prometheus_client.Counter(
+            "kinto_algolia_errors",
+            "Number of failed Algolia calls by operation.",
+            ["operation"],
+            registry=registry,
+        )
+        self._retries = prometheus_client.Counter(
+            "kinto_algolia_retries",
+            "Number of retried Algolia calls by operation.",
+            ["operation"],
+            registry=registry,
+        )
+        self._coalesced = prometheus_client.Counter(
+            "kinto_algolia_coalesced",
+            "Number of Algolia calls saved by coalescing identical calls, by operation.",
+            ["operation"],
+            registry=registry,
+        )
+        self._fallback = prometheus_client.Counter(
+            "kinto_algolia_fallback",
+            "Number of calls answered by the in-memory fallback engine, by operation.",
+            ["operation"],
+            registry=registry,
+        )
+        self._batch_size = prometheus_client.Histogram(
+            "kinto_algolia_batch_size",
+            "Number of operations per index batch.",
+            buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000),
+            registry=registry,
+        )
+        self._records = prometheus_client.Counter(
+            "kinto_algolia_indexed_records",
+            "Number of operations sent by index.",
+            ["index"],
+            registry=registry,
+        )
+        self._payload = prometheus_client.Counter(
+            "kinto_algolia_payload_bytes",
+            "Size of the batches sent by index.",
+            ["index"],
+            registry=registry,
+        )
+        self._budget_usage = prometheus_client.Gauge(
+            "kinto_algolia_rate_limit_usage",
+            "Ratio of the indexing rate limit budget in use, by scope.",
+            ["scope"],
+            registry=registry,
+        )
+        self._deferred = prometheus_client.Gauge(
+            "kinto_algolia_rate_limit_deferred",
+            "Number of indexing operations deferred by the rate limit, by scope.",
+            ["scope"],
+            registry=registry,
+        )
+        self._gauges = {}
+        self.prometheus_registry = registry
+
+    @contextmanager
+    def timer(self, operation):
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.error(operation)
+            raise
+        finally:
+            duration = time.time() - start
+            if self.statsd is not None:
+                key = "{}.{}".format(STATSD_PREFIX, operation)
+                self.statsd.timing(key, duration * 1000)
+            if self.prometheus_registry is not None:
+                self._latency.labels(operation).observe(duration)
+
+    def error(self, operation):
+        if self.statsd is not None:
+            self.statsd.incr("{}.errors.{}".format(STATSD_PREFIX, operation))
+        if self.prometheus_registry is not None:
+            self._errors.labels(operation).inc()
+
+    def retry(self, operation):
+        if self.statsd is not None:
+            self.statsd.incr("{}.retries.{}".format(STATSD_PREFIX, operation))
+        if self.prometheus_registry is not None:
+            self._retries.labels(operation).inc()
+
+    def coalesced(self, operation):
+        if self.statsd is not None:
+            self.statsd.incr("{}.coalesced.{}".format(STATSD_PREFIX, operation))
+        if self.prometheus_registry is not None:
+            self._coalesced.labels(operation).inc()
+
+    def fallback(self, operation):
+        if self.statsd is not None:
+            self.statsd.incr("{}.fallback.{}".format(STATSD_PREFIX, operation))
+        if self.prometheus_registry is not None:
+            self._fallback.labels(operation).inc()
+
+    def batch(self, indexname, size, payload_bytes):
+        if self.statsd is not None:
+            self.statsd.timing("{}.batch_size".format(STATSD_PREFIX), size)
+            key = "{}.indexed_records.{}".format(STATSD_PREFIX, indexname)
+            self.statsd.incr(key, count=size)
+            key = "{}.payload_bytes.{}".format(STATSD_PREFIX, indexname)
+            self.statsd.incr(key, count=payload_bytes)
+        if self.prometheus_registry is not None:
+            self._batch_size.observe(size)
+            self._records.labels(indexname).inc(size)
+            self._payload.labels(indexname).inc(payload_bytes)
+
+    def budget(self, scope, usage, deferred):
+        if self.statsd is not None:
+            key = "{}.rate_limit.{}".format(STATSD_PREFIX, scope.replace("/", "."))
+            self.statsd.gauge("{}.usage".format(key), usage)
+            self.statsd.gauge("{}.deferred".format(key), deferred)
+        if self.prometheus_registry is not None:
+            self._budget_usage.labels(scope).set(usage)
+            self._deferred.labels(scope).set(deferred)
+
+    def gauge(self, name, value):
+        if self.statsd is not None:
+            self.statsd.gauge("{}.{}".format(STATSD_PREFIX, name), value)
+        if self.prometheus_registry is not None:
+            if name not in self._gauges:
+                metric_name = "kinto_algolia_{}".format(name.replace(".", "_"))
+                self._gauges[name] = self.prometheus_client.Gauge(
+                    metric_name, name, registry=self.prometheus_registry
+                )
+            self._gauges[name].set(value)
+
+
+prometheus_metrics = Service(
+    name="algolia_metrics",
+    path="/__algolia_metrics__",
+    description="Prometheus exposition of indexing metrics",
+)
+
+
+@prometheus_metrics.get(permission=NO_PERMISSION_REQUIRED)
+def get_metrics(request):
+    metrics = request.registry.indexer.metrics
+    prometheus_client = metrics.prometheus_client
+    return Response(
+        body=prometheus_client.generate_latest(metrics.prometheus_registry),
+        content_type=prometheus_client.CONTENT_TYPE_LATEST.split(";")[0],
+        charset="utf-8",
+    )
+
+
+def load_from_config(config):
+    settings = config.get_settings()
+    prometheus = asbool(settings.get("algolia.metrics.prometheus", False))
+    if prometheus:
+        try:
+            import prometheus_client  # NOQA
+        except ImportError:
+            error_msg = "Please install the prometheus_client package"
+            raise ConfigurationError(error_msg)
+    statsd = None
+    if config.registry.statsd is not None:
+        statsd = statsd_client(settings)
+    return Metrics(statsd=statsd, prometheus=prometheus)
+
+
+def statsd_client(settings):
+    """Return a StatsD client configured like Kinto's one."""
+    uri = urlparse(settings["statsd_url"])
+    prefix = settings.get("project_name") or settings.get("statsd_prefix")
+    return statsd_module.StatsClient(uri.hostname, uri.port, prefix=prefix)
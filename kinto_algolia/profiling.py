@@ -0,0 +1,125 @@
+import cProfile
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from pyramid.events import ContextFound
+from pyramid.interfaces import IRoutesMapper
+from pyramid.settings import asbool
+
+
+logger = logging.getLogger(__name__)
+
+#: Routes for which timings are collected and profiles are sampled.
+PROFILED_ROUTES = ("search",)
+
+# Only one profiler can be active per process (enforced since Python 3.12).
+_profiler_lock = threading.Lock()
+
+
+class Timings(object):
+    """Durations of the successive phases of a request."""
+
+    def __init__(self):
+        self.start = self.last = time.time()
+        self.phases = []
+
+    def mark(self, name):
+        now = time.time()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def header(self):
+        phases = self.phases + [("total", self.last - self.start)]
+        return ", ".join(
+            "{};dur={:.2f}".format(name, duration * 1000) for name, duration in phases
+        )
+
+
+def mark(request, name):
+    """End the current phase of the request, if timings are collected."""
+    timings = getattr(request, "algolia_timings", None)
+    if timings is not None:
+        timings.mark(name)
+
+
+def on_context_found(event):
+    # Routing and ``RouteFactory`` instantiation are done.
+    mark(event.request, "routing")
+
+
+def is_profiled(request):
+    route = request.matched_route
+    return route is not None and route.name in PROFILED_ROUTES
+
+
+def start_profiler():
+    """Return an enabled profiler, or ``None`` if another one is active."""
+    if not _profiler_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Another profiling tool is active, the request is not sampled.
+        _profiler_lock.release()
+        logger.debug("Search request not profiled: %s", e)
+        return None
+    return profiler
+
+
+def stop_profiler(profiler):
+    profiler.disable()
+    _profiler_lock.release()
+
+
+def tween_factory(handler, registry):
+    settings = registry.settings
+    server_timing = asbool(settings.get("algolia.profiling.server_timing", False))
+    sample_rate = float(settings.get("algolia.profiling.sample_rate", 0))
+    directory = settings.get("algolia.profiling.directory") or tempfile.gettempdir()
+    mapper = registry.getUtility(IRoutesMapper)
+
+    def profiling_tween(request):
+        request.algolia_timings = Timings()
+
+        profiler = None
+        if sample_rate > 0 and random.random() < sample_rate:
+            # Routing is done by the handler, look up the route beforehand.
+            route = mapper(request)["route"]
+            if route is not None and route.name in PROFILED_ROUTES:
+                profiler = start_profiler()
+        try:
+            response = handler(request)
+        finally:
+            if profiler is not None:
+                stop_profiler(profiler)
+
+        if not is_profiled(request):
+            return response
+
+        mark(request, "render")
+        if server_timing:
+            response.headers["Server-Timing"] = request.algolia_timings.header()
+        if profiler is not None:
+            filename = "search-{}-{}.prof".format(int(time.time() * 1000), os.getpid())
+            path = os.path.join(directory, filename)
+            profiler.dump_stats(path)
+            logger.info("Search request profile written to %s", path)
+        return response
+
+    return profiling_tween
+
+
+def includeme(config):
+    settings = config.get_settings()
+    server_timing = asbool(settings.get("algolia.profiling.server_timing", False))
+    sample_rate = float(settings.get("algolia.profiling.sample_rate", 0))
+    if not server_timing and sample_rate <= 0:
+        return
+
+    config.add_subscriber(on_context_found, ContextFound)
+    config.add_tween("kinto_algolia.profiling.tween_factory")
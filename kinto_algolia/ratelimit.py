@@ -0,0 +1,170 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from kinto.core.events import ACTIONS
+from pyramid.exceptions import ConfigurationError
+
+from . import listener
+from .utils import PeriodicThread
+
+
+RATE_LIMIT_SETTING_RE = re.compile(r"^algolia\.([^.]+)\.(?:([^.]+)\.)?rate_limit$")
+
+#: Interval (in seconds) between two attempts to index the deferred operations.
+DRAIN_INTERVAL = 1.0
+
+
+class TokenBucket(object):
+    """Allow ``rate`` operations per second, with bursts of one second."""
+
+    def __init__(self, rate, clock=time.time):
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        elapsed = now - self.updated
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def consume(self, count):
+        """Take up to ``count`` tokens, and return how many were granted."""
+        self.refill()
+        granted = min(count, int(self.tokens))
+        self.tokens -= granted
+        return granted
+
+    @property
+    def usage(self):
+        return 1 - self.tokens / self.capacity
+
+
+class RateLimiter(object):
+    """Limit the indexing operations sent to Algolia per bucket or collection.
+
+    Operations beyond the budget are buffered, and coalesced by record: only
+    the last change of a record is sent once tokens are available again.
+
+    The changes of a scope are taken and sent one batch at a time, from the
+    requests or from the drain thread, so that they are sent in order.
+    """
+
+    def __init__(self, indexer, rates, default_rate=None, clock=time.time, lanes=None):
+        self.indexer = indexer
+        # Optionally send the allowed operations on the lanes, in order with
+        # the other changes of their scope.
+        self.lanes = lanes
+        self.rates = rates
+        self.default_rate = default_rate
+        self.clock = clock
+        self.buckets = {}
+        self.deferred = {}
+        self.thread = PeriodicThread(
+            "kinto-algolia-ratelimit", DRAIN_INTERVAL, self.drain
+        )
+        self._lock = threading.Lock()
+        self._scope_locks = {}
+
+    def scope(self, bucket_id, collection_id):
+        if (bucket_id, collection_id) in self.rates:
+            return (bucket_id, collection_id)
+        if (bucket_id, None) in self.rates:
+            # Shared by all the collections of the bucket.
+            return (bucket_id, None)
+        if self.default_rate is not None:
+            return (bucket_id, collection_id)
+        return None
+
+    def submit(self, bucket_id, collection_id, changes):
+        """Send the changes that can be indexed now, defer the others.
+
+        :param changes: list of ``(action, record, old)`` tuples.
+        """
+        scope = self.scope(bucket_id, collection_id)
+        if scope is None:
+            changes = [(collection_id,) + change for change in changes]
+            self._send(bucket_id, (bucket_id, collection_id), changes)
+            return
+
+        with self._sending(scope):
+            with self._lock:
+                deferred = self.deferred.setdefault(scope, OrderedDict())
+                for action, record, old in changes:
+                    key = (collection_id, record["id"])
+                    # The latest change of a record supersedes the deferred one.
+                    previous = deferred.pop(key, None)
+                    if previous is not None and action == ACTIONS.UPDATE.value:
+                        # The update applies to the version that was last sent.
+                        previous_action, _, previous_old = previous
+                        if previous_action != ACTIONS.DELETE.value:
+                            action, old = previous_action, previous_old
+                    deferred[key] = (action, record, old)
+                allowed = self._take(scope)
+            self._send(bucket_id, scope, allowed)
+
+        if self.deferred.get(scope):
+            self.start()
+
+    def drain(self):
+        """Index the deferred operations, within the available budgets."""
+        with self._lock:
+            scopes = list(self.deferred)
+        for scope in scopes:
+            with self._sending(scope):
+                with self._lock:
+                    allowed = self._take(scope) if scope in self.deferred else []
+                self._send(scope[0], scope, allowed)
+
+    def _sending(self, scope):
+        with self._lock:
+            return self._scope_locks.setdefault(scope, threading.Lock())
+
+    def _send(self, bucket_id, scope, changes):
+        # Changes of a bucket budget can be sent with other collections.
+        listener.send_changes(self.indexer, self.lanes, bucket_id, scope, changes)
+
+    def _take(self, scope):
+        deferred = self.deferred[scope]
+        bucket = self.buckets.get(scope)
+        if bucket is None:
+            rate = self.rates.get(scope, self.default_rate)
+            bucket = self.buckets[scope] = TokenBucket(rate, clock=self.clock)
+        granted = bucket.consume(len(deferred))
+        allowed = []
+        for _ in range(granted):
+            (collection_id, _), change = deferred.popitem(last=False)
+            allowed.append((collection_id,) + change)
+        if not deferred:
+            del self.deferred[scope]
+
+        name = "/".join(s for s in scope if s is not None)
+        self.indexer.metrics.budget(name, bucket.usage, len(deferred))
+        return allowed
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.thread.stop()
+
+
+def load_from_config(config, indexer, lanes=None):
+    settings = config.get_settings()
+    rates = {}
+    for key, value in settings.items():
+        match = RATE_LIMIT_SETTING_RE.match(key)
+        if match:
+            rates[match.groups()] = float(value)
+    default_rate = settings.get("algolia.rate_limit")
+    if default_rate is not None:
+        default_rate = float(default_rate)
+    if not rates and default_rate is None:
+        return None
+    if min(list(rates.values()) + [default_rate or 1]) <= 0:
+        raise ConfigurationError("kinto.algolia rate limits must be positive.")
+    return RateLimiter(indexer, rates, default_rate=default_rate, lanes=lanes)
@@ -0,0 +1,58 @@
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class Call(object):
+    """A call in flight, whose outcome is shared with the identical calls."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Let concurrent identical calls share a single execution.
+
+    The first caller for a key runs the function, the next ones wait for its
+    outcome. If it takes longer than ``timeout`` seconds, waiting callers stop
+    waiting and run the function themselves.
+    """
+
+    def __init__(self, operation, timeout, metrics=None):
+        self.operation = operation
+        self.timeout = timeout
+        self.metrics = metrics
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            if call.done.wait(self.timeout):
+                if self.metrics is not None:
+                    self.metrics.coalesced(self.operation)
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            logger.warning("Timeout while waiting for in-flight call %r", key)
+            return func(*args, **kwargs)
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self.calls[key]
+            call.done.set()
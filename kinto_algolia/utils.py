@@ -1,10 +1,22 @@
+import json
+import os
+import threading
+
 from pyramid.settings import aslist
 
 from kinto.core import utils as core_utils
+from kinto.core.storage import Filter, Sort
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
 
-def is_monitoring_collection(registry, bucket_id, collection_id=None):
-    resources_uri = aslist(registry.settings.get("algolia.resources", ""))
+def is_monitoring_collection(
+    registry, bucket_id, collection_id=None, setting="algolia.resources"
+):
+    resources_uri = aslist(registry.settings.get(setting, ""))
 
     for resource_uri in resources_uri:
         resource_name, matchdict = core_utils.view_lookup_registry(
@@ -22,3 +34,123 @@ def is_monitoring_collection(registry, bucket_id, collection_id=None):
         )
         if is_matching_collection:
             return True
+
+
+def is_valid_sort_orders(sort_orders):
+    """Return true if ``sort_orders`` maps sort names to a ranking criterion,
+    or to a list of criteria."""
+    if not isinstance(sort_orders, dict):
+        return False
+    for ranking in sort_orders.values():
+        criteria = ranking if isinstance(ranking, list) else [ranking]
+        if not criteria or not all(isinstance(c, str) for c in criteria):
+            return False
+    return True
+
+
+def settings_diff(old, new, removals=True):
+    """Return the index settings that differ between ``old`` and ``new``.
+
+    Unless ``removals`` is false, settings that were removed are reset to
+    their default value with ``None``.
+    """
+    diff = {
+        key: value
+        for key, value in new.items()
+        if key not in old or old[key] != value
+    }
+    if removals:
+        diff.update({key: None for key in old if key not in new})
+    return diff
+
+
+def json_loads(data):
+    """Parse JSON bytes, using ``orjson`` if installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode("utf-8"))
+
+
+def json_dumps(value):
+    """Serialize the value to JSON bytes, using ``orjson`` if installed."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode("utf-8")
+
+
+def json_response(request, value):
+    """Serialize the view result with ``orjson`` if installed, instead of the
+    Pyramid renderer."""
+    if orjson is None:
+        return value
+    response = request.response
+    response.content_type = "application/json"
+    response.body = orjson.dumps(value)
+    return response
+
+
+def get_paginated(
+    storage, resource_name, parent_id, sort=None, limit=5000, filters=None
+):
+    """Yield the pages of the objects of a resource, sorted by ``sort``.
+
+    We can reach the storage_fetch_limit, so we use pagination on the sort field.
+    """
+    if sort is None:
+        sort = Sort("last_modified", -1)
+    comparison = core_utils.COMPARISON
+    operator = comparison.GT if sort.direction > 0 else comparison.LT
+    pagination_rules = []
+    while "not gone through all pages":
+        objects = storage.list_all(
+            resource_name=resource_name,
+            parent_id=parent_id,
+            filters=filters,
+            pagination_rules=pagination_rules,
+            sorting=[sort],
+            limit=limit,
+        )
+        yield objects
+
+        if len(objects) < limit:
+            break  # Done.
+
+        pagination_rules = [[Filter(sort.field, objects[-1][sort.field], operator)]]
+
+
+def get_paginated_records(storage, bucket_id, collection_id, limit=5000, filters=None):
+    parent_id = "/buckets/%s/collections/%s" % (bucket_id, collection_id)
+    return get_paginated(storage, "record", parent_id, limit=limit, filters=filters)
+
+
+class PeriodicThread(object):
+    """Call ``func`` every ``interval`` seconds from a daemon thread.
+
+    Threads do not survive a fork, the thread is started once per process.
+    """
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self, on_start=None):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            if on_start is not None:
+                on_start()
+            thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.func()
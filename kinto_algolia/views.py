@@ -1,21 +1,29 @@
+import itertools
 import json
 import logging
+import time
 
 from algoliasearch.exceptions import AlgoliaException
 from kinto.core import authorization
 from kinto.core import Service
-from kinto.core import utils
-from kinto.core.errors import raise_invalid
+from kinto.core.errors import http_error, raise_invalid, ERRORS
+from kinto.core.storage.exceptions import RecordNotFoundError
+from pyramid import httpexceptions
+from pyramid.security import NO_PERMISSION_REQUIRED
+
+from . import profiling
+from .utils import is_valid_sort_orders, json_dumps, json_loads, json_response
 
 
 logger = logging.getLogger(__name__)
 
 
 class RouteFactory(authorization.RouteFactory):
-    def __init__(self, request):
+    def __init__(self, request, collection_id=None):
         super().__init__(request)
-        records_plural = utils.strip_uri_prefix(
-            request.path.replace("/search", "/records")
+        records_plural = "/buckets/{}/collections/{}/records".format(
+            request.matchdict["bucket_id"],
+            collection_id or request.matchdict["collection_id"],
         )
         self.permission_object_id = records_plural
         self.required_permission = "read"
@@ -28,53 +36,158 @@ search = Service(
     factory=RouteFactory,
 )
 
+search_export = Service(
+    name="search_export",
+    path="/buckets/{bucket_id}/collections/{collection_id}/search/export",
+    description="Export all the search results",
+    factory=RouteFactory,
+)
+
+bucket_search = Service(
+    name="bucket_search",
+    path="/buckets/{bucket_id}/search",
+    description="Search several collections at once",
+)
+
+search_key = Service(
+    name="search_key",
+    path="/buckets/{bucket_id}/collections/{collection_id}/search/key",
+    description="Secured API key to search the collection index from clients",
+    factory=RouteFactory,
+)
+
+
+def limit_hits_per_page(request, params):
+    # Limit the number of results to return, based on existing Kinto settings.
+    settings = request.registry.settings
+    paginate_by = settings.get("paginate_by")
+    max_fetch_size = int(settings["storage_max_fetch_size"])
+    if paginate_by is None or int(paginate_by) <= 0:
+        paginate_by = max_fetch_size
+    configured = min(int(paginate_by), max_fetch_size)
+
+    # If the size is specified in query, ignore it if larger than setting.
+    specified = params.get("hitsPerPage")
+    if specified is not None:
+        try:
+            specified = int(specified)
+        except (TypeError, ValueError):
+            error_details = {
+                "name": "hitsPerPage",
+                "description": "hitsPerPage should be an integer.",
+            }
+            raise_invalid(request, **error_details)
+
+    if specified is None or specified > configured:
+        specified = configured
+    params["hitsPerPage"] = specified
+
+
+def get_sort_orders(request, bucket_id, collection_id):
+    try:
+        metadata = request.registry.storage.get(
+            resource_name="collection",
+            parent_id="/buckets/{}".format(bucket_id),
+            object_id=collection_id,
+        )
+    except RecordNotFoundError:
+        return {}
+    sort_orders = metadata.get("algolia:sort_orders") or {}
+    if not is_valid_sort_orders(sort_orders):
+        # Stored before the metadata was validated.
+        return {}
+    return sort_orders
+
 
-def search_view(request, **kwargs):
+def search_view(request, sort=None, **kwargs):
     bucket_id = request.matchdict["bucket_id"]
     collection_id = request.matchdict["collection_id"]
 
-    # algoliasearch doesn't support pagination
-    # https://github.com/algolia/algoliasearch-client-python/issues/365
-    #
-    # Limit the number of results to return, based on existing Kinto settings.
-    # paginate_by = request.registry.settings.get("paginate_by")
-    # max_fetch_size = request.registry.settings["storage_max_fetch_size"]
-    # if paginate_by is None or paginate_by <= 0:
-    #     paginate_by = max_fetch_size
-    # configured = min(paginate_by, max_fetch_size)
-    # # If the size is specified in query, ignore it if larger than setting.
-    # specified = None
-    # if "size" in kwargs:
-    #     specified = kwargs.get("hitsPerPage")
-    #
-    # if specified is None or specified > configured:
-    #     kwargs.setdefault("hitsPerPage", configured)
+    # Sort orders are served by replica indices, declared in collection metadata.
+    sort_orders = None
+    if sort is not None:
+        if not isinstance(sort, str):
+            error_details = {"name": "sort", "description": "Must be a string."}
+            raise_invalid(request, **error_details)
+        sort_orders = get_sort_orders(request, bucket_id, collection_id)
+        if sort not in sort_orders:
+            error_details = {
+                "name": "sort",
+                "description": "Unknown sort order. Available: {}".format(
+                    ", ".join(sorted(sort_orders))
+                ),
+            }
+            raise_invalid(request, **error_details)
+
+    limit_hits_per_page(request, kwargs)
+    profiling.mark(request, "params")
 
     # Access indexer from views using registry.
     indexer = request.registry.indexer
+
+    # When Algolia is known to be down, answer from memory if possible.
+    probe = getattr(request.registry, "algolia_health", None)
+    if probe is not None and probe.is_alive() is False:
+        results = fallback_search(request, bucket_id, collection_id, kwargs, sort)
+        if results is not None:
+            return results
+
     try:
         indexer.set_extra_headers(
             {"Referer": request.headers.get("Referer", request.route_url("hello"))}
         )
-        results = indexer.search(bucket_id, collection_id, **kwargs)
+        profiling.mark(request, "referer")
+        ranking = sort_orders[sort] if sort is not None else None
+        results = indexer.search(
+            bucket_id, collection_id, kwargs, sort=sort, ranking=ranking
+        )
+        profiling.mark(request, "algolia")
     except AlgoliaException as e:
+        profiling.mark(request, "algolia")
         logger.exception("Index query failed.")
         message = str(e)
         if "does not exist" in message:
             # If plugin was enabled after the creation of the collection.
-            indexer.create_index(bucket_id, collection_id, wait_for_creation=True)
-            return search_view(request, **kwargs)
+            if sort_orders is None:
+                sort_orders = get_sort_orders(request, bucket_id, collection_id) or None
+            indexer.create_index(
+                bucket_id,
+                collection_id,
+                sort_orders=sort_orders,
+                wait_for_creation=True,
+            )
+            indexer.metrics.retry("search")
+            return search_view(request, sort=sort, **kwargs)
         else:
+            results = fallback_search(request, bucket_id, collection_id, kwargs, sort)
+            if results is not None:
+                return results
             error_details = {"name": "Algolia error", "description": message}
             return raise_invalid(request, **error_details)
 
     return results
 
 
-@search.post(permission=authorization.DYNAMIC)
-def post_search(request):
+def fallback_search(request, bucket_id, collection_id, params, sort):
+    fallback = getattr(request.registry, "algolia_fallback", None)
+    if fallback is None:
+        return None
+    results = fallback.search(
+        request.registry, bucket_id, collection_id, params, sort=sort
+    )
+    profiling.mark(request, "fallback")
+    if results is not None:
+        logger.warning(
+            "Search of '%s/%s' answered by the fallback engine."
+            % (bucket_id, collection_id)
+        )
+        request.registry.indexer.metrics.fallback("search")
+    return results
+
+
+def parse_body(request):
     try:
-        body = json.loads(request.body.decode("utf-8"))
+        body = json_loads(request.body)
     except json.decoder.JSONDecodeError:
         if not request.body:
             body = {}
@@ -84,11 +197,181 @@ def post_search(request):
                 "description": "Please make sure your request body is a valid JSON payload.",
             }
             raise_invalid(request, **error_details)
+    return body
 
-    return search_view(request, **body)
+
+@search.post(permission=authorization.DYNAMIC)
+def post_search(request):
+    profiling.mark(request, "permission")
+    body = parse_body(request)
+    results = search_view(request, **body)
+    return json_response(request, results)
 
 
 @search.get(permission=authorization.DYNAMIC)
 def get_search(request):
+    profiling.mark(request, "permission")
+    kwargs = dict(**request.GET)
+    results = search_view(request, **kwargs)
+    return json_response(request, results)
+
+
+def export_view(request, **kwargs):
+    bucket_id = request.matchdict["bucket_id"]
+    collection_id = request.matchdict["collection_id"]
+
+    indexer = request.registry.indexer
+    try:
+        indexer.set_extra_headers(
+            {"Referer": request.headers.get("Referer", request.route_url("hello"))}
+        )
+        hits = indexer.browse(bucket_id, collection_id, **kwargs)
+        # Fetch the first page now, in order to report errors before streaming.
+        first = list(itertools.islice(hits, 1))
+    except AlgoliaException as e:
+        logger.exception("Index browse failed.")
+        error_details = {"name": "Algolia error", "description": str(e)}
+        return raise_invalid(request, **error_details)
+
+    def ndjson_lines():
+        for hit in itertools.chain(first, hits):
+            yield json_dumps(hit) + b"\n"
+
+    response = request.response
+    response.content_type = "application/x-ndjson"
+    response.app_iter = ndjson_lines()
+    return response
+
+
+@search_export.post(permission=authorization.DYNAMIC)
+def post_search_export(request):
+    body = parse_body(request)
+    return export_view(request, **body)
+
+
+@search_export.get(permission=authorization.DYNAMIC)
+def get_search_export(request):
     kwargs = dict(**request.GET)
-    return search_view(request, **kwargs)
+    return export_view(request, **kwargs)
+
+
+def bucket_search_view(request, collections, **kwargs):
+    bucket_id = request.matchdict["bucket_id"]
+
+    if (
+        not isinstance(collections, list)
+        or not collections
+        or not all(isinstance(c, str) for c in collections)
+    ):
+        error_details = {
+            "name": "collections",
+            "description": "Please provide a list of collections to search.",
+        }
+        raise_invalid(request, **error_details)
+
+    # Read permission is checked for every collection, like on ``/search``.
+    for collection_id in collections:
+        context = RouteFactory(request, collection_id=collection_id)
+        if not request.has_permission(authorization.DYNAMIC, context):
+            raise httpexceptions.HTTPForbidden()
+
+    limit_hits_per_page(request, kwargs)
+
+    indexer = request.registry.indexer
+    queries = [(collection_id, kwargs) for collection_id in collections]
+    try:
+        indexer.set_extra_headers(
+            {"Referer": request.headers.get("Referer", request.route_url("hello"))}
+        )
+        results = indexer.multiple_search(bucket_id, queries)
+    except AlgoliaException as e:
+        logger.exception("Index query failed.")
+        message = str(e)
+        if "does not exist" in message:
+            # If plugin was enabled after the creation of some collections.
+            for collection_id in collections:
+                indexer.create_index(bucket_id, collection_id, wait_for_creation=True)
+            indexer.metrics.retry("multiple_queries")
+            return bucket_search_view(request, collections, **kwargs)
+        else:
+            error_details = {"name": "Algolia error", "description": message}
+            return raise_invalid(request, **error_details)
+
+    return {"results": dict(zip(collections, results))}
+
+
+@bucket_search.post(permission=NO_PERMISSION_REQUIRED)
+def post_bucket_search(request):
+    body = parse_body(request)
+    collections = body.pop("collections", None)
+    results = bucket_search_view(request, collections, **body)
+    return json_response(request, results)
+
+
+@bucket_search.get(permission=NO_PERMISSION_REQUIRED)
+def get_bucket_search(request):
+    kwargs = dict(**request.GET)
+    collections = kwargs.pop("collections", "")
+    collections = [c.strip() for c in collections.split(",") if c.strip()]
+    results = bucket_search_view(request, collections, **kwargs)
+    return json_response(request, results)
+
+
+@search_key.get(permission=authorization.DYNAMIC)
+def get_search_key(request):
+    bucket_id = request.matchdict["bucket_id"]
+    collection_id = request.matchdict["collection_id"]
+
+    indexer = request.registry.indexer
+    if indexer.search_api_key is None:
+        message = "kinto.algolia.search_api_key setting is not configured."
+        raise http_error(
+            httpexceptions.HTTPServiceUnavailable(),
+            errno=ERRORS.BACKEND,
+            message=message,
+        )
+
+    if indexer.nb_shards(bucket_id, collection_id) > 1:
+        message = "Secured keys are not available for sharded collections."
+        raise http_error(
+            httpexceptions.HTTPBadRequest(),
+            errno=ERRORS.INVALID_PARAMETERS,
+            message=message,
+        )
+
+    settings = request.registry.settings
+    ttl = int(settings.get("algolia.secured_key_ttl_seconds", 3600))
+    filters = settings.get("algolia.secured_key_filters")
+    user_id = request.prefixed_userid or "system.Everyone"
+
+    # Keys are reused while they have at least half of their validity left.
+    cache_key = "algolia:secured-key:{}:{}".format(
+        indexer.indexname(bucket_id, collection_id), user_id
+    )
+    cached = request.registry.cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    valid_until = int(time.time()) + ttl
+    if filters:
+        filters = filters.format(user_id=user_id)
+    sort_orders = get_sort_orders(request, bucket_id, collection_id)
+    api_key = indexer.secured_api_key(
+        bucket_id,
+        collection_id,
+        valid_until=valid_until,
+        filters=filters,
+        sort_orders=sort_orders,
+    )
+    result = {
+        "application_id": indexer.application_id,
+        "index_name": indexer.indexname(bucket_id, collection_id),
+        "replicas": {
+            name: indexer.replicaname(bucket_id, collection_id, name)
+            for name in sort_orders
+        },
+        "api_key": api_key,
+        "valid_until": valid_until,
+    }
+    request.registry.cache.set(cache_key, result, ttl // 2)
+    return result
@@ -12,13 +12,20 @@ REQUIREMENTS = [
     'kinto'
 ]
 
+EXTRA_REQUIREMENTS = {
+    'prometheus': ['prometheus_client'],
+    'orjson': ['orjson'],
+}
+
 TEST_REQUIREMENTS = [
     'webtest',
 ]
 
 ENTRY_POINTS = {
     'console_scripts': [
-        'kinto-algolia-reindex = kinto_algolia.command_reindex:main'
+        'kinto-algolia-reindex = kinto_algolia.command_reindex:main',
+        'kinto-algolia-settings = kinto_algolia.command_settings:main',
+        'kinto-algolia-reconcile = kinto_algolia.command_reconcile:main',
     ],
 }
 
@@ -36,6 +43,7 @@ setup(
     package_dir={'kinto_algolia': 'kinto_algolia'},
     include_package_data=True,
     install_requires=REQUIREMENTS,
+    extras_require=EXTRA_REQUIREMENTS,
     license="Apache License (2.0)",
     zip_safe=False,
     keywords='kinto algolia index',
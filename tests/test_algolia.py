@@ -59,3 +59,101 @@ class RecordIndexing(BaseWebTest, unittest.TestCase):
                                headers=self.headers)
             timers = set(c[0][0] for c in mocked.call_args_list)
             assert 'plugins.algolia.index' in timers
+
+
+class PartialUpdates(BaseWebTest, unittest.TestCase):
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        self.body = {"title": "Hello", "tags": ["a", "b"], "content": "x" * 1000}
+        self.app.put_json("/buckets/bid/collections/cid/records/rid",
+                          {"data": self.body}, headers=self.headers)
+        self.indexer.join()
+
+    def batch_requests(self, method, body):
+        index = mock.MagicMock()
+        with mock.patch.object(self.indexer, "client") as client:
+            client.init_index.return_value = index
+            getattr(self.app, method)("/buckets/bid/collections/cid/records/rid",
+                                      body, headers=self.headers)
+        return index.batch.call_args[0][0]
+
+    def search_hit(self):
+        self.indexer.join()
+        resp = self.app.get("/buckets/bid/collections/cid/search", headers=self.headers)
+        return resp.json["hits"][0]
+
+    def test_only_changed_attributes_are_sent(self):
+        requests = self.batch_requests("patch_json", {"data": {"title": "Bonjour"}})
+        assert len(requests) == 1
+        assert requests[0]["action"] == "partialUpdateObjectNoCreate"
+        body = requests[0]["body"]
+        assert body["objectID"] == "rid"
+        assert body["title"] == "Bonjour"
+        assert "content" not in body
+        assert "tags" not in body
+        assert "last_modified" in body
+
+    def test_whole_object_is_sent_if_attributes_are_removed(self):
+        data = dict(self.body)
+        del data["tags"]
+        requests = self.batch_requests("put_json", {"data": data})
+        assert requests[0]["action"] == "addObject"
+        assert "tags" not in requests[0]["body"]
+        assert requests[0]["body"]["content"] == self.body["content"]
+
+    def test_whole_object_is_sent_if_not_larger(self):
+        data = {"title": "Hi", "tags": [], "content": "y" * 1000}
+        requests = self.batch_requests("put_json", {"data": data})
+        assert requests[0]["action"] == "addObject"
+        assert requests[0]["body"]["content"] == "y" * 1000
+
+    def test_partial_updates_are_applied_to_index(self):
+        self.app.patch_json("/buckets/bid/collections/cid/records/rid",
+                            {"data": {"title": "Bonjour"}}, headers=self.headers)
+        hit = self.search_hit()
+        assert hit["title"] == "Bonjour"
+        assert hit["content"] == self.body["content"]
+
+    def test_partial_updates_can_be_disabled(self):
+        with mock.patch.object(self.indexer, "partial_updates", False):
+            requests = self.batch_requests("patch_json", {"data": {"title": "Bonjour"}})
+        assert requests[0]["action"] == "addObject"
+
+
+class SettingsDiff(BaseWebTest, unittest.TestCase):
+
+    settings = {"searchableAttributes": ["title"], "customRanking": ["desc(votes)"]}
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put_json("/buckets/bid/collections/cid",
+                          {"data": {"algolia:settings": self.settings}},
+                          headers=self.headers)
+        self.indexer.join()
+
+    def update_collection(self, data):
+        with mock.patch.object(self.indexer, "update_index") as update_index:
+            self.app.put_json("/buckets/bid/collections/cid", {"data": data},
+                              headers=self.headers)
+        return update_index
+
+    def test_only_changed_settings_are_sent(self):
+        settings = dict(self.settings, customRanking=["asc(price)"])
+        update_index = self.update_collection({"algolia:settings": settings})
+        update_index.assert_called_with("bid", "cid",
+                                        settings={"customRanking": ["asc(price)"]},
+                                        sort_orders=None)
+
+    def test_removed_settings_are_reset(self):
+        settings = {"searchableAttributes": ["title"]}
+        update_index = self.update_collection({"algolia:settings": settings})
+        update_index.assert_called_with("bid", "cid",
+                                        settings={"customRanking": None},
+                                        sort_orders=None)
+
+    def test_unchanged_settings_are_not_sent(self):
+        update_index = self.update_collection({"algolia:settings": self.settings,
+                                               "title": "Renamed"})
+        assert not update_index.called
@@ -1,9 +1,23 @@
+import gzip
+import json
 import os
+import shutil
+import tempfile
 import unittest
+from collections import Counter
+from multiprocessing.pool import ThreadPool
 from unittest import mock
 
 from algoliasearch.exceptions import AlgoliaException
-from kinto_algolia.command_reindex import main, reindex_records, get_paginated_records
+from kinto.core.storage import Filter
+from kinto.core.utils import COMPARISON
+from kinto_algolia.command_reindex import (main, reindex_records, get_paginated_records,
+                                           get_partitions, index_pages, read_snapshot_pages,
+                                           reindex_partition, upload_pages, wait_page,
+                                           estimate_pages, percentile)
+from kinto_algolia.indexer import record_to_object
+from kinto_algolia.lanes import Lanes
+from kinto_algolia.utils import json_dumps
 
 from . import BaseWebTest
 
@@ -57,7 +71,8 @@ class TestMain(BaseWebTest, unittest.TestCase):
                                 mock.sentinel.collection_id)
                 get_paginated_records.assert_called_with(mock.sentinel.storage,
                                                          mock.sentinel.bucket_id,
-                                                         mock.sentinel.collection_id)
+                                                         mock.sentinel.collection_id,
+                                                         limit=5000)
                 logger.exception.assert_called_with('Failed to index record')
 
     def test_cli_default_to_sys_argv(self):
@@ -78,3 +93,274 @@ class TestMain(BaseWebTest, unittest.TestCase):
         for records in get_paginated_records(self.app.app.registry.storage, 'bid', 'cid', limit=3):
             count += 1
         assert count == 2
+
+
+class Snapshots(BaseWebTest, unittest.TestCase):
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        body = {"data": {"algolia:settings": {"searchableAttributes": ["title"]}}}
+        self.app.put_json("/buckets/bid/collections/cid", body, headers=self.headers)
+        for i in range(5):
+            self.app.put_json("/buckets/bid/collections/cid/records/r%d" % i,
+                              {"data": {"title": "Record %d" % i}},
+                              headers=self.headers)
+        self.indexer.join()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "cid.ndjson.gz")
+
+        env = {"registry": self.app.app.registry}
+        for target, kwargs in [("bootstrap", {"return_value": env}),
+                               ("time.sleep", {}),
+                               ("print", {})]:
+            patch = mock.patch("kinto_algolia.command_reindex." + target,
+                               create=True, **kwargs)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_cli(self, *args):
+        return main(["--ini", self.ini_path()] + list(args))
+
+    def search_ids(self, collection_id="cid"):
+        self.indexer.join()
+        resp = self.indexer.search("bid", collection_id, {"hitsPerPage": 100})
+        return sorted(h["objectID"] for h in resp["hits"])
+
+    def test_export_writes_header_and_records(self):
+        assert self.run_cli("-b", "bid", "-c", "cid", "--export", self.path) == 0
+        with gzip.open(self.path, "rt") as f:
+            lines = [json.loads(line) for line in f]
+        header = lines[0]
+        assert header["bucket_id"] == "bid"
+        assert header["collection_id"] == "cid"
+        assert header["metadata"]["algolia:settings"] == {"searchableAttributes": ["title"]}
+        assert sorted(r["id"] for r in lines[1:]) == ["r0", "r1", "r2", "r3", "r4"]
+
+    def test_load_reindexes_from_snapshot_without_storage(self):
+        self.run_cli("-b", "bid", "-c", "cid", "--export", self.path)
+        self.indexer.delete_index("bid", "cid")
+
+        storage = self.app.app.registry.storage
+        with mock.patch.object(storage, "get_all") as get_all:
+            with mock.patch.object(storage, "get") as get:
+                assert self.run_cli("--load", self.path, "--workers", "2") == 0
+        assert not get_all.called
+        assert not get.called
+        assert self.search_ids() == ["r0", "r1", "r2", "r3", "r4"]
+        index = self.indexer.client.init_index("kinto-bid-cid")
+        assert index.get_settings()["searchableAttributes"] == ["title"]
+
+    def test_load_can_target_another_collection(self):
+        self.run_cli("-b", "bid", "-c", "cid", "--export", self.path)
+        assert self.run_cli("-c", "copy", "--load", self.path) == 0
+        assert len(self.search_ids("copy")) == 5
+
+    def test_load_fails_if_snapshot_is_invalid(self):
+        with mock.patch("kinto_algolia.command_reindex.logger") as logger:
+            assert self.run_cli("--load", self.path) == 64
+            with open(self.path, "wb") as f:
+                f.write(gzip.compress(b"[]\n"))
+            assert self.run_cli("--load", self.path) == 64
+        logger.error.assert_called_with("Cannot read snapshot '%s'" % self.path)
+
+    def test_snapshot_pages_are_bounded(self):
+        with gzip.open(self.path, "wb") as f:
+            f.write(b'{}\n' + b''.join(b'{"id": "%d"}\n\n' % i for i in range(5)))
+        with gzip.open(self.path, "rb") as f:
+            f.readline()
+            pages = list(read_snapshot_pages(f, limit=2))
+        assert [len(p) for p in pages] == [2, 2, 1]
+
+    def test_uploads_in_flight_are_bounded(self):
+        lanes = Lanes({"reindex": 1}, self.indexer.metrics)
+        pages = [[{"id": "r%d" % i}] for i in range(5)]
+        with mock.patch.object(lanes, "submit", wraps=lanes.submit) as submit:
+            with mock.patch("kinto_algolia.command_reindex.wait_page",
+                            wraps=wait_page) as wait:
+                total = index_pages(self.indexer, "bid", "cid", iter(pages), lanes=lanes)
+        assert total == 5
+        assert submit.call_count == 5
+        assert wait.call_count == 5
+
+    def test_reindex_reads_storage_by_default(self):
+        self.indexer.delete_index("bid", "cid")
+        assert self.run_cli("-b", "bid", "-c", "cid", "--workers", "2") == 0
+        assert len(self.search_ids()) == 5
+
+
+class Partitions(BaseWebTest, unittest.TestCase):
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        for i in range(5):
+            self.app.put_json("/buckets/bid/collections/cid/records/r%d" % i,
+                              {"data": {"title": "Record %d" % i}},
+                              headers=self.headers)
+        self.indexer.join()
+        self.storage = self.app.app.registry.storage
+
+        # Partitions are reindexed in threads, with the test application.
+        multiprocessing = mock.MagicMock()
+        multiprocessing.get_context.return_value.Pool = ThreadPool
+
+        env = {"registry": self.app.app.registry}
+        for target, kwargs in [("bootstrap", {"return_value": env}),
+                               ("time.sleep", {}),
+                               ("multiprocessing", {"new": multiprocessing}),
+                               ("print", {})]:
+            patch = mock.patch("kinto_algolia.command_reindex." + target,
+                               create=True, **kwargs)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_cli(self, *args):
+        return main(["--ini", self.ini_path(), "-b", "bid", "-c", "cid"] + list(args))
+
+    def test_partitions_cover_the_collection(self):
+        partitions = get_partitions(self.storage, "bid", "cid", 3)
+        assert len(partitions) == 3
+        assert partitions[0][0] is None
+        assert partitions[-1][1] is None
+        assert [p[1] for p in partitions[:-1]] == [p[0] for p in partitions[1:]]
+        records = []
+        for since, before in partitions:
+            filters = []
+            if since is not None:
+                filters.append(Filter("last_modified", since, COMPARISON.MIN))
+            if before is not None:
+                filters.append(Filter("last_modified", before, COMPARISON.LT))
+            for page in get_paginated_records(self.storage, "bid", "cid", filters=filters):
+                records.extend(r["id"] for r in page)
+        assert sorted(records) == ["r0", "r1", "r2", "r3", "r4"]
+
+    def test_empty_collection_has_one_partition(self):
+        self.app.put("/buckets/bid/collections/empty", headers=self.headers)
+        assert get_partitions(self.storage, "bid", "empty", 4) == [(None, None)]
+
+    def test_collection_is_reindexed_by_several_processes(self):
+        self.indexer.delete_index("bid", "cid")
+        with mock.patch("kinto_algolia.command_reindex.reindex_partition",
+                        wraps=reindex_partition) as partition:
+            assert self.run_cli("--processes", "3", "--workers", "2") == 0
+        assert partition.call_count == 3
+        self.indexer.join()
+        resp = self.indexer.search("bid", "cid", {"hitsPerPage": 100})
+        assert resp["nbHits"] == 5
+
+    def test_failures_are_aggregated(self):
+        with mock.patch("kinto_algolia.command_reindex.reindex_partition",
+                        side_effect=[(3, 0), (0, 1), ValueError]):
+            with mock.patch("kinto_algolia.command_reindex.logger") as logger:
+                assert self.run_cli("--processes", "3") == 65
+        assert logger.exception.call_count == 1
+
+    def test_failed_pages_are_counted(self):
+        indexer = mock.MagicMock()
+        indexer.bulk.side_effect = AlgoliaException
+        with mock.patch("kinto_algolia.command_reindex.logger"):
+            assert upload_pages(indexer, "bid", "cid", [[{"id": "a"}]]) == (0, 1)
+
+    def test_processes_cannot_be_used_with_snapshots(self):
+        with mock.patch("sys.stderr"):
+            with self.assertRaises(SystemExit):
+                self.run_cli("--processes", "2", "--load", "snapshot.gz")
+
+
+class DryRun(BaseWebTest, unittest.TestCase):
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        for i in range(5):
+            self.app.put_json("/buckets/bid/collections/cid/records/r%d" % i,
+                              {"data": {"title": "Record %d" % i}},
+                              headers=self.headers)
+        self.app.put_json("/buckets/bid/collections/cid/records/big",
+                          {"data": {"title": "x" * 200}}, headers=self.headers)
+        self.indexer.join()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "cid.ndjson.gz")
+
+        env = {"registry": self.app.app.registry}
+        for target, kwargs in [("bootstrap", {"return_value": env}),
+                               ("time.sleep", {}),
+                               ("print", {})]:
+            patch = mock.patch("kinto_algolia.command_reindex." + target,
+                               create=True, **kwargs)
+            self.print = patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_cli(self, *args):
+        return main(["--ini", self.ini_path(), "--dry-run"] + list(args))
+
+    def printed(self):
+        return [c[0][0] for c in self.print.call_args_list if c[0]]
+
+    def test_nothing_is_sent_to_algolia(self):
+        with mock.patch.object(self.indexer, "bulk") as bulk:
+            with mock.patch("kinto_algolia.command_reindex.prepare_index") as prepare:
+                assert self.run_cli("-b", "bid", "-c", "cid") == 0
+        assert not bulk.called
+        assert not prepare.called
+        assert "\nDry run: nothing was sent to Algolia." in self.printed()
+        assert "6 records (%s bytes)." % self.total_size() in self.printed()
+
+    def total_size(self):
+        storage = self.app.app.registry.storage
+        records = next(get_paginated_records(storage, "bid", "cid"))
+        return sum(len(json_dumps(record_to_object(r))) for r in records)
+
+    def test_sizes_and_batches_are_reported(self):
+        storage = self.app.app.registry.storage
+        pages = get_paginated_records(storage, "bid", "cid", limit=4)
+        stats = estimate_pages(self.indexer, "bid", "cid", pages, max_object_size=100)
+        assert stats["records"] == 6
+        assert stats["bytes"] == self.total_size()
+        assert stats["p99_size"] == stats["max_size"] > 200
+        assert stats["oversized"] == ["big"]
+        assert stats["batches"] == 2
+        assert stats["records_per_second"] > 0
+
+    def test_batches_are_counted_per_shard(self):
+        pages = [[{"id": "r%d" % i} for i in range(20)]]
+        with mock.patch.object(self.indexer, "shards", 3):
+            stats = estimate_pages(self.indexer, "bid", "cid", pages)
+        assert stats["batches"] == 3
+        assert stats["oversized"] == []
+
+    def test_empty_collection(self):
+        stats = estimate_pages(self.indexer, "bid", "cid", [[]])
+        assert stats["records"] == stats["p99_size"] == stats["max_size"] == 0
+
+    def test_percentile_of_counted_sizes(self):
+        sizes = Counter({10: 98, 20: 1, 30: 1})
+        assert percentile(sizes, 99) == 20
+        assert percentile(sizes, 50) == 10
+        assert percentile(sizes, 100) == 30
+        assert percentile(Counter(), 99) == 0
+
+    def test_snapshot_can_be_estimated(self):
+        main(["--ini", self.ini_path(), "-b", "bid", "-c", "cid", "--export", self.path])
+        with mock.patch.object(self.indexer, "bulk") as bulk:
+            assert self.run_cli("--load", self.path, "--batch-size", "2",
+                                "--max-object-size", "100") == 0
+        assert not bulk.called
+        assert "3 batches projected." in self.printed()
+        assert "1 objects larger than 100 bytes: big" in self.printed()
+
+    def test_batch_size_is_used_for_reindexing(self):
+        with mock.patch("kinto_algolia.command_reindex.index_page",
+                        return_value=0) as index_page:
+            assert main(["--ini", self.ini_path(), "-b", "bid", "-c", "cid",
+                         "--batch-size", "4"]) == 0
+        assert index_page.call_count == 2
+
+    def test_dry_run_cannot_be_used_with_export_or_processes(self):
+        with mock.patch("sys.stderr"):
+            for args in (["--export", self.path], ["--processes", "2"],
+                         ["--batch-size", "0"]):
+                with self.assertRaises(SystemExit):
+                    self.run_cli("-b", "bid", "-c", "cid", *args)
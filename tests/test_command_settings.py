@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from algoliasearch.exceptions import AlgoliaException
+
+from kinto_algolia.command_settings import get_bucket_collections, main
+from . import BaseWebTest
+
+
+class SettingsRollout(BaseWebTest, unittest.TestCase):
+
+    template = {"searchableAttributes": ["title"], "hitsPerPage": 50}
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["kinto.algolia.resources"] = ("/buckets/bid "
+                                               "/buckets/other/collections/cid "
+                                               "/buckets/other/collections/unknown")
+        return settings
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/other", headers=self.headers)
+        for bucket_id, collection_id in [("bid", "a"), ("bid", "b"), ("other", "cid")]:
+            self.app.put("/buckets/{}/collections/{}".format(bucket_id, collection_id),
+                         headers=self.headers)
+        body = {"data": {"algolia:settings": {"hitsPerPage": 10}}}
+        self.app.put_json("/buckets/bid/collections/b", body, headers=self.headers)
+        self.indexer.join()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.template_path = os.path.join(self.tmpdir, "template.json")
+        with open(self.template_path, "w") as f:
+            json.dump(self.template, f)
+
+        env = {"registry": self.app.app.registry}
+        for target, kwargs in [("bootstrap", {"return_value": env}), ("print", {})]:
+            patch = mock.patch("kinto_algolia.command_settings." + target,
+                               create=True, **kwargs)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_cli(self, *args):
+        return main(["--ini", self.ini_path(), "--template", self.template_path] +
+                    list(args))
+
+    def get_settings(self, bucket_id, collection_id):
+        return self.indexer.get_settings(bucket_id, collection_id)
+
+    def test_template_is_applied_to_all_monitored_collections(self):
+        assert self.run_cli("--workers", "2") == 0
+        for bucket_id, collection_id in [("bid", "a"), ("other", "cid")]:
+            settings = self.get_settings(bucket_id, collection_id)
+            assert settings["searchableAttributes"] == ["title"]
+            assert settings["hitsPerPage"] == 50
+
+    def test_collection_settings_take_precedence(self):
+        self.run_cli()
+        settings = self.get_settings("bid", "b")
+        assert settings["searchableAttributes"] == ["title"]
+        assert settings["hitsPerPage"] == 10
+
+    def test_only_changed_settings_are_sent_and_tasks_waited(self):
+        self.run_cli()
+        with mock.patch.object(self.indexer, "update_index",
+                               wraps=self.indexer.update_index) as update_index:
+            with mock.patch.object(self.indexer, "join") as join:
+                self.template["typoTolerance"] = False
+                with open(self.template_path, "w") as f:
+                    json.dump(self.template, f)
+                self.run_cli()
+        assert update_index.call_count == 3
+        assert update_index.call_args[1]["settings"] == {"typoTolerance": False}
+        join.assert_called_once_with()
+
+    def test_unchanged_indices_are_skipped(self):
+        self.run_cli()
+        with mock.patch.object(self.indexer, "update_index") as update_index:
+            self.run_cli()
+        assert not update_index.called
+
+    def test_failures_are_logged(self):
+        with mock.patch.object(self.indexer, "update_index",
+                               side_effect=AlgoliaException):
+            with mock.patch("kinto_algolia.command_settings.logger") as logger:
+                assert self.run_cli() == 65
+        assert logger.exception.call_count == 3
+
+    def test_bucket_collections_are_paginated(self):
+        storage = self.app.app.registry.storage
+        collections = get_bucket_collections(storage, "bid", limit=1)
+        assert [c["id"] for c in collections] == ["a", "b"]
+
+    def test_sort_orders_rankings_are_reapplied_to_replicas(self):
+        body = {"data": {"algolia:sort_orders": {"age": "asc(age)"}}}
+        self.app.put_json("/buckets/other/collections/cid", body, headers=self.headers)
+        self.template["ranking"] = ["custom"]
+        with open(self.template_path, "w") as f:
+            json.dump(self.template, f)
+        with mock.patch.object(self.indexer, "update_index",
+                               wraps=self.indexer.update_index) as update_index:
+            assert self.run_cli() == 0
+        sort_orders = {c[0][1]: c[1]["sort_orders"] for c in update_index.call_args_list}
+        assert sort_orders == {"a": None, "b": None, "cid": {"age": "asc(age)"}}
+        replica = self.indexer.client.init_index("kinto-other-cid-sort-age")
+        assert replica.get_settings()["ranking"][0] == "asc(age)"
+
+    def test_unknown_index_settings_are_empty(self):
+        self.indexer.delete_index("bid", "a")
+        assert self.get_settings("bid", "a") == {}
+        with mock.patch.object(self.indexer.client, "init_index") as init_index:
+            init_index.return_value.get_settings.side_effect = AlgoliaException
+            with self.assertRaises(AlgoliaException):
+                self.get_settings("bid", "a")
+
+    def test_invalid_template_is_rejected(self):
+        with mock.patch("kinto_algolia.command_settings.logger") as logger:
+            with open(self.template_path, "w") as f:
+                f.write("[]")
+            assert self.run_cli() == 64
+            os.remove(self.template_path)
+            assert self.run_cli() == 64
+        logger.error.assert_called_with(
+            "Cannot read settings template '%s'" % self.template_path)
+
+    def test_cli_fail_if_algolia_plugin_not_installed(self):
+        with mock.patch("kinto_algolia.command_settings.bootstrap",
+                        return_value={"registry": object()}):
+            assert self.run_cli() == 62
+
+    def test_cli_default_to_sys_argv(self):
+        with mock.patch("sys.argv", ["cli", "--template", self.template_path]):
+            assert main() == 0
@@ -0,0 +1,309 @@
+import unittest
+from unittest import mock
+
+from algoliasearch.exceptions import AlgoliaException
+from pyramid import testing
+
+from kinto_algolia import fallback as algolia_fallback
+from kinto_algolia.fallback import (
+    FallbackSearch,
+    InvertedIndex,
+    UnsupportedSearch,
+    parse_filters,
+    searchable_fields,
+    tokenize,
+)
+from kinto_algolia.metrics import Metrics
+from . import BaseWebTest
+
+
+class InvertedIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add({"id": "a", "title": "Café crème", "tags": ["hot", "milk"]})
+        self.index.add({"id": "b", "title": "Iced coffee", "meta": {"origin": "Kenya"}})
+        self.index.add({"id": "c", "title": "Hot chocolate", "price": 3})
+
+    def ids(self, query, predicate=None):
+        return [hit["objectID"] for hit in self.index.search(query, predicate)]
+
+    def test_tokens_are_case_and_accents_insensitive(self):
+        assert tokenize("Café CRÈME, s'il-vous-plaît") == [
+            "cafe", "creme", "s", "il", "vous", "plait"]
+
+    def test_all_words_must_match(self):
+        assert self.ids("cafe creme") == ["a"]
+        assert self.ids("hot") == ["c", "a"]
+        assert self.ids("hot milk") == ["a"]
+        assert self.ids("hot unknown") == []
+        assert self.ids("chocolate milk") == []
+
+    def test_last_word_matches_as_prefix(self):
+        assert self.ids("co") == ["b"]
+        assert self.ids("c") == ["c", "b", "a"]
+        assert self.ids("ken") == ["b"]
+        assert self.ids("zz") == []
+
+    def test_empty_query_returns_all_records_most_recent_first(self):
+        assert self.ids("") == ["c", "b", "a"]
+
+    def test_updated_and_removed_records_are_reindexed(self):
+        self.index.add({"id": "a", "title": "Tea"})
+        self.index.remove("b")
+        self.index.remove("unknown")
+        assert self.ids("cafe") == []
+        assert self.ids("") == ["a", "c"]
+        assert len(self.index) == 2
+
+    def test_postings_are_compacted(self):
+        with mock.patch("kinto_algolia.fallback.COMPACT_MIN_REMOVED", 1):
+            self.index.remove("a")
+            assert len(self.index.documents) == 3
+            self.index.remove("b")
+        assert self.index.documents == [{"objectID": "c", "title": "Hot chocolate",
+                                         "price": 3}]
+        assert list(self.index.postings["hot"]) == [0]
+        assert self.ids("hot") == ["c"]
+
+    def test_only_searchable_fields_are_indexed(self):
+        index = InvertedIndex(fields=["title", "meta.origin"])
+        index.add({"id": "a", "title": "Iced coffee", "meta": {"origin": "Kenya"},
+                   "body": "hot"})
+        assert sorted(index.postings) == ["coffee", "iced", "kenya"]
+
+    def test_results_can_be_filtered(self):
+        predicate = parse_filters({"filters": "tags:hot"})
+        assert self.ids("", predicate) == ["a"]
+
+
+class FiltersTest(unittest.TestCase):
+
+    hit = {"objectID": "a", "kind": "drink", "tags": ["hot"], "bio": True, "price": 3,
+           "meta": {"origin": "Costa Rica"}}
+
+    def matches(self, **params):
+        return parse_filters(params)(self.hit)
+
+    def test_no_filters(self):
+        assert parse_filters({"filters": " "}) is None
+
+    def test_conjunctions_of_values(self):
+        assert self.matches(filters='kind:drink AND meta.origin:"Costa Rica"')
+        assert self.matches(filters="price:3 AND bio:true", facetFilters=["tags:hot"])
+        assert not self.matches(filters="kind:drink AND bio:false")
+        assert not self.matches(facetFilters=["unknown:value"])
+        assert not self.matches(filters="kind.name:drink")
+
+    def test_other_filters_are_not_supported(self):
+        for params in ({"filters": "price > 2"},
+                       {"filters": "kind:drink OR kind:food"},
+                       {"filters": ["kind:drink"]},
+                       {"facetFilters": [["kind:drink", "kind:food"]]},
+                       {"facetFilters": "kind:drink"}):
+            with self.assertRaises(UnsupportedSearch):
+                parse_filters(params)
+
+    def test_searchable_fields_are_read_from_settings(self):
+        assert searchable_fields(None) is None
+        assert searchable_fields({"attributesToIndex": ["title"]}) == ["title"]
+        settings = {"searchableAttributes": ["title,alt", "unordered(body)"]}
+        assert searchable_fields(settings) == ["title", "alt", "body"]
+
+
+class FallbackSettings(unittest.TestCase):
+
+    def load(self, **settings):
+        config = testing.setUp(settings=settings)
+        return algolia_fallback.load_from_config(config)
+
+    def test_fallback_is_disabled_by_default(self):
+        assert self.load() is None
+
+    def test_max_records_can_be_configured(self):
+        fallback = self.load(**{"algolia.fallback.resources": "/buckets/bid",
+                                "algolia.fallback.max_records": "10"})
+        assert fallback.max_records == 10
+
+    def test_fallback_searches_are_counted(self):
+        statsd = mock.MagicMock()
+        metrics = Metrics(statsd=statsd, prometheus=True)
+        metrics.fallback("search")
+        statsd.incr.assert_called_with("plugins.algolia.fallback.search")
+        value = metrics.prometheus_registry.get_sample_value(
+            "kinto_algolia_fallback_total", {"operation": "search"})
+        assert value == 1
+
+
+class FallbackSearchView(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["kinto.algolia.fallback.resources"] = "/buckets/bid/collections/cid"
+        return settings
+
+    def setUp(self):
+        self.fallback = self.app.app.registry.algolia_fallback
+        self.fallback.clear()
+        self.fallback.max_records = algolia_fallback.DEFAULT_MAX_RECORDS
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put_json("/buckets/bid/collections/cid",
+                          {"data": {"algolia:settings": {
+                              "searchableAttributes": ["title"]}}},
+                          headers=self.headers)
+        for record_id, title, kind in [("a", "Hot coffee", "drink"),
+                                       ("b", "Hot dog", "food"),
+                                       ("c", "Iced coffee", "drink")]:
+            self.app.put_json("/buckets/bid/collections/cid/records/" + record_id,
+                              {"data": {"title": title, "kind": kind}},
+                              headers=self.headers)
+        self.indexer.join()
+        patch = mock.patch.object(self.indexer, "search",
+                                  side_effect=AlgoliaException("Unreachable hosts"))
+        self.search = patch.start()
+        self.addCleanup(patch.stop)
+
+    def search_ids(self, url="/buckets/bid/collections/cid/search", **params):
+        resp = self.app.post_json(url, params, headers=self.headers)
+        assert resp.json["degraded"]
+        return [hit["objectID"] for hit in resp.json["hits"]]
+
+    def test_search_is_answered_from_memory_when_algolia_fails(self):
+        with mock.patch("kinto_algolia.views.logger") as logger:
+            assert self.search_ids(query="coffee") == ["c", "a"]
+        assert self.search.called
+        assert logger.warning.called
+
+    def test_filters_and_pagination_are_supported(self):
+        assert self.search_ids(query="coffee", filters="kind:drink",
+                               hitsPerPage=1, page=1) == ["a"]
+        resp = self.app.get("/buckets/bid/collections/cid/search?query=hot&hitsPerPage=1",
+                            headers=self.headers)
+        assert resp.json["nbHits"] == 2
+        assert resp.json["nbPages"] == 2
+        assert "hitsPerPage=1" in resp.json["params"]
+
+    def test_index_is_updated_from_record_changes(self):
+        self.search_ids()
+        self.app.patch_json("/buckets/bid/collections/cid/records/b",
+                            {"data": {"title": "Hot chocolate"}}, headers=self.headers)
+        self.app.delete("/buckets/bid/collections/cid/records/c", headers=self.headers)
+        self.app.put_json("/buckets/bid/collections/cid/records/d",
+                          {"data": {"title": "Cold chocolate"}}, headers=self.headers)
+        assert self.search_ids(query="choco") == ["d", "b"]
+        assert self.search_ids(query="coffee") == ["a"]
+
+    def test_index_is_reloaded_after_changes_of_other_processes(self):
+        assert self.search_ids(query="dog") == ["b"]
+        # Changes made by other processes do not notify this one.
+        storage = self.app.app.registry.storage
+        parent_id = "/buckets/bid/collections/cid"
+        storage.delete(resource_name="record", parent_id=parent_id, object_id="b")
+        storage.create(resource_name="record", parent_id=parent_id,
+                       obj={"id": "e", "title": "Corn dog"})
+        with mock.patch.object(self.fallback, "_load") as load:
+            assert self.search_ids(query="dog") == ["e"]
+        assert not load.called
+
+    def test_own_changes_are_caught_up_without_reloading(self):
+        self.search_ids()
+        with mock.patch.object(self.fallback, "_load") as load:
+            self.app.patch_json("/buckets/bid/collections/cid/records/b",
+                                {"data": {"title": "Hot chocolate"}},
+                                headers=self.headers)
+            assert self.search_ids(query="choco") == ["b"]
+        assert not load.called
+
+    def test_index_is_reloaded_if_too_many_changes(self):
+        self.search_ids()
+        self.fallback.max_records = 1
+        self.app.put_json("/buckets/bid/collections/cid/records/d",
+                          {"data": {"title": "Hot tea"}}, headers=self.headers)
+        self.app.put_json("/buckets/bid/collections/cid/records/e",
+                          {"data": {"title": "Hot milk"}}, headers=self.headers)
+        with mock.patch.object(self.fallback, "_load", return_value=None) as load:
+            self.app.post_json("/buckets/bid/collections/cid/search", {},
+                               headers=self.headers, status=400)
+        assert load.called
+
+    def test_large_collections_are_loaded_again_after_changes(self):
+        self.fallback.max_records = 2
+        self.app.post_json("/buckets/bid/collections/cid/search", {},
+                           headers=self.headers, status=400)
+        self.app.delete("/buckets/bid/collections/cid/records/c", headers=self.headers)
+        assert self.search_ids(query="hot") == ["b", "a"]
+
+    def test_algolia_is_not_called_when_known_to_be_down(self):
+        probe = mock.MagicMock()
+        probe.is_alive.return_value = False
+        with mock.patch.object(self.app.app.registry, "algolia_health", probe,
+                               create=True):
+            assert self.search_ids(query="dog") == ["b"]
+        assert not self.search.called
+
+    def test_unsupported_searches_return_the_algolia_error(self):
+        for params in ({"filters": "price > 2"}, {"aroundLatLng": "1,2"}, {"page": "x"}):
+            resp = self.app.post_json("/buckets/bid/collections/cid/search", params,
+                                      headers=self.headers, status=400)
+            assert resp.json["details"][0]["name"] == "Algolia error"
+
+    def test_sorted_searches_are_not_supported(self):
+        assert self.fallback.search(self.app.app.registry, "bid", "cid",
+                                    {"hitsPerPage": 10}, sort="price") is None
+
+    def test_unselected_collections_are_not_answered(self):
+        self.app.put("/buckets/bid/collections/other", headers=self.headers)
+        registry = self.app.app.registry
+        assert self.fallback.search(registry, "bid", "other", {"hitsPerPage": 10}) is None
+        assert self.fallback.search(registry, "bid", "cid", {"hitsPerPage": 10}) is not None
+        assert ("bid", "other") not in self.fallback.indexes
+
+    def test_large_collections_are_not_loaded(self):
+        self.fallback.max_records = 2
+        with mock.patch("kinto_algolia.fallback.logger") as logger:
+            resp = self.app.post_json("/buckets/bid/collections/cid/search", {},
+                                      headers=self.headers, status=400)
+        assert resp.json["details"][0]["name"] == "Algolia error"
+        logger.warning.assert_called_with(
+            "Collection 'bid/cid' is too large for the fallback search.")
+
+    def test_deleted_collections_are_dropped(self):
+        self.search_ids()
+        self.app.put_json("/buckets/bid/collections/cid",
+                          {"data": {"algolia:settings": {"searchableAttributes": ["kind"]}}},
+                          headers=self.headers)
+        assert self.fallback.indexes == {}
+        assert self.search_ids(query="food") == ["b"]
+        self.app.delete("/buckets/bid/collections/cid", headers=self.headers)
+        assert self.fallback.indexes == {}
+        registry = self.app.app.registry
+        assert self.fallback.search(registry, "bid", "cid", {"hitsPerPage": 10}) is None
+
+    def test_deleted_buckets_are_dropped(self):
+        self.search_ids()
+        self.app.delete("/buckets/bid", headers=self.headers)
+        assert self.fallback.indexes == {}
+
+    def test_flush_clears_the_indexes(self):
+        self.search_ids()
+        self.app.post("/__flush__", headers=self.headers)
+        assert self.fallback.indexes == {}
+
+
+class FallbackDisabled(unittest.TestCase):
+
+    def test_search_is_not_answered_without_fallback(self):
+        from kinto_algolia.views import fallback_search
+
+        request = mock.MagicMock()
+        request.registry.algolia_fallback = None
+        assert fallback_search(request, "bid", "cid", {}, None) is None
+
+    def test_index_is_not_loaded_twice(self):
+        fallback = FallbackSearch()
+        registry = mock.MagicMock()
+        with mock.patch.object(fallback, "_load") as load:
+            fallback.get_index(registry, "bid", "cid")
+            fallback.get_index(registry, "bid", "cid")
+        load.assert_called_once_with(registry.storage, "bid", "cid")
@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+
+from algoliasearch.exceptions import AlgoliaException
+
+from kinto_algolia.health import HealthProbe
+from . import BaseWebTest
+
+
+class CachedHeartbeat(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["algolia.heartbeat_interval_seconds"] = "3600"
+        return settings
+
+    def tearDown(self):
+        super().tearDown()
+        self.app.app.registry.algolia_health.stop()
+
+    def test_heartbeat_answers_from_cached_status(self):
+        probe = self.app.app.registry.algolia_health
+        resp = self.app.get("/__heartbeat__")
+        assert resp.json["algolia"] is True
+        assert probe.last_success is not None
+        assert probe.latency >= 0
+
+        with mock.patch.object(self.app.app.registry.indexer, "client") as client:
+            client._transporter.read.side_effect = AlgoliaException
+            self.app.get("/__heartbeat__", status=200)
+            assert not client._transporter.read.called
+
+            probe.check()
+            resp = self.app.get("/__heartbeat__", status=503)
+            assert resp.json["algolia"] is False
+
+    def test_heartbeat_fails_if_the_probe_stopped_checking(self):
+        probe = self.app.app.registry.algolia_health
+        probe.check()
+        self.app.get("/__heartbeat__", status=200)
+        with mock.patch.object(probe, "last_check", probe.last_check - 3 * 3600 - 1):
+            resp = self.app.get("/__heartbeat__", status=503)
+        assert resp.json["algolia"] is False
+
+
+class HealthProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = mock.MagicMock()
+        self.probe = HealthProbe(self.indexer, interval=0.01)
+
+    def tearDown(self):
+        self.probe.stop()
+
+    def test_failure_keeps_last_success(self):
+        self.probe.check()
+        last_success = self.probe.last_success
+        self.indexer.isalive.side_effect = AlgoliaException
+        assert self.probe.check() is False
+        assert self.probe.is_alive() is False
+        assert self.probe.last_success == last_success
+        assert self.probe.last_check >= last_success
+
+    def test_stale_status_is_reported_as_failed(self):
+        assert self.probe.is_alive() is None
+        self.probe.check()
+        assert self.probe.is_alive() is True
+        with mock.patch("kinto_algolia.health.time.time",
+                        return_value=self.probe.last_check + 0.05):
+            with mock.patch("kinto_algolia.health.logger") as logger:
+                assert self.probe.is_alive() is False
+        assert logger.warning.called
+
+    def test_status_is_sent_to_metrics(self):
+        self.probe.check()
+        gauge = self.indexer.metrics.gauge
+        gauge.assert_any_call("health.alive", 1)
+        gauge.assert_any_call("health.latency_seconds", self.probe.latency)
+        gauge.assert_any_call("health.last_success", self.probe.last_success)
+        self.indexer.isalive.side_effect = AlgoliaException
+        self.probe.check()
+        gauge.assert_any_call("health.alive", 0)
+
+    def test_probe_is_started_once_per_process(self):
+        with mock.patch("kinto_algolia.utils.threading.Thread") as thread:
+            self.probe.start()
+            self.probe.start()
+        thread.assert_called_once()
+        assert self.indexer.isalive.call_count == 1
+
+    def test_probe_refreshes_status_periodically(self):
+        self.probe.thread._stopped.wait = mock.MagicMock(side_effect=[False, False, True])
+        self.probe.thread._run()
+        assert self.indexer.isalive.call_count == 2
@@ -1,3 +1,6 @@
+import importlib
+import subprocess
+import sys
 import unittest
 from unittest import mock
 
@@ -7,7 +10,9 @@ from pyramid.exceptions import ConfigurationError
 
 import kinto.core
 
+import kinto_algolia
 from kinto_algolia import __version__ as algolia_version, includeme
+from kinto_algolia.indexer import Indexer
 from . import BaseWebTest
 from kinto import main
 
@@ -50,3 +55,28 @@ class PluginSetup(BaseWebTest, unittest.TestCase):
             main({}, None, **settings)
         assert str(e.exception) == ('kinto-algolia needs kinto.algolia.application_id '
                                     'and kinto.algolia.api_key settings to be set.')
+
+
+class StartupTime(unittest.TestCase):
+
+    def test_algolia_client_is_instantiated_on_first_use(self):
+        with mock.patch("kinto_algolia.indexer.SearchClient.create") as create:
+            indexer = Indexer("app-id", "api-key")
+            assert not create.called
+            assert indexer.client is indexer.client
+        create.assert_called_once_with("app-id", "api-key")
+
+    def test_commands_dependencies_are_not_imported(self):
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys, kinto_algolia; "
+            "print(' '.join(m for m in ('pyramid.paster', 'multiprocessing', "
+            "'prometheus_client') if m in sys.modules))"])
+        assert output.strip() == b""
+
+    def test_version_is_not_read_with_pkg_resources(self):
+        # pkg_resources scans all the installed distributions when imported.
+        with mock.patch("pkg_resources.get_distribution") as get_distribution:
+            importlib.reload(kinto_algolia)
+        assert not get_distribution.called
+        assert kinto_algolia.__version__ == algolia_version
@@ -0,0 +1,270 @@
+import unittest
+from unittest import mock
+
+from kinto.core.cache import memory
+from pyramid import testing
+from pyramid.exceptions import ConfigurationError
+
+from kinto_algolia import index_registry as algolia_index_registry
+from kinto_algolia.command_reconcile import get_bucket_ids, main
+from kinto_algolia.index_registry import IndexRegistry
+from . import BaseWebTest
+
+
+def rebuild(registry, indices_by_bucket):
+    registry.rebuild(indices_by_bucket, registry.written(indices_by_bucket))
+
+
+class IndexRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        cache = memory.Cache(cache_prefix="", cache_max_size_bytes=524288)
+        self.registry = IndexRegistry(cache, "kinto", ttl=60)
+
+    def test_unknown_buckets_have_no_indices(self):
+        assert self.registry.indices("bid") is None
+        assert self.registry.buckets() is None
+        assert self.registry.all() is None
+
+    def test_entries_are_trusted_until_the_next_write(self):
+        self.registry.touch("bid")
+        rebuild(self.registry, {"bid": [("app", "kinto-bid-a")]})
+        assert self.registry.indices("bid") == [("app", "kinto-bid-a")]
+        assert self.registry.buckets() == ["bid"]
+        self.registry.touch("bid")
+        assert self.registry.indices("bid") is None
+        assert self.registry.all() is None
+
+    def test_writes_during_the_rebuild_are_not_trusted(self):
+        written = self.registry.written(["bid"])
+        self.registry.touch("bid")
+        self.registry.rebuild({"bid": []}, written)
+        assert self.registry.indices("bid") is None
+        assert self.registry.buckets() is None
+
+    def test_known_indices_do_not_stamp_the_bucket(self):
+        rebuild(self.registry, {"bid": [("app", "kinto-bid-a")]})
+        self.registry.ensure("bid", [("app", "kinto-bid-a")])
+        assert self.registry.indices("bid") == [("app", "kinto-bid-a")]
+        self.registry.ensure("bid", [("app", "kinto-bid-b")])
+        assert self.registry.indices("bid") is None
+        written = self.registry.written(["bid"])
+        self.registry.ensure("bid", [("app", "kinto-bid-b")])
+        assert self.registry.written(["bid"]) != written
+
+    def test_indices_can_be_removed(self):
+        self.registry.remove("bid", [("app", "kinto-bid-a")])
+        rebuild(self.registry, {"bid": [("app", "kinto-bid-a"), ("app", "kinto-bid-b")]})
+        self.registry.remove("bid", [("app", "kinto-bid-a"), ("app", "unknown")])
+        self.registry.remove("bid", [("app", "unknown")])
+        assert self.registry.indices("bid") == [("app", "kinto-bid-b")]
+
+    def test_removals_keep_the_expiration(self):
+        rebuild(self.registry, {"bid": [("app", "kinto-bid-a")]})
+        with mock.patch.object(self.registry.cache, "ttl", return_value=5):
+            with mock.patch.object(self.registry.cache, "set") as cache_set:
+                self.registry.remove("bid", [("app", "kinto-bid-a")])
+        cache_set.assert_called_with(
+            "algolia:indices:kinto:bid", {"written": None, "indices": []}, 5)
+
+    def test_expired_entries_are_not_rewritten_by_removals(self):
+        rebuild(self.registry, {"bid": [("app", "kinto-bid-a")]})
+        with mock.patch.object(self.registry.cache, "ttl", return_value=-1):
+            with mock.patch.object(self.registry.cache, "set") as cache_set:
+                self.registry.remove("bid", [("app", "kinto-bid-a")])
+        assert not cache_set.called
+
+    def test_all_indices_are_known_once_rebuilt(self):
+        rebuild(self.registry, {"gone": [("app", "kinto-gone-x")]})
+        rebuild(self.registry, {"a": [("app", "kinto-a-x")], "b": []})
+        assert self.registry.buckets() == ["a", "b"]
+        assert self.registry.indices("gone") is None
+        assert self.registry.all() == [("app", "kinto-a-x")]
+        self.registry.delete("b")
+        assert self.registry.all() is None
+
+    def test_clear_removes_all_entries(self):
+        self.registry.touch("a")
+        rebuild(self.registry, {"a": [("app", "kinto-a-x")]})
+        self.registry.clear()
+        assert self.registry.indices("a") is None
+        assert self.registry.buckets() is None
+        self.registry.rebuild({"a": []}, {})
+        assert self.registry.indices("a") == []
+
+
+class IndexRegistrySettings(unittest.TestCase):
+
+    def load(self, cache=mock.sentinel.cache, **settings):
+        config = testing.setUp(settings=settings)
+        config.registry.cache = cache
+        return algolia_index_registry.load_from_config(config, "kinto")
+
+    def test_registry_is_disabled_by_default(self):
+        assert self.load() is None
+
+    def test_registry_can_be_enabled(self):
+        registry = self.load(**{"algolia.index_registry": "true"})
+        assert registry.cache is mock.sentinel.cache
+        assert registry.ttl == algolia_index_registry.DEFAULT_TTL
+
+    def test_ttl_can_be_configured(self):
+        registry = self.load(**{"algolia.index_registry": "true",
+                                "algolia.index_registry.ttl_seconds": "60"})
+        assert registry.ttl == 60
+
+    def test_registry_requires_a_shared_cache(self):
+        cache = memory.Cache(cache_prefix="", cache_max_size_bytes=524288)
+        for backend in (None, cache):
+            with self.assertRaises(ConfigurationError):
+                self.load(cache=backend, **{"algolia.index_registry": "true"})
+
+
+def enable_registry(test):
+    registry = IndexRegistry(test.app.app.registry.cache, "kinto")
+    patch = mock.patch.object(test.indexer, "index_registry", registry)
+    patch.start()
+    test.addCleanup(patch.stop)
+    return registry
+
+
+class RegisteredIndices(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["kinto.algolia.resources"] = "/buckets/bid /buckets/bid-2"
+        return settings
+
+    def setUp(self):
+        self.registry = enable_registry(self)
+        self.app.put("/buckets/bid", headers=self.headers)
+        body = {"data": {"algolia:sort_orders": {"age": "asc(age)"}}}
+        self.app.put_json("/buckets/bid/collections/cid", body, headers=self.headers)
+        self.indexer.join()
+        self.app_id = self.indexer.application_id
+        self.names = [(self.app_id, "kinto-bid-cid"), (self.app_id, "kinto-bid-cid-sort-age")]
+
+    def list_indices(self):
+        return mock.patch.object(self.indexer, "list_indices",
+                                 wraps=self.indexer.list_indices)
+
+    def test_index_creations_are_not_trusted_until_rebuilt(self):
+        assert self.registry.indices("bid") is None
+        rebuild(self.registry, {"bid": self.names})
+        assert self.registry.indices("bid") == self.names
+        self.app.put("/buckets/bid/collections/other", headers=self.headers)
+        assert self.registry.indices("bid") is None
+
+    def test_implicit_index_creations_stamp_the_bucket(self):
+        rebuild(self.registry, {"bid": self.names})
+        self.app.put_json("/buckets/bid/collections/cid/records/r1",
+                          {"data": {"age": 1}}, headers=self.headers)
+        assert self.registry.indices("bid") == self.names
+        with self.indexer.bulk() as bulk:
+            bulk.index_record("bid", "existing", {"id": "r1"})
+        assert self.registry.indices("bid") is None
+
+    def test_bucket_deletion_targets_registered_indices(self):
+        rebuild(self.registry, {"bid": self.names})
+        with self.list_indices() as list_indices:
+            self.app.delete("/buckets/bid", headers=self.headers)
+        assert not list_indices.called
+        names = [i["name"] for i in self.indexer.client.list_indices()["items"]]
+        assert not [n for n in names if n.startswith("kinto-bid-")]
+        assert self.registry.indices("bid") is None
+
+    def test_bucket_deletion_lists_indices_if_unknown(self):
+        with self.list_indices() as list_indices:
+            self.indexer.delete_index("bid")
+        list_indices.assert_called_with("kinto-bid-")
+
+    def test_collection_and_replicas_deletions_are_registered(self):
+        rebuild(self.registry, {"bid": self.names})
+        self.indexer.delete_replicas("bid", "cid", ["age"])
+        assert self.registry.indices("bid") == [(self.app_id, "kinto-bid-cid")]
+        self.app.delete("/buckets/bid/collections/cid", headers=self.headers)
+        assert self.registry.indices("bid") == []
+
+    def test_flush_targets_registered_indices(self):
+        rebuild(self.registry, {"bid": self.names})
+        with self.list_indices() as list_indices:
+            self.indexer.flush()
+        assert not list_indices.called
+        assert self.indexer.client.list_indices()["items"] == []
+        assert self.registry.buckets() is None
+
+    def test_flush_lists_indices_if_unknown(self):
+        with self.list_indices() as list_indices:
+            self.indexer.flush()
+        list_indices.assert_called_with("kinto")
+        assert self.indexer.client.list_indices()["items"] == []
+
+    def test_unmonitored_buckets_are_not_stamped(self):
+        with mock.patch.object(self.registry, "touch") as touch:
+            self.app.put("/buckets/other", headers=self.headers)
+            self.app.put("/buckets/other/collections/cid", headers=self.headers)
+        assert not touch.called
+
+
+class Reconcile(BaseWebTest, unittest.TestCase):
+
+    def setUp(self):
+        self.registry = enable_registry(self)
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid-2", headers=self.headers)
+        self.app.put("/buckets/empty", headers=self.headers)
+        for bucket_id, collection_id in [("bid", "cid"), ("bid-2", "x"), ("gone", "y")]:
+            self.indexer.create_index(bucket_id, collection_id, wait_for_creation=True)
+        self.app_id = self.indexer.application_id
+
+        env = {"registry": self.app.app.registry}
+        for target, kwargs in [("bootstrap", {"return_value": env}), ("print", {})]:
+            patch = mock.patch("kinto_algolia.command_reconcile." + target,
+                               create=True, **kwargs)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_cli(self):
+        return main(["--ini", self.ini_path()])
+
+    def test_registry_is_rebuilt_from_algolia(self):
+        with mock.patch("kinto_algolia.command_reconcile.logger") as logger:
+            assert self.run_cli() == 0
+        assert self.registry.indices("bid") == [(self.app_id, "kinto-bid-cid")]
+        assert self.registry.indices("bid-2") == [(self.app_id, "kinto-bid-2-x")]
+        assert self.registry.indices("empty") == []
+        logger.warning.assert_called_with(
+            "Index 'kinto-gone-y' of application '%s' does not belong to any bucket."
+            % self.app_id)
+
+    def test_indices_created_while_listing_are_not_trusted(self):
+        list_indices = self.indexer.list_indices
+
+        def create_while_listing(prefix):
+            self.indexer.create_index("bid", "new", wait_for_creation=True)
+            return list_indices(prefix)
+
+        with mock.patch.object(self.indexer, "list_indices", create_while_listing):
+            assert self.run_cli() == 0
+        assert self.registry.indices("bid") is None
+        assert self.registry.indices("bid-2") == [(self.app_id, "kinto-bid-2-x")]
+
+    def test_buckets_are_paginated(self):
+        bucket_ids = get_bucket_ids(self.app.app.registry.storage, limit=2)
+        assert list(bucket_ids) == ["bid", "bid-2", "empty"]
+
+    def test_cli_fails_if_registry_is_disabled(self):
+        with mock.patch.object(self.indexer, "index_registry", None):
+            with mock.patch("kinto_algolia.command_reconcile.logger") as logger:
+                assert self.run_cli() == 62
+        logger.error.assert_called_with("kinto-algolia index registry not enabled.")
+
+    def test_cli_fails_if_algolia_plugin_not_installed(self):
+        with mock.patch("kinto_algolia.command_reconcile.bootstrap",
+                        return_value={"registry": object()}):
+            assert self.run_cli() == 62
+
+    def test_cli_default_to_sys_argv(self):
+        with mock.patch("sys.argv", ["cli"]):
+            assert main() == 0
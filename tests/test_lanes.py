@@ -0,0 +1,193 @@
+import threading
+import unittest
+from unittest import mock
+
+from algoliasearch.exceptions import AlgoliaException
+from pyramid import testing
+from pyramid.exceptions import ConfigurationError
+
+from kinto_algolia import lanes as algolia_lanes
+from kinto_algolia.command_reindex import reindex_records
+from kinto_algolia.lanes import Lane, Lanes
+from . import BaseWebTest
+
+
+class LanesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = mock.MagicMock()
+        self.lanes = Lanes({"bulk": 1}, self.metrics, interactive_max_records=2)
+        self.addCleanup(self.lanes.wait)
+
+    def test_small_changes_are_interactive(self):
+        assert self.lanes.lane_for(1) == "interactive"
+        assert self.lanes.lane_for(2) == "interactive"
+        assert self.lanes.lane_for(3) == "bulk"
+
+    def test_interactive_work_is_not_delayed_by_bulk_work(self):
+        released = threading.Event()
+        self.lanes.submit("bulk", released.wait)
+        blocked = self.lanes.submit("bulk", lambda: "import")
+        future = self.lanes.submit("interactive", lambda: "edit")
+        assert future.result(timeout=5) == "edit"
+        assert not blocked.done()
+        released.set()
+        assert blocked.result(timeout=5) == "import"
+
+    def test_work_of_a_key_runs_in_order_on_one_worker(self):
+        lanes = Lanes({"interactive": 4}, self.metrics)
+        self.addCleanup(lanes.wait)
+        lane = lanes.lanes["interactive"]
+        assert lane.worker_for(("bid", "cid")) == lane.worker_for(("bid", "cid"))
+        released = threading.Event()
+        lanes.submit("interactive", released.wait, key=("bid", "cid"))
+        done = []
+        futures = [lanes.submit("interactive", done.append, i, key=("bid", "cid"))
+                   for i in range(10)]
+        assert not any(f.done() for f in futures)
+        released.set()
+        lanes.wait()
+        assert done == list(range(10))
+
+    def test_interactive_work_waits_for_pending_bulk_work_of_its_key(self):
+        released = threading.Event()
+        self.lanes.submit("bulk", released.wait, key=("bid", "cid"))
+        done = []
+        edit = self.lanes.submit("interactive", done.append, "edit", key=("bid", "cid"))
+        other = self.lanes.submit("interactive", done.append, "other", key=("bid", "x"))
+        assert other.result(timeout=5) is None
+        assert not edit.done()
+        assert self.lanes.pending[("bid", "cid")] == ("bulk", edit)
+        released.set()
+        edit.result(timeout=5)
+        assert done == ["other", "edit"]
+        assert ("bid", "cid") not in self.lanes.pending
+        self.lanes.submit("interactive", done.append, "again", key=("bid", "cid"))
+        self.lanes.wait()
+        assert done == ["other", "edit", "again"]
+
+    def test_queue_depth_is_sent_to_metrics(self):
+        released = threading.Event()
+        self.lanes.submit("bulk", released.wait)
+        self.lanes.submit("bulk", released.wait)
+        self.metrics.gauge.assert_called_with("lanes.bulk.queue_depth", 2)
+        released.set()
+        self.lanes.wait()
+        self.metrics.gauge.assert_called_with("lanes.bulk.queue_depth", 0)
+
+    def test_failures_are_logged_and_counted(self):
+        released = threading.Event()
+        self.lanes.submit("bulk", released.wait)
+        future = self.lanes.submit("bulk", int, "not a number")
+        reported = threading.Event()
+        # Called after the callback of the lane.
+        future.add_done_callback(lambda future: reported.set())
+        with mock.patch("kinto_algolia.lanes.logger") as logger:
+            released.set()
+            assert reported.wait(timeout=5)
+        assert "lane 'bulk'" in logger.error.call_args[0][0]
+        assert logger.error.call_args[1]["exc_info"][0] is ValueError
+        self.metrics.error.assert_called_with("lanes.bulk")
+
+    def test_cancelled_work_is_not_reported(self):
+        lane = Lane("bulk", 1, self.metrics)
+        future = mock.MagicMock()
+        future.cancelled.return_value = True
+        lane._done(future)
+        assert not self.metrics.error.called
+
+    def test_workers_are_created_once_per_process(self):
+        lane = Lane("bulk", 1, self.metrics)
+        executors = lane.executors
+        assert lane.executors is executors
+        with mock.patch("kinto_algolia.lanes.os.getpid", return_value=-1):
+            assert lane.executors is not executors
+
+
+class LanesSettings(unittest.TestCase):
+
+    def load(self, **settings):
+        config = testing.setUp(settings=settings)
+        return algolia_lanes.load_from_config(config, mock.MagicMock())
+
+    def test_lanes_are_disabled_by_default(self):
+        assert self.load() is None
+
+    def test_workers_can_be_configured_per_lane(self):
+        lanes = self.load(**{"algolia.async_indexing": "true",
+                             "algolia.lanes.bulk.workers": "3",
+                             "algolia.lanes.interactive.max_records": "5"})
+        assert lanes.lanes["bulk"].workers == 3
+        assert lanes.lanes["interactive"].workers == 4
+        assert lanes.interactive_max_records == 5
+
+    def test_workers_must_be_positive(self):
+        with self.assertRaises(ConfigurationError):
+            self.load(**{"algolia.async_indexing": "true",
+                         "algolia.lanes.reindex.workers": "0"})
+
+
+class AsyncIndexing(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["algolia.async_indexing"] = "true"
+        settings["algolia.lanes.interactive.max_records"] = "1"
+        return settings
+
+    def setUp(self):
+        self.lanes = self.app.app.registry.algolia_lanes
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+
+    def search_ids(self):
+        self.lanes.wait()
+        self.indexer.join()
+        resp = self.app.get("/buckets/bid/collections/cid/search", headers=self.headers)
+        return sorted(h["objectID"] for h in resp.json["hits"])
+
+    def test_records_are_indexed_in_background(self):
+        with mock.patch.object(self.lanes, "submit", wraps=self.lanes.submit) as submit:
+            for record_id in ("a", "b"):
+                self.app.put_json("/buckets/bid/collections/cid/records/" + record_id,
+                                  {"data": {"title": record_id}}, headers=self.headers)
+            assert self.search_ids() == ["a", "b"]
+            self.app.delete("/buckets/bid/collections/cid/records", headers=self.headers)
+            assert self.search_ids() == []
+        lanes = [c[0][0] for c in submit.call_args_list]
+        assert lanes == ["interactive", "interactive", "bulk"]
+
+    def test_background_indexing_errors_are_logged(self):
+        with mock.patch.object(self.indexer, "bulk", side_effect=AlgoliaException):
+            with mock.patch("kinto_algolia.listener.logger") as logger:
+                self.app.put_json("/buckets/bid/collections/cid/records/a",
+                                  {"data": {"title": "a"}}, headers=self.headers)
+                self.lanes.wait()
+        logger.exception.assert_called_with("Failed to index record")
+
+
+class ReindexLane(unittest.TestCase):
+
+    def setUp(self):
+        self.lanes = Lanes({}, mock.MagicMock())
+        self.indexer = mock.MagicMock()
+        patch = mock.patch("kinto_algolia.command_reindex.get_paginated_records",
+                           return_value=[[{"id": "a"}, {"id": "b"}], [{"id": "c"}]])
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_pages_are_uploaded_on_reindex_lane(self):
+        with mock.patch.object(self.lanes, "submit", wraps=self.lanes.submit) as submit:
+            with mock.patch("builtins.print") as print_:
+                reindex_records(self.indexer, None, "bid", "cid", lanes=self.lanes)
+        assert [c[0][0] for c in submit.call_args_list] == ["reindex", "reindex"]
+        print_.assert_called_with("\n3 records reindexed.")
+
+    def test_failed_pages_are_logged(self):
+        self.indexer.bulk.side_effect = [AlgoliaException, mock.MagicMock()]
+        with mock.patch("kinto_algolia.command_reindex.logger") as logger:
+            with mock.patch("builtins.print") as print_:
+                reindex_records(self.indexer, None, "bid", "cid", lanes=self.lanes)
+        logger.exception.assert_called_with("Failed to index record")
+        assert print_.call_args[0][0].endswith("records reindexed.")
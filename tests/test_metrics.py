@@ -0,0 +1,97 @@
+import unittest
+from unittest import mock
+
+from algoliasearch.exceptions import AlgoliaException
+from pyramid.exceptions import ConfigurationError
+
+from . import BaseWebTest
+
+
+class StatsDMetrics(BaseWebTest, unittest.TestCase):
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        self.statsd_client = self.indexer.metrics.statsd
+        self.indexer.join()
+
+    def test_batch_size_payload_and_latency_are_sent(self):
+        with mock.patch.object(self.statsd_client, "timing") as timing:
+            with mock.patch.object(self.statsd_client, "incr") as incr:
+                self.app.post_json("/buckets/bid/collections/cid/records",
+                                   {"data": {"hola": "mundo"}},
+                                   headers=self.headers)
+        timers = dict((c[0][0], c[0][1]) for c in timing.call_args_list)
+        assert timers["plugins.algolia.batch_size"] == 1
+        assert "plugins.algolia.batch" in timers
+        counters = dict((c[0][0], c[1]["count"]) for c in incr.call_args_list)
+        assert counters["plugins.algolia.indexed_records.kinto-bid-cid"] == 1
+        assert counters["plugins.algolia.payload_bytes.kinto-bid-cid"] > 0
+
+    def test_pending_tasks_are_sent(self):
+        with mock.patch.object(self.statsd_client, "gauge") as gauge:
+            self.app.post_json("/buckets/bid/collections/cid/records",
+                               {"data": {"hola": "mundo"}},
+                               headers=self.headers)
+            self.indexer.join()
+        values = [c[0][1] for c in gauge.call_args_list
+                  if c[0][0] == "plugins.algolia.pending_tasks"]
+        assert values == [1, 0]
+
+    def test_only_the_last_task_of_each_index_is_kept(self):
+        for _ in range(3):
+            self.app.post_json("/buckets/bid/collections/cid/records",
+                               {"data": {"hola": "mundo"}},
+                               headers=self.headers)
+        assert len(self.indexer.tasks) == 1
+        with mock.patch.object(self.statsd_client, "gauge") as gauge:
+            self.indexer.join()
+        gauge.assert_any_call("plugins.algolia.pending_tasks", 1)
+        assert self.indexer.tasks == {}
+
+    def test_errors_are_counted_by_operation(self):
+        with mock.patch.object(self.statsd_client, "incr") as incr:
+            with mock.patch.object(self.indexer, "client") as client:
+                client.init_index.return_value.search.side_effect = AlgoliaException
+                self.app.post("/buckets/bid/collections/cid/search",
+                              headers=self.headers, status=400)
+        counters = [c[0][0] for c in incr.call_args_list]
+        assert "plugins.algolia.errors.search" in counters
+
+
+class PrometheusMetrics(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["algolia.metrics.prometheus"] = "true"
+        return settings
+
+    def test_metrics_are_exposed(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        self.app.post_json("/buckets/bid/collections/cid/records",
+                           {"data": {"hola": "mundo"}},
+                           headers=self.headers)
+        self.indexer.join()
+        resp = self.app.get("/__algolia_metrics__")
+        assert resp.content_type == "text/plain"
+        body = resp.body.decode("utf-8")
+        assert 'kinto_algolia_operation_seconds_count{operation="batch"}' in body
+        assert 'kinto_algolia_indexed_records_total{index="kinto-bid-cid"} 1.0' in body
+        assert "kinto_algolia_pending_tasks 0.0" in body
+
+    def test_errors_and_retries_are_counted(self):
+        metrics = self.indexer.metrics
+        with self.assertRaises(ValueError):
+            with metrics.timer("batch"):
+                raise ValueError
+        metrics.retry("search")
+        body = self.app.get("/__algolia_metrics__").body.decode("utf-8")
+        assert 'kinto_algolia_errors_total{operation="batch"} 1.0' in body
+        assert 'kinto_algolia_retries_total{operation="search"} 1.0' in body
+
+    def test_prometheus_client_is_required(self):
+        with mock.patch.dict("sys.modules", {"prometheus_client": None}):
+            with self.assertRaises(ConfigurationError):
+                self.make_app()
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from algoliasearch.exceptions import AlgoliaException
+
+from . import BaseWebTest
+
+
+class ServerTiming(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["algolia.profiling.server_timing"] = "true"
+        return settings
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+
+    def test_search_phases_durations_are_returned(self):
+        resp = self.app.get("/buckets/bid/collections/cid/search", headers=self.headers)
+        phases = [p.split(";")[0] for p in resp.headers["Server-Timing"].split(", ")]
+        assert phases == ["routing", "permission", "params", "referer", "algolia",
+                          "render", "total"]
+
+    def test_header_is_returned_on_algolia_errors(self):
+        with mock.patch.object(self.indexer, "client") as client:
+            client.init_index.return_value.search.side_effect = AlgoliaException
+            resp = self.app.post("/buckets/bid/collections/cid/search",
+                                 headers=self.headers, status=400)
+        assert "algolia;dur=" in resp.headers["Server-Timing"]
+
+    def test_other_endpoints_are_not_timed(self):
+        resp = self.app.get("/buckets/bid/collections/cid", headers=self.headers)
+        assert "Server-Timing" not in resp.headers
+
+
+class SampledProfiles(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(cls.directory)
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["algolia.profiling.sample_rate"] = "1.0"
+        settings["algolia.profiling.directory"] = cls.directory
+        return settings
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        for filename in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, filename))
+
+    def search(self, query="", status=200):
+        url = "/buckets/bid/collections/cid/search?query={}".format(query)
+        return self.app.get(url, headers=self.headers, status=status)
+
+    def test_search_requests_profiles_are_written(self):
+        resp = self.search()
+        assert "Server-Timing" not in resp.headers
+        profiles = os.listdir(self.directory)
+        assert len(profiles) == 1
+        assert profiles[0].startswith("search-")
+
+    def test_other_endpoints_are_not_profiled(self):
+        with mock.patch("kinto_algolia.profiling.cProfile.Profile") as profile:
+            self.app.get("/buckets/bid/collections/cid", headers=self.headers)
+        assert not profile.called
+
+    def test_concurrent_requests_are_not_profiled_twice(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def search(*args):
+            barrier.wait()
+            return {"hits": []}
+
+        def request(query):
+            statuses.append(self.search(query).status_code)
+
+        statuses = []
+        threads = [threading.Thread(target=request, args=(q,)) for q in "ab"]
+        with mock.patch.object(self.indexer, "_search", side_effect=search):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert statuses == [200, 200]
+        assert len(os.listdir(self.directory)) == 1
+
+    def test_request_is_not_sampled_if_another_profiler_is_active(self):
+        with mock.patch("kinto_algolia.profiling.cProfile.Profile") as profile:
+            profile.return_value.enable.side_effect = ValueError(
+                "Another profiling tool is already active")
+            self.search()
+        assert os.listdir(self.directory) == []
+        self.search()
+        assert len(os.listdir(self.directory)) == 1
@@ -0,0 +1,269 @@
+import threading
+import unittest
+from unittest import mock
+
+from algoliasearch.exceptions import AlgoliaException
+from pyramid import testing
+from pyramid.exceptions import ConfigurationError
+
+from kinto_algolia import listener, ratelimit
+from kinto_algolia.metrics import Metrics
+from kinto_algolia.ratelimit import RateLimiter, TokenBucket
+from kinto_algolia.utils import PeriodicThread
+from . import BaseWebTest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_tokens_are_refilled_at_given_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, clock=clock)
+        assert bucket.consume(15) == 10
+        assert bucket.usage == 1
+        clock.now += 0.5
+        assert bucket.consume(15) == 5
+        clock.now += 10
+        assert bucket.consume(15) == 10
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.indexer = mock.MagicMock()
+        rates = {("bid", "cid"): 2, ("shared", None): 1}
+        self.limiter = RateLimiter(self.indexer, rates, clock=self.clock)
+        for target in ("start", "_send"):
+            patch = mock.patch.object(self.limiter, target)
+            setattr(self, target.strip("_"), patch.start())
+            self.addCleanup(patch.stop)
+
+    def changes(self, *ids, action="create"):
+        return [(action, {"id": i}, None) for i in ids]
+
+    def sent_ids(self):
+        changes = self.send.call_args[0][2]
+        return [r["id"] for _, _, r, _ in changes]
+
+    def test_changes_beyond_budget_are_deferred(self):
+        self.limiter.submit("bid", "cid", self.changes("a", "b", "c", "d"))
+        self.send.assert_called_with("bid", ("bid", "cid"), mock.ANY)
+        assert self.sent_ids() == ["a", "b"]
+        assert list(self.limiter.deferred[("bid", "cid")]) == [("cid", "c"), ("cid", "d")]
+        self.start.assert_called_with()
+
+    def test_deferred_changes_are_coalesced_by_record(self):
+        self.limiter.submit("bid", "cid", self.changes("a", "b", "c", "d"))
+        self.limiter.submit("bid", "cid", self.changes("c", action="delete"))
+        assert self.sent_ids() == []
+        deferred = self.limiter.deferred[("bid", "cid")]
+        assert list(deferred) == [("cid", "d"), ("cid", "c")]
+        assert deferred[("cid", "c")] == ("delete", {"id": "c"}, None)
+
+    def test_deferred_updates_apply_to_last_sent_version(self):
+        self.limiter.submit("bid", "cid", self.changes("a", "b", "c"))
+        v1, v2, v3 = ({"id": "a", "v": i} for i in range(3))
+        self.limiter.submit("bid", "cid", [("update", v2, v1), ("update", v3, v2)])
+        deferred = self.limiter.deferred[("bid", "cid")]
+        assert deferred[("cid", "a")] == ("update", v3, v1)
+
+        # Created record was not sent yet, it is sent entirely.
+        self.limiter.submit("bid", "cid", [("update", {"id": "c", "v": 1}, {"id": "c"})])
+        assert deferred[("cid", "c")] == ("create", {"id": "c", "v": 1}, None)
+
+    def test_deferred_changes_are_indexed_when_budget_allows(self):
+        self.limiter.submit("bid", "cid", self.changes("a", "b", "c", "d", "e"))
+        self.clock.now += 1
+        self.limiter.drain()
+        self.send.assert_called_with("bid", ("bid", "cid"), [
+            ("cid", "create", {"id": "c"}, None),
+            ("cid", "create", {"id": "d"}, None)])
+        self.clock.now += 1
+        self.limiter.drain()
+        self.limiter.drain()
+        assert self.send.call_count == 3
+        assert self.limiter.deferred == {}
+
+    def test_changes_of_a_scope_are_taken_and_sent_in_order(self):
+        self.limiter.submit("bid", "cid", self.changes("a", "b", "c"))
+        self.clock.now += 1
+        sent = []
+        requests = []
+
+        def send(bucket_id, scope, changes):
+            if not requests:
+                # A request deletes the record while the drain sends it.
+                request = threading.Thread(target=self.limiter.submit, args=(
+                    "bid", "cid", self.changes("c", action="delete")))
+                requests.append(request)
+                request.start()
+                request.join(timeout=0.1)
+            sent.extend((action, record["id"]) for _, action, record, _ in changes)
+
+        self.send.side_effect = send
+        self.limiter.drain()
+        requests[0].join()
+        assert sent == [("create", "c"), ("delete", "c")]
+
+    def test_deferred_changes_are_sent_on_the_lanes_of_their_scope(self):
+        limiter = RateLimiter(self.indexer, {("bid", None): 1}, clock=self.clock,
+                              lanes=mock.MagicMock())
+        limiter.lanes.lane_for.return_value = "interactive"
+        with mock.patch.object(limiter, "start"):
+            limiter.submit("bid", "cid", self.changes("a", "b"))
+        self.clock.now += 1
+        limiter.drain()
+        limiter.lanes.submit.assert_called_with(
+            "interactive", listener.try_index_changes, self.indexer, "bid",
+            [("cid", "create", {"id": "b"}, None)], key=("bid", None))
+
+    def test_indexing_errors_of_deferred_changes_are_logged(self):
+        limiter = RateLimiter(self.indexer, {("bid", "cid"): 1}, clock=self.clock)
+        with mock.patch.object(limiter, "start"):
+            limiter.submit("bid", "cid", self.changes("a", "b"))
+        self.clock.now += 1
+        with mock.patch("kinto_algolia.listener.index_changes",
+                        side_effect=AlgoliaException):
+            with mock.patch("kinto_algolia.listener.logger") as logger:
+                limiter.drain()
+        assert logger.exception.called
+
+    def test_bucket_budget_is_shared_by_its_collections(self):
+        self.limiter.submit("shared", "a", self.changes("x"))
+        assert self.sent_ids() == ["x"]
+        self.limiter.submit("shared", "b", self.changes("x"))
+        assert self.sent_ids() == []
+        self.send.assert_called_with("shared", ("shared", None), [])
+        assert list(self.limiter.deferred[("shared", None)]) == [("b", "x")]
+
+    def test_collections_without_limit_are_not_throttled(self):
+        self.limiter.submit("other", "cid", self.changes("a", "b", "c"))
+        self.send.assert_called_with("other", ("other", "cid"), mock.ANY)
+        assert self.sent_ids() == ["a", "b", "c"]
+        assert self.limiter.deferred == {}
+
+    def test_default_rate_applies_per_collection(self):
+        self.limiter.default_rate = 1
+        self.limiter.submit("other", "a", self.changes("x", "y"))
+        assert self.sent_ids() == ["x"]
+        self.limiter.submit("other", "b", self.changes("x", "y"))
+        assert self.sent_ids() == ["x"]
+
+    def test_budget_usage_is_sent_to_metrics(self):
+        self.limiter.submit("bid", "cid", self.changes("a", "b", "c"))
+        self.indexer.metrics.budget.assert_called_with("bid/cid", 1, 1)
+
+    def test_drain_is_started_once_per_process(self):
+        limiter = RateLimiter(self.indexer, {})
+        with mock.patch("kinto_algolia.utils.threading.Thread") as thread:
+            limiter.start()
+            limiter.start()
+        thread.assert_called_once()
+        limiter.stop()
+        assert limiter.thread._stopped.is_set()
+
+
+class PeriodicThreadTest(unittest.TestCase):
+
+    def test_function_is_called_periodically(self):
+        func = mock.MagicMock()
+        thread = PeriodicThread("test", 0.01, func)
+        thread._stopped.wait = mock.MagicMock(side_effect=[False, False, True])
+        thread._run()
+        assert func.call_count == 2
+
+    def test_thread_is_started_again_after_a_fork(self):
+        on_start = mock.MagicMock()
+        thread = PeriodicThread("test", 0.01, mock.MagicMock())
+        with mock.patch("kinto_algolia.utils.threading.Thread") as thread_class:
+            thread.start(on_start=on_start)
+            with mock.patch("kinto_algolia.utils.os.getpid", return_value=-1):
+                thread.start(on_start=on_start)
+        assert thread_class.call_count == 2
+        assert on_start.call_count == 2
+
+
+class BudgetMetrics(unittest.TestCase):
+
+    def test_budget_is_sent_to_statsd_and_prometheus(self):
+        statsd = mock.MagicMock()
+        metrics = Metrics(statsd=statsd, prometheus=True)
+        metrics.budget("bid/cid", 0.5, 3)
+        statsd.gauge.assert_any_call("plugins.algolia.rate_limit.bid.cid.usage", 0.5)
+        statsd.gauge.assert_any_call("plugins.algolia.rate_limit.bid.cid.deferred", 3)
+        registry = metrics.prometheus_registry
+        labels = {"scope": "bid/cid"}
+        assert registry.get_sample_value("kinto_algolia_rate_limit_usage", labels) == 0.5
+        assert registry.get_sample_value("kinto_algolia_rate_limit_deferred", labels) == 3
+
+
+class RateLimitSettings(unittest.TestCase):
+
+    def load(self, **settings):
+        config = testing.setUp(settings=settings)
+        return ratelimit.load_from_config(config, mock.sentinel.indexer)
+
+    def test_rate_limiter_is_disabled_by_default(self):
+        assert self.load() is None
+
+    def test_rates_are_read_by_bucket_and_collection(self):
+        limiter = self.load(**{"algolia.rate_limit": "50",
+                               "algolia.bid.rate_limit": "10",
+                               "algolia.bid.cid.rate_limit": "5"})
+        assert limiter.default_rate == 50
+        assert limiter.rates == {("bid", None): 10, ("bid", "cid"): 5}
+
+    def test_rates_must_be_positive(self):
+        with self.assertRaises(ConfigurationError):
+            self.load(**{"algolia.bid.rate_limit": "0"})
+
+
+class RateLimitedIndexing(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["algolia.bid.cid.rate_limit"] = "1"
+        return settings
+
+    def setUp(self):
+        self.limiter = self.app.app.registry.algolia_rate_limiter
+        self.limiter.clock = FakeClock()
+        self.limiter.buckets = {}
+        patch = mock.patch.object(self.limiter, "start")
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+
+    def search_ids(self):
+        self.indexer.join()
+        resp = self.app.get("/buckets/bid/collections/cid/search", headers=self.headers)
+        return sorted(h["objectID"] for h in resp.json["hits"])
+
+    def test_deferred_records_are_eventually_indexed(self):
+        for record_id in ("a", "b", "c"):
+            self.app.put_json("/buckets/bid/collections/cid/records/" + record_id,
+                              {"data": {"title": record_id}}, headers=self.headers)
+        self.app.delete("/buckets/bid/collections/cid/records/c", headers=self.headers)
+        assert self.search_ids() == ["a"]
+
+        self.limiter.drain()
+        assert self.search_ids() == ["a"]
+
+        self.limiter.clock.now += 1
+        self.limiter.drain()
+        assert self.search_ids() == ["a", "b"]
+        self.limiter.clock.now += 1
+        self.limiter.drain()
+        # Record was deleted before being indexed.
+        assert self.search_ids() == ["a", "b"]
+        assert self.limiter.deferred == {}
@@ -0,0 +1,56 @@
+import base64
+import unittest
+from unittest import mock
+
+from kinto.core.testing import get_user_headers
+
+from . import BaseWebTest
+
+
+class SearchKeyView(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["algolia.search_api_key"] = "search-only-key"
+        settings["algolia.secured_key_filters"] = 'owner:"{user_id}"'
+        return settings
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+
+    def test_secured_key_is_restricted_to_collection_index(self):
+        resp = self.app.get("/buckets/bid/collections/cid/search/key",
+                            headers=self.headers)
+        result = resp.json
+        assert result["index_name"] == "kinto-bid-cid"
+        assert result["application_id"] == self.indexer.application_id
+        decoded = base64.b64decode(result["api_key"]).decode("utf-8")
+        assert "restrictIndices=kinto-bid-cid&" in decoded
+        assert "validUntil=%s" % result["valid_until"] in decoded
+        assert "owner%3A%22basicauth%3A" in decoded
+
+    def test_secured_key_is_cached_per_principal(self):
+        url = "/buckets/bid/collections/cid/search/key"
+        first = self.app.get(url, headers=self.headers).json
+        with mock.patch.object(self.indexer, "secured_api_key") as secured_api_key:
+            second = self.app.get(url, headers=self.headers).json
+            assert not secured_api_key.called
+        assert first == second
+
+        body = {"permissions": {"read": ["system.Authenticated"]}}
+        self.app.patch_json("/buckets/bid/collections/cid", body, headers=self.headers)
+        other = self.app.get(url, headers=get_user_headers("alice")).json
+        assert other["api_key"] != first["api_key"]
+
+    def test_secured_key_requires_read_permission(self):
+        headers = get_user_headers("alice")
+        self.app.get("/buckets/bid/collections/cid/search/key", headers=headers,
+                     status=403)
+
+    def test_secured_key_fails_if_search_api_key_not_configured(self):
+        with mock.patch.object(self.indexer, "search_api_key", None):
+            resp = self.app.get("/buckets/bid/collections/cid/search/key",
+                                headers=self.headers, status=503)
+        assert "search_api_key" in resp.json["message"]
@@ -1,3 +1,4 @@
+import json
 import unittest
 from unittest import mock
 
@@ -59,67 +60,115 @@ class SearchView(BaseWebTest, unittest.TestCase):
         assert len(result["hits"]) == 2
 
 
-# ALGOLIA SEARCH DOESN'T SUPPORT LIMITING YET
-# https://github.com/algolia/algoliasearch-client-python/issues/365
-# class LimitedResults(BaseWebTest, unittest.TestCase):
-#     def get_app(self, settings):
-#         app = self.make_app(settings=settings)
-#         app.put("/buckets/bid", headers=self.headers)
-#         app.put_json("/buckets/bid/collections/cid",
-#                      {"data": {"algolia:settings": {}}},
-#                      headers=self.headers)
-#         requests = [{
-#             "method": "POST",
-#             "path": "/buckets/bid/collections/cid/records",
-#             "body": {"data": {"age": i}}
-#         } for i in range(5)]
-#         app.post_json("/batch", {"requests": requests}, headers=self.headers)
-#         sleep(1)  # Wait for indexing
-#         return app
-#
-#     def test_the_number_of_responses_is_limited_by_paginate_by_setting(self):
-#         app = self.get_app({"paginate_by": 2})
-#         resp = app.get("/buckets/bid/collections/cid/search", headers=self.headers)
-#         result = resp.json
-#         assert len(result["hits"]) == 2
-#
-#     def test_the_number_of_responses_is_limited_by_max_fetch_size_setting(self):
-#         app = self.get_app({"storage_max_fetch_size": 2})
-#         resp = app.get("/buckets/bid/collections/cid/search", headers=self.headers)
-#         result = resp.json
-#         assert len(result["hits"]) == 2
-#
-#     def test_the_number_of_responses_is_limited_by_smaller_limit(self):
-#         app = self.get_app({"paginate_by": 4, "storage_max_fetch_size": 2})
-#         resp = app.get("/buckets/bid/collections/cid/search", headers=self.headers)
-#         result = resp.json
-#         assert len(result["hits"]) == 2
-#
-#     def test_the_number_of_responses_is_limited_by_only_defined_limit(self):
-#         app = self.get_app({"paginate_by": 0, "storage_max_fetch_size": 2})
-#         resp = app.get("/buckets/bid/collections/cid/search", headers=self.headers)
-#         result = resp.json
-#         assert len(result["hits"]) == 2
-#
-#     def test_size_specified_in_query_is_taken_into_account(self):
-#         app = self.get_app({"paginate_by": 3})
-#         query = {
-#             "hitsPerPage": 2
-#         }
-#         resp = app.post_json("/buckets/bid/collections/cid/search", query,
-#                              headers=self.headers)
-#         result = resp.json
-#         assert len(result["hits"]) == 2
-#
-#     def test_size_specified_in_query_is_caped_by_setting(self):
-#         app = self.get_app({"paginate_by": 3})
-#         query = {
-#             "hitsPerPage": 4
-#         }
-#         resp = app.post_json("/buckets/bid/collections/cid/search", query,
-#                              headers=self.headers)
-#         result = resp.json
-#         assert len(result["hits"]) == 3
+class LimitedResults(BaseWebTest, unittest.TestCase):
+    def get_app(self, settings):
+        app = self.make_app(settings=settings)
+        app.put("/buckets/bid", headers=self.headers)
+        app.put_json("/buckets/bid/collections/cid",
+                     {"data": {"algolia:settings": {}}},
+                     headers=self.headers)
+        requests = [{
+            "method": "POST",
+            "path": "/buckets/bid/collections/cid/records",
+            "body": {"data": {"age": i}}
+        } for i in range(5)]
+        app.post_json("/batch", {"requests": requests}, headers=self.headers)
+        app.app.registry.indexer.join()
+        return app
+
+    def test_the_number_of_responses_is_limited_by_paginate_by_setting(self):
+        app = self.get_app({"paginate_by": 2})
+        resp = app.get("/buckets/bid/collections/cid/search", headers=self.headers)
+        result = resp.json
+        assert len(result["hits"]) == 2
+
+    def test_the_number_of_responses_is_limited_by_max_fetch_size_setting(self):
+        app = self.get_app({"storage_max_fetch_size": 2})
+        resp = app.get("/buckets/bid/collections/cid/search", headers=self.headers)
+        result = resp.json
+        assert len(result["hits"]) == 2
+
+    def test_the_number_of_responses_is_limited_by_smaller_limit(self):
+        app = self.get_app({"paginate_by": 4, "storage_max_fetch_size": 2})
+        resp = app.get("/buckets/bid/collections/cid/search", headers=self.headers)
+        result = resp.json
+        assert len(result["hits"]) == 2
+
+    def test_the_number_of_responses_is_limited_by_only_defined_limit(self):
+        app = self.get_app({"paginate_by": 0, "storage_max_fetch_size": 2})
+        resp = app.get("/buckets/bid/collections/cid/search", headers=self.headers)
+        result = resp.json
+        assert len(result["hits"]) == 2
+
+    def test_size_specified_in_query_is_taken_into_account(self):
+        app = self.get_app({"paginate_by": 3})
+        query = {
+            "hitsPerPage": 2
+        }
+        resp = app.post_json("/buckets/bid/collections/cid/search", query,
+                             headers=self.headers)
+        result = resp.json
+        assert len(result["hits"]) == 2
+
+    def test_size_specified_in_query_is_caped_by_setting(self):
+        app = self.get_app({"paginate_by": 3})
+        query = {
+            "hitsPerPage": 4
+        }
+        resp = app.post_json("/buckets/bid/collections/cid/search", query,
+                             headers=self.headers)
+        result = resp.json
+        assert len(result["hits"]) == 3
+
+    def test_size_specified_in_querystring_is_caped_by_setting(self):
+        app = self.get_app({"paginate_by": 3})
+        resp = app.get("/buckets/bid/collections/cid/search?hitsPerPage=4",
+                       headers=self.headers)
+        result = resp.json
+        assert len(result["hits"]) == 3
+
+    def test_size_specified_in_query_must_be_an_integer(self):
+        app = self.get_app({"paginate_by": 3})
+        app.get("/buckets/bid/collections/cid/search?hitsPerPage=abc",
+                headers=self.headers, status=400)
+
+
+class ExportView(BaseWebTest, unittest.TestCase):
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        requests = [{
+            "method": "POST",
+            "path": "/buckets/bid/collections/cid/records",
+            "body": {"data": {"age": i}}
+        } for i in range(5)]
+        self.app.post_json("/batch", {"requests": requests}, headers=self.headers)
+        self.indexer.join()
+
+    def test_all_results_are_streamed_as_ndjson(self):
+        resp = self.app.get("/buckets/bid/collections/cid/search/export?hitsPerPage=2",
+                            headers=self.headers)
+        assert resp.content_type == "application/x-ndjson"
+        lines = resp.body.decode("utf-8").splitlines()
+        ages = sorted(json.loads(line)["age"] for line in lines)
+        assert ages == [0, 1, 2, 3, 4]
+
+    def test_export_parameters_can_be_sent_in_body(self):
+        resp = self.app.post_json("/buckets/bid/collections/cid/search/export",
+                                  {"filters": "age<2"}, headers=self.headers)
+        lines = resp.body.decode("utf-8").splitlines()
+        assert len(lines) == 2
+
+    def test_export_response_error_400_indexer_fails(self):
+        with mock.patch.object(self.app.app.registry.indexer, "client") as client:
+            client.init_index.return_value.browse_objects.side_effect = AlgoliaException
+            self.app.get("/buckets/bid/collections/cid/search/export",
+                         headers=self.headers, status=400)
+
+    def test_export_requires_read_permission(self):
+        headers = get_user_headers("cual", "quiera")
+        self.app.get("/buckets/bid/collections/cid/search/export", headers=headers,
+                     status=403)
 
 
 class PermissionsCheck(BaseWebTest, unittest.TestCase):
@@ -168,3 +217,85 @@ class PermissionsCheck(BaseWebTest, unittest.TestCase):
                            headers=headers)
 
         self.app.post("/buckets/bid/collections/cid/search", status=403, headers=headers)
+
+
+class BucketSearchView(BaseWebTest, unittest.TestCase):
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        for cid in ("cid", "other"):
+            self.app.put("/buckets/bid/collections/%s" % cid, headers=self.headers)
+            self.app.post_json("/buckets/bid/collections/%s/records" % cid,
+                               {"data": {"age": 12}}, headers=self.headers)
+        self.indexer.create_index("bid", "other")
+        with self.indexer.bulk() as bulk:
+            bulk.index_record("bid", "other", {"id": "abc", "age": 21})
+        self.indexer.join()
+
+    def test_collections_are_searched_in_a_single_call(self):
+        body = {"collections": ["cid", "other"], "filters": "age<15"}
+        with mock.patch.object(self.indexer.client, "multiple_queries",
+                               wraps=self.indexer.client.multiple_queries) as mocked:
+            resp = self.app.post_json("/buckets/bid/search", body, headers=self.headers)
+        mocked.assert_called_once()
+        results = resp.json["results"]
+        assert len(results["cid"]["hits"]) == 1
+        assert len(results["other"]["hits"]) == 0
+
+    def test_collections_can_be_searched_from_querystring(self):
+        resp = self.app.get("/buckets/bid/search?collections=cid,other",
+                            headers=self.headers)
+        results = resp.json["results"]
+        assert sorted(results.keys()) == ["cid", "other"]
+        assert len(results["other"]["hits"]) == 1
+
+    def test_collections_list_is_required(self):
+        self.app.post_json("/buckets/bid/search", {"query": "foo"},
+                           headers=self.headers, status=400)
+        self.app.get("/buckets/bid/search", headers=self.headers, status=400)
+
+    def test_read_permission_is_checked_on_every_collection(self):
+        body = {"permissions": {"read": ["system.Everyone"]}}
+        self.app.patch_json("/buckets/bid/collections/cid", body, headers=self.headers)
+        self.app.get("/buckets/bid/search?collections=cid", status=200)
+        self.app.get("/buckets/bid/search?collections=cid,other", status=401)
+        headers = get_user_headers("cual", "quiera")
+        self.app.get("/buckets/bid/search?collections=cid,other", status=403,
+                     headers=headers)
+
+    def test_missing_indices_are_created(self):
+        self.app.put("/buckets/bid/collections/new", headers=self.headers)
+        resp = self.app.get("/buckets/bid/search?collections=new",
+                            headers=self.headers)
+        assert resp.json["results"]["new"]["hits"] == []
+
+    def test_search_response_error_400_indexer_fails(self):
+        with mock.patch.object(self.app.app.registry.indexer, "client") as client:
+            client.multiple_queries.side_effect = AlgoliaException
+            self.app.get("/buckets/bid/search?collections=cid", headers=self.headers,
+                         status=400)
+
+
+class FastJSON(BaseWebTest, unittest.TestCase):
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        self.app.put("/buckets/bid/collections/cid", headers=self.headers)
+        self.app.post_json("/buckets/bid/collections/cid/records",
+                           {"data": {"age": 12}}, headers=self.headers)
+        self.indexer.join()
+
+    def test_search_is_rendered_with_orjson_if_installed(self):
+        resp = self.app.post_json("/buckets/bid/collections/cid/search",
+                                  {"filters": "age<15"}, headers=self.headers)
+        assert resp.content_type == "application/json"
+        assert resp.body.startswith(b'{"hits":[{')
+
+    def test_search_works_without_orjson(self):
+        with mock.patch("kinto_algolia.utils.orjson", None):
+            resp = self.app.post_json("/buckets/bid/collections/cid/search",
+                                      {"filters": "age<15"}, headers=self.headers)
+            assert len(resp.json["hits"]) == 1
+            self.app.post("/buckets/bid/collections/cid/search", "blah",
+                          headers=self.headers, status=400)
+            resp = self.app.get("/buckets/bid/collections/cid/search/export",
+                                headers=self.headers)
+            assert json.loads(resp.body.decode("utf-8"))["age"] == 12
@@ -0,0 +1,215 @@
+import unittest
+import zlib
+from unittest import mock
+
+from pyramid import testing
+from pyramid.exceptions import ConfigurationError
+
+from kinto_algolia.indexer import Indexer, load_from_config, merge_results
+from . import BaseWebTest
+
+
+class ShardedCollection(BaseWebTest, unittest.TestCase):
+
+    @classmethod
+    def get_app_settings(cls, extras=None):
+        settings = super().get_app_settings(extras)
+        settings["kinto.algolia.resources"] = ("/buckets/bid/collections/cid "
+                                               "/buckets/bid/collections/other")
+        # Every shard is kept on the configured application, in order to
+        # run against real credentials.
+        settings["algolia.bid.cid.shards"] = "3"
+        return settings
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        body = {"data": {"algolia:sort_orders": {"age": "asc(age)"}}}
+        self.app.put_json("/buckets/bid/collections/cid", body, headers=self.headers)
+        self.app.put("/buckets/bid/collections/other", headers=self.headers)
+        for age in range(10):
+            self.app.put_json("/buckets/bid/collections/cid/records/r{}".format(age),
+                              {"data": {"age": age}}, headers=self.headers)
+        self.app.put_json("/buckets/bid/collections/other/records/o1",
+                          {"data": {"age": 42}}, headers=self.headers)
+        self.indexer.join()
+
+    def test_records_are_routed_by_id_hash(self):
+        for age in range(10):
+            record_id = "r{}".format(age)
+            shard = zlib.crc32(record_id.encode("utf-8")) % 3
+            assert self.indexer.shard("bid", "cid", record_id) == shard
+            index = self.indexer.client_for(shard).init_index(
+                "kinto-bid-cid-shard-{}".format(shard))
+            objects = {o["objectID"]: o for o in index.browse_objects({})}
+            assert objects[record_id]["age"] == age
+
+    def test_unsharded_collections_keep_their_index_name(self):
+        assert self.indexer.shardname("bid", "other", 0) == "kinto-bid-other"
+
+    def test_search_merges_the_shards_results(self):
+        resp = self.app.get("/buckets/bid/collections/cid/search",
+                            headers=self.headers)
+        assert resp.json["nbHits"] == 10
+        assert len(resp.json["hits"]) == 10
+
+    def test_search_pages_are_cut_from_merged_results(self):
+        url = "/buckets/bid/collections/cid/search?sort=age&hitsPerPage=4&page={}"
+        pages = [self.app.get(url.format(page), headers=self.headers).json
+                 for page in range(3)]
+        assert [[h["age"] for h in page["hits"]] for page in pages] == [
+            [0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+        assert pages[0]["nbPages"] == 3
+
+    def test_shards_are_queried_in_parallel(self):
+        with mock.patch.object(self.indexer.executor, "submit",
+                               wraps=self.indexer.executor.submit) as submit:
+            self.app.get("/buckets/bid/collections/cid/search", headers=self.headers)
+        assert submit.call_count == 3
+
+    def test_export_browses_all_shards(self):
+        resp = self.app.get("/buckets/bid/collections/cid/search/export",
+                            headers=self.headers)
+        assert len(resp.body.splitlines()) == 10
+
+    def test_bucket_search_mixes_sharded_and_unsharded_collections(self):
+        resp = self.app.post_json("/buckets/bid/search",
+                                  {"collections": ["cid", "other"]},
+                                  headers=self.headers)
+        assert resp.json["results"]["cid"]["nbHits"] == 10
+        assert resp.json["results"]["other"]["nbHits"] == 1
+
+    def test_bucket_search_sends_all_shards_in_a_single_call(self):
+        client = self.indexer.client
+        with mock.patch.object(client, "multiple_queries",
+                               wraps=client.multiple_queries) as multiple_queries:
+            self.app.post_json("/buckets/bid/search", {"collections": ["cid", "other"]},
+                               headers=self.headers)
+        multiple_queries.assert_called_once()
+        names = [r["indexName"] for r in multiple_queries.call_args[0][0]]
+        assert names == ["kinto-bid-cid-shard-0", "kinto-bid-cid-shard-1",
+                         "kinto-bid-cid-shard-2", "kinto-bid-other"]
+
+    def test_all_shards_are_deleted_with_collection(self):
+        self.app.delete("/buckets/bid/collections/cid", headers=self.headers)
+        names = [i["name"] for i in self.indexer.client.list_indices()["items"]]
+        assert not [n for n in names if n.startswith("kinto-bid-cid")]
+
+    def test_all_applications_are_searched_for_bucket_indices(self):
+        with mock.patch.object(self.indexer, "application_clients",
+                               [mock.MagicMock()]) as clients, \
+                mock.patch.object(self.indexer, "applications",
+                                  [("other-app", "other-key")]), \
+                mock.patch.object(self.indexer, "index_registry", None):
+            clients[0].list_indices.return_value = {"items": [{"name": "kinto-bid-x"}]}
+            self.indexer.delete_index("bid")
+        clients[0].init_index.assert_called_with("kinto-bid-x")
+
+    def test_secured_keys_are_refused_for_sharded_collections(self):
+        with mock.patch.object(self.indexer, "search_api_key", "search-only-key"):
+            resp = self.app.get("/buckets/bid/collections/cid/search/key",
+                                headers=self.headers, status=400)
+        assert "sharded" in resp.json["message"]
+
+
+class ShardedApplications(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = Indexer("app", "key", shards=2,
+                               applications=[("other-app", "other-key")])
+        self.clients = [mock.MagicMock(), mock.MagicMock()]
+        self.indexer.client = self.clients[0]
+        self.indexer.application_clients = self.clients[1:]
+
+    def test_shards_are_spread_across_applications(self):
+        indexer = Indexer("app", "key", applications=[("other-app", "other-key")])
+        assert indexer.client_for(0) is indexer.client
+        assert indexer.client_for(1)._config.app_id == "other-app"
+        assert indexer.client_for(2) is indexer.client
+
+    def test_bucket_search_sends_one_call_per_application(self):
+        for shard, client in enumerate(self.clients):
+            client.multiple_queries.side_effect = lambda requests, shard=shard: {
+                "results": [{"hits": [{"shard": shard, "index": r["indexName"]}],
+                             "nbHits": 1} for r in requests]}
+        results = self.indexer.multiple_search(
+            "bid", [("a", {"hitsPerPage": 5}), ("b", {"page": 1, "hitsPerPage": 1})])
+        for client in self.clients:
+            client.multiple_queries.assert_called_once()
+            assert len(client.multiple_queries.call_args[0][0]) == 2
+        assert results[0]["hits"] == [{"shard": 0, "index": "kinto-bid-a-shard-0"},
+                                      {"shard": 1, "index": "kinto-bid-a-shard-1"}]
+        assert results[1]["page"] == 1
+        assert results[1]["hits"] == [{"shard": 1, "index": "kinto-bid-b-shard-1"}]
+        assert "hitsPerPage=2" in self.clients[0].multiple_queries.call_args[0][0][1]["params"]
+
+
+class MergeResults(unittest.TestCase):
+
+    def test_hits_are_interleaved_by_rank_without_sort(self):
+        results = [{"hits": [{"id": "a1"}, {"id": "a2"}], "nbHits": 2},
+                   {"hits": [{"id": "b1"}], "nbHits": 1}]
+        merged = merge_results(results, page=0, hits_per_page=20)
+        assert [h["id"] for h in merged["hits"]] == ["a1", "b1", "a2"]
+        assert merged["nbPages"] == 1
+
+    def test_hits_are_merged_on_descending_attribute(self):
+        results = [{"hits": [{"age": 5}, {"age": 1}, {}]},
+                   {"hits": [{"age": 3}, {}]}]
+        merged = merge_results(results, page=0, hits_per_page=3,
+                               ranking=["desc(age)"])
+        assert merged["hits"] == [{"age": 5}, {"age": 3}, {"age": 1}]
+
+    def test_hits_without_attribute_come_last_in_ascending_order(self):
+        results = [{"hits": [{"id": "a", "age": 1}, {"id": "b", "age": 5}]},
+                   {"hits": [{"id": "d", "age": 3}, {"id": "c"}]}]
+        merged = merge_results(results, page=0, hits_per_page=20,
+                               ranking=["asc(age)"])
+        assert [h["id"] for h in merged["hits"]] == ["a", "d", "b", "c"]
+
+    def test_hits_with_non_numeric_values_are_merged_last(self):
+        results = [{"hits": [{"id": "a", "age": 5}, {"id": "b", "age": "old"}]},
+                   {"hits": [{"id": "c", "age": True}, {"id": "d", "age": None}]}]
+        merged = merge_results(results, page=0, hits_per_page=20,
+                               ranking=["desc(age)"])
+        assert [h["id"] for h in merged["hits"]] == ["a", "c", "b", "d"]
+
+    def test_facets_counts_are_summed(self):
+        results = [{"hits": [], "facets": {"kind": {"a": 1, "b": 2}}},
+                   {"hits": [], "facets": {"kind": {"a": 3}}}]
+        merged = merge_results(results, page=0, hits_per_page=20)
+        assert merged["facets"] == {"kind": {"a": 4, "b": 2}}
+
+
+class ShardingSettings(unittest.TestCase):
+
+    def make_config(self, **settings):
+        config = testing.setUp(settings=dict(settings, **{
+            "algolia.application_id": "app",
+            "algolia.api_key": "key",
+        }))
+        config.registry.statsd = None
+        return config
+
+    def test_shards_must_be_positive(self):
+        with self.assertRaises(ConfigurationError):
+            load_from_config(self.make_config(**{"algolia.bid.cid.shards": "0"}))
+
+    def test_applications_must_have_an_api_key(self):
+        with self.assertRaises(ConfigurationError):
+            load_from_config(self.make_config(**{"algolia.applications": "app2"}))
+
+    def test_applications_are_read_from_settings(self):
+        config = self.make_config(**{"algolia.applications": "app2:key2 app3:key3"})
+        indexer = load_from_config(config)
+        assert indexer.application_ids() == ["app", "app2", "app3"]
+
+    def test_search_threads_are_sized_for_concurrency(self):
+        indexer = load_from_config(self.make_config(**{"algolia.shards": "2"}))
+        assert indexer.executor._max_workers == 32
+        config = self.make_config(**{"algolia.search_threads": "8",
+                                     "algolia.bid.cid.shards": "10"})
+        assert load_from_config(config).executor._max_workers == 10
+
+    def test_default_number_of_shards_can_be_set(self):
+        indexer = load_from_config(self.make_config(**{"algolia.shards": "2"}))
+        assert indexer.nb_shards("bid", "cid") == 2
@@ -0,0 +1,136 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from algoliasearch.exceptions import AlgoliaException
+from pyramid import testing
+
+from kinto_algolia import indexer as algolia_indexer
+from kinto_algolia.indexer import Indexer
+from kinto_algolia.metrics import Metrics
+from kinto_algolia.singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = mock.MagicMock()
+        self.flight = SingleFlight("search", timeout=5, metrics=self.metrics)
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.executor.shutdown)
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def slow(self, result):
+        self.started.set()
+        self.released.wait(5)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def follow(self, count, *args):
+        # Submit identical calls, and return once they all wait for the leader.
+        done = self.flight.calls["key"].done
+        with mock.patch.object(done, "wait", wraps=done.wait) as wait:
+            followers = [self.executor.submit(self.flight.do, "key", *args)
+                         for _ in range(count)]
+            while wait.call_count < count:
+                time.sleep(0.001)
+        return followers
+
+    def test_concurrent_identical_calls_share_the_result(self):
+        func = mock.MagicMock(side_effect=self.slow)
+        leader = self.executor.submit(self.flight.do, "key", func, "result")
+        self.started.wait(5)
+        followers = self.follow(3, func, "other")
+        self.released.set()
+        assert leader.result(5) == "result"
+        assert [f.result(5) for f in followers] == ["result"] * 3
+        func.assert_called_once_with("result")
+        assert self.metrics.coalesced.call_count == 3
+        assert self.flight.calls == {}
+
+    def test_errors_are_shared_too(self):
+        error = AlgoliaException("boom")
+        leader = self.executor.submit(self.flight.do, "key", self.slow, error)
+        self.started.wait(5)
+        follower, = self.follow(1, self.slow, "other")
+        self.released.set()
+        with self.assertRaises(AlgoliaException):
+            leader.result(5)
+        with self.assertRaises(AlgoliaException):
+            follower.result(5)
+        assert self.flight.calls == {}
+
+    def test_different_keys_are_not_coalesced(self):
+        func = mock.MagicMock(side_effect=lambda value: value)
+        assert self.flight.do("a", func, 1) == 1
+        assert self.flight.do("b", func, 2) == 2
+        assert func.call_count == 2
+        assert not self.metrics.coalesced.called
+
+    def test_followers_call_themselves_after_timeout(self):
+        self.flight.timeout = 0.01
+        leader = self.executor.submit(self.flight.do, "key", self.slow, "result")
+        self.started.wait(5)
+        with mock.patch("kinto_algolia.singleflight.logger") as logger:
+            assert self.flight.do("key", lambda: "own") == "own"
+        assert logger.warning.called
+        self.released.set()
+        assert leader.result(5) == "result"
+
+
+class SearchCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = SingleFlight("search", timeout=5)
+        self.indexer = Indexer("app-id", "api-key", single_flight=self.flight)
+
+    def test_identical_searches_share_the_same_key(self):
+        with mock.patch.object(self.flight, "do") as do:
+            self.indexer.search("bid", "cid", {"query": "a", "page": 1})
+            self.indexer.search("bid", "cid", {"page": 1, "query": "a"})
+            self.indexer.search("bid", "cid", {"query": "a"}, sort="price")
+        keys = [c[0][0] for c in do.call_args_list]
+        assert keys[0] == keys[1]
+        assert keys[0] != keys[2]
+
+    def test_searches_are_sent_to_algolia(self):
+        for indexer in (self.indexer, Indexer("app-id", "api-key")):
+            with mock.patch.object(indexer, "_search_shard",
+                                   return_value={"hits": []}) as search_shard:
+                assert indexer.search("bid", "cid", {"query": "a"}) == {"hits": []}
+            search_shard.assert_called_with("bid", "cid", 0, None, "a", {})
+
+    def test_coalesced_searches_are_counted(self):
+        statsd = mock.MagicMock()
+        metrics = Metrics(statsd=statsd, prometheus=True)
+        metrics.coalesced("search")
+        statsd.incr.assert_called_with("plugins.algolia.coalesced.search")
+        value = metrics.prometheus_registry.get_sample_value(
+            "kinto_algolia_coalesced_total", {"operation": "search"})
+        assert value == 1
+
+
+class CoalescingSettings(unittest.TestCase):
+
+    def load(self, **settings):
+        settings.update({"algolia.application_id": "app-id",
+                         "algolia.api_key": "api-key"})
+        config = testing.setUp(settings=settings)
+        config.registry.statsd = None
+        return algolia_indexer.load_from_config(config)
+
+    def test_searches_are_coalesced_by_default(self):
+        indexer = self.load()
+        assert indexer.single_flight.timeout == 5.0
+
+    def test_wait_timeout_can_be_configured(self):
+        indexer = self.load(**{"algolia.search.coalesce_timeout_seconds": "0.5"})
+        assert indexer.single_flight.timeout == 0.5
+
+    def test_coalescing_can_be_disabled(self):
+        indexer = self.load(**{"algolia.search.coalesce": "false"})
+        assert indexer.single_flight is None
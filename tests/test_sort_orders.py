@@ -0,0 +1,137 @@
+import unittest
+from unittest import mock
+
+from algoliasearch.exceptions import AlgoliaException
+
+from kinto_algolia.indexer import DEFAULT_RANKING
+from . import BaseWebTest
+
+
+class SortOrders(BaseWebTest, unittest.TestCase):
+
+    sort_orders = {"age_asc": "asc(age)", "age_desc": ["desc(age)"]}
+
+    def setUp(self):
+        self.app.put("/buckets/bid", headers=self.headers)
+        body = {"data": {"algolia:sort_orders": self.sort_orders}}
+        self.app.put_json("/buckets/bid/collections/cid", body, headers=self.headers)
+        for age in (21, 12, 42):
+            self.app.post_json("/buckets/bid/collections/cid/records",
+                               {"data": {"age": age}}, headers=self.headers)
+        self.indexer.join()
+
+    def test_replicas_are_declared_on_primary_index(self):
+        index = self.indexer.client.init_index("kinto-bid-cid")
+        assert sorted(index.get_settings()["replicas"]) == [
+            "kinto-bid-cid-sort-age_asc",
+            "kinto-bid-cid-sort-age_desc",
+        ]
+        replica = self.indexer.client.init_index("kinto-bid-cid-sort-age_desc")
+        assert replica.get_settings()["ranking"] == ["desc(age)"] + DEFAULT_RANKING
+
+    def test_sort_is_routed_to_replica(self):
+        resp = self.app.get("/buckets/bid/collections/cid/search?sort=age_asc",
+                            headers=self.headers)
+        assert [h["age"] for h in resp.json["hits"]] == [12, 21, 42]
+
+        resp = self.app.post_json("/buckets/bid/collections/cid/search",
+                                  {"sort": "age_desc"}, headers=self.headers)
+        assert [h["age"] for h in resp.json["hits"]] == [42, 21, 12]
+
+    def test_unknown_sort_order_is_rejected(self):
+        resp = self.app.get("/buckets/bid/collections/cid/search?sort=name",
+                            headers=self.headers, status=400)
+        assert resp.json["details"][0]["name"] == "sort"
+        assert "age_asc, age_desc" in resp.json["details"][0]["description"]
+
+    def test_sort_on_collection_without_sort_orders_is_rejected(self):
+        self.app.put("/buckets/bid/collections/other", headers=self.headers)
+        self.app.get("/buckets/bid/collections/other/search?sort=age_asc",
+                     headers=self.headers, status=400)
+
+    def test_removed_sort_orders_delete_replicas(self):
+        body = {"data": {"algolia:sort_orders": {"age_asc": "asc(age)"}}}
+        with mock.patch.object(self.indexer, "delete_replicas") as delete_replicas:
+            self.app.put_json("/buckets/bid/collections/cid", body, headers=self.headers)
+        delete_replicas.assert_called_with("bid", "cid", ["age_desc"])
+
+    def test_replicas_are_deleted_with_collection(self):
+        self.app.delete("/buckets/bid/collections/cid", headers=self.headers)
+        names = [i["name"] for i in self.indexer.client.list_indices()["items"]]
+        assert not [n for n in names if n.startswith("kinto-bid-cid")]
+
+    def test_replicas_are_created_when_index_is_missing(self):
+        calls = []
+        search = self.indexer.search
+
+        def failing_search(*args, **kwargs):
+            if not calls:
+                calls.append(kwargs)
+                raise AlgoliaException("Index kinto-bid-cid does not exist")
+            return search(*args, **kwargs)
+
+        with mock.patch.object(self.indexer, "search", side_effect=failing_search):
+            with mock.patch.object(self.indexer, "create_index") as create_index:
+                self.app.get("/buckets/bid/collections/cid/search",
+                             headers=self.headers)
+        create_index.assert_called_with("bid", "cid", sort_orders=self.sort_orders,
+                                        wait_for_creation=True)
+
+    def test_search_key_restricts_replicas(self):
+        with mock.patch.object(self.indexer, "search_api_key", "search-key"):
+            resp = self.app.get("/buckets/bid/collections/cid/search/key",
+                                headers=self.headers)
+        assert resp.json["replicas"] == {
+            "age_asc": "kinto-bid-cid-sort-age_asc",
+            "age_desc": "kinto-bid-cid-sort-age_desc",
+        }
+
+    def test_removed_replicas_are_deleted(self):
+        body = {"data": {"algolia:sort_orders": {"age_asc": "asc(age)"}}}
+        self.app.put_json("/buckets/bid/collections/cid", body, headers=self.headers)
+        names = [i["name"] for i in self.indexer.client.list_indices()["items"]]
+        assert "kinto-bid-cid-sort-age_desc" not in names
+
+    def test_replicas_rankings_can_be_waited_for(self):
+        self.indexer.create_index("bid", "other", sort_orders={"age": "asc(age)"},
+                                  wait_for_creation=True)
+        replica = self.indexer.client.init_index("kinto-bid-other-sort-age")
+        assert replica.get_settings()["ranking"][0] == "asc(age)"
+
+    def test_missing_index_has_no_replicas(self):
+        index = self.indexer.client.init_index("kinto-bid-unknown")
+        assert self.indexer._replicas(index) == []
+
+        error = AlgoliaException("Unreachable")
+        with mock.patch.object(index, "get_settings", side_effect=error):
+            with self.assertRaises(AlgoliaException):
+                self.indexer._replicas(index)
+
+    def test_sort_on_unknown_collection_is_rejected(self):
+        self.app.get("/buckets/bid/collections/unknown/search?sort=age_asc",
+                     headers=self.headers, status=400)
+
+    def test_sort_must_be_a_string(self):
+        resp = self.app.post_json("/buckets/bid/collections/cid/search",
+                                  {"sort": ["age_asc"]}, headers=self.headers, status=400)
+        assert resp.json["details"][0]["name"] == "sort"
+
+    def test_invalid_sort_orders_are_rejected(self):
+        with mock.patch.object(self.indexer, "update_index") as update_index:
+            for sort_orders in (["asc(age)"], {"age": 42}, {"age": []}, {"age": [42]}):
+                body = {"data": {"algolia:sort_orders": sort_orders}}
+                resp = self.app.put_json("/buckets/bid/collections/cid", body,
+                                         headers=self.headers, status=400)
+                assert resp.json["details"][0]["name"] == "algolia:sort_orders"
+        assert not update_index.called
+
+    def test_sort_orders_of_unmonitored_collections_are_not_validated(self):
+        body = {"data": {"algolia:sort_orders": ["asc(age)"]}}
+        self.app.put_json("/buckets/bid/collections/other", body, headers=self.headers)
+
+    def test_invalid_stored_sort_orders_are_ignored(self):
+        self.app.app.registry.storage.update(
+            resource_name="collection", parent_id="/buckets/bid", object_id="cid",
+            obj={"id": "cid", "algolia:sort_orders": ["asc(age)"]})
+        self.app.get("/buckets/bid/collections/cid/search?sort=age_asc",
+                     headers=self.headers, status=400)